@@ -0,0 +1,315 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import gc
+import time
+import json
+import shutil
+import argparse
+import tempfile
+from distutils.spawn import find_executable
+
+import collect_sysstat
+__version__ = 0.1
+__author__ = "Sergey Bulavintsev"
+
+
+# Fixture sizes along each axis, the other axes stay at their first size
+AXES = {'cpus': [4, 16, 64, 256, 1024],
+        'disks': [1, 10, 100, 500],
+        'interfaces': [1, 10, 100, 1000, 2000]}
+
+# /proc/meminfo fields of a fixture, in kernel order
+MEMINFO_FIELDS = ['MemTotal', 'MemFree', 'MemAvailable', 'Buffers', 'Cached',
+                  'SwapCached', 'Active', 'Inactive', 'Active(anon)',
+                  'Inactive(anon)', 'Active(file)', 'Inactive(file)',
+                  'Unevictable', 'Mlocked', 'SwapTotal', 'SwapFree', 'Dirty',
+                  'Writeback', 'AnonPages', 'Mapped', 'Shmem', 'Slab',
+                  'SReclaimable', 'SUnreclaim', 'KernelStack', 'PageTables',
+                  'NFS_Unstable', 'Bounce', 'WritebackTmp', 'CommitLimit',
+                  'Committed_AS', 'VmallocTotal', 'VmallocUsed',
+                  'VmallocChunk', 'HardwareCorrupted', 'AnonHugePages',
+                  'HugePages_Total', 'HugePages_Free', 'HugePages_Rsvd',
+                  'HugePages_Surp', 'Hugepagesize', 'DirectMap4k',
+                  'DirectMap2M']
+
+
+# Write a synthetic /proc tree with the given number of devices
+def makefixture(root, cpus, disks, interfaces, tick=0, sysroot=None):
+    """Write stat, meminfo, loadavg, uptime, net/dev and diskstats, and
+    with sysroot the block/<disk>/stat and dev files of every disk.
+
+    Counters grow with tick, so two fixtures written with different
+    ticks give non-zero deltas. Returns the names of the disks and
+    interfaces written.
+    """
+    if not os.path.isdir(os.path.join(root, 'net')):
+        os.makedirs(os.path.join(root, 'net'))
+    base = 1000 + tick * 100
+    lines = ['cpu  %s' % ' '.join(str(base * cpus * (column + 1))
+                                  for column in xrange(10))]
+    for cpu in xrange(cpus):
+        lines.append('cpu%d %s' % (cpu, ' '.join(str(base * (column + 1))
+                                                 for column in xrange(10))))
+    lines.append('intr 0\nctxt %d\nbtime 1500000000\nprocesses 1' % base)
+    writefixture(root, 'stat', lines)
+    writefixture(root, 'meminfo',
+                 ['%-16s%8d%s' % (name + ':', 1024 + index + tick,
+                                  '' if name.startswith('HugePages_')
+                                  else ' kB')
+                  for index, name in enumerate(MEMINFO_FIELDS)])
+    writefixture(root, 'loadavg', ['0.10 0.20 0.30 1/100 1234'])
+    writefixture(root, 'uptime', ['%d.00 %d.00' % (1000 + tick,
+                                                   900 + tick)])
+    names = ['lo'] + ['eth%d' % index for index in xrange(interfaces)]
+    lines = ['Inter-|   Receive                            '
+             '                    |  Transmit',
+             ' face |bytes    packets errs drop fifo frame compressed '
+             'multicast|bytes    packets errs drop fifo colls carrier '
+             'compressed']
+    for index, name in enumerate(names):
+        lines.append('%6s: %s' % (name, ' '.join(str(base * (column + 1) +
+                                                     index)
+                                                 for column in xrange(16))))
+    writefixture(root, 'net/dev', lines)
+    disknames = ['disk%d' % index for index in xrange(disks)]
+    lines = []
+    for index, name in enumerate(disknames):
+        lines.append('%4d %7d %s %s' % (8, index * 16, name,
+                                        ' '.join(str(base * (column + 1))
+                                                 for column in xrange(11))))
+    writefixture(root, 'diskstats', lines)
+    for index, name in enumerate(disknames if sysroot else ()):
+        path = os.path.join(sysroot, 'block', name)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        writefixture(path, 'dev', ['8:%d' % (index * 16)])
+        writefixture(path, 'stat', [lines[index].split(None, 3)[3]])
+    return disknames, names[1:]
+
+
+# Write one fixture file
+def writefixture(root, name, lines):
+    with open(os.path.join(root, name), 'w') as f:
+        f.write('\n'.join(lines) + '\n')
+
+
+# Drop everything the collectors cached for the previous fixture
+def resetcaches():
+    collect_sysstat.closeprocfiles()
+    collect_sysstat.closecolumnstores()
+    collect_sysstat.MEMINFO_LAYOUT.clear()
+    collect_sysstat.UPDATE_PLAN.clear()
+    collect_sysstat.SYS_BLOCK.clear()
+
+
+# Return read and write syscalls of this process so far
+def readsyscalls():
+    counters = {}
+    with open('/proc/self/io', 'r') as f:
+        for line in f:
+            key, _, value = line.partition(':')
+            counters[key] = int(value)
+    return counters.get('syscr', 0), counters.get('syscw', 0)
+
+
+# Time function over repeat calls after one warm-up call
+def measure(function, repeat, before=None):
+    """Return a dict with the median and min seconds per call, and per
+    call the net number of gc tracked objects allocated and the read and
+    write syscalls done by this process (not by rrdtool children).
+    """
+    if before:
+        before()
+    function()
+    # Syscalls of reading /proc/self/io itself are not counted
+    reads, writes = readsyscalls()
+    after = readsyscalls()
+    overhead = (after[0] - reads, after[1] - writes)
+    timings = []
+    allocs = []
+    syscalls = []
+    for _ in xrange(repeat):
+        if before:
+            before()
+        gc.collect()
+        gc.disable()
+        try:
+            reads, writes = readsyscalls()
+            count = gc.get_count()[0]
+            started = time.time()
+            function()
+            timings.append(time.time() - started)
+            allocs.append(gc.get_count()[0] - count)
+            after = readsyscalls()
+            syscalls.append((after[0] - reads - overhead[0],
+                             after[1] - writes - overhead[1]))
+        finally:
+            gc.enable()
+    timings.sort()
+    return {'median_s': timings[len(timings) // 2], 'min_s': timings[0],
+            'allocs': sorted(allocs)[len(allocs) // 2],
+            'syscr': sorted(syscalls)[len(syscalls) // 2][0],
+            'syscw': sorted(syscalls)[len(syscalls) // 2][1]}
+
+
+# Sleep until the next whole second, RRD updates need new timestamps
+def nextsecond():
+    time.sleep(1 - time.time() % 1)
+
+
+# Run every stage against one fixture
+def benchfixture(workdir, cpus, disks, interfaces, repeat, rrdtool):
+    """Return a list of (stage, result) for one fixture size."""
+    root = os.path.join(workdir, 'proc')
+    sysroot = os.path.join(workdir, 'sys')
+    disknames, ifnames = makefixture(root, cpus, disks, interfaces,
+                                     sysroot=sysroot)
+    resetcaches()
+    namespace = collect_sysstat.initnamespace(
+        collect_sysstat.createParser().parse_args([]))
+    namespace['procroot'] = root
+    namespace['rrdpath'] = os.path.join(workdir, 'bench.rrd')
+    namespace['graphpath'] = os.path.join(workdir, 'graphs') + '/'
+    namespace['interface'] = ' '.join(ifnames)
+    namespace['disk'] = ' '.join(disknames)
+    results = []
+    results.append(('read_cpu_data',
+                    measure(lambda: collect_sysstat.read_cpu_data(root),
+                            repeat)))
+    prev = collect_sysstat.read_cpu_data(root)
+    makefixture(root, cpus, disks, interfaces, tick=1)
+    cur = collect_sysstat.read_cpu_data(root)
+    results.append(('diff_cpu_data',
+                    measure(lambda: collect_sysstat.diff_cpu_data(prev, cur),
+                            repeat)))
+    results.append(('readMemValues',
+                    measure(lambda: collect_sysstat.readMemValues(root),
+                            repeat)))
+    results.append(('readNetValues',
+                    measure(lambda: collect_sysstat.readNetValues(
+                        namespace['interface'], root), repeat)))
+    results.append(('readBlockValues',
+                    measure(lambda: collect_sysstat.readBlockValues(
+                        namespace['disk'], root), repeat)))
+    # One wanted disk among all of them, as with a configured disk list
+    results.append(('readBlockValues_one',
+                    measure(lambda: collect_sysstat.readBlockValues(
+                        disknames[-1], root), repeat)))
+    results.append(('readSysBlockValues_one',
+                    measure(lambda: collect_sysstat.readBlockValues(
+                        disknames[-1], root, None, sysroot), repeat)))
+    values = (collect_sysstat.readMemValues(root),
+              collect_sysstat.readNetValues(namespace['interface'], root),
+              collect_sysstat.readBlockValues(namespace['disk'], root),
+              collect_sysstat.diff_cpu_data(prev, cur),
+              collect_sysstat.readLoadAvgValues(root))
+    results.append(('createTemplateAndValues',
+                    measure(lambda: collect_sysstat.createTemplateAndValues(
+                        *values, plankey=namespace['rrdpath']), repeat)))
+    storepath = collect_sysstat.columnstorepath(namespace['rrdpath'])
+    collect_sysstat.createcolumns(namespace, *values, rrdpath=storepath)
+    results.append(('updatecolumns',
+                    measure(lambda: collect_sysstat.updatecolumns(
+                        namespace, *values, rrdpath=storepath), repeat)))
+    if not rrdtool:
+        return results
+    try:
+        collect_sysstat.createrra(namespace, *values)
+    except (OSError, collect_sysstat.ExternalCommandError), error:
+        print "%d cpus, %d disks, %d interfaces: RRD not created, " \
+            "skipping updaterra and draw_file: %s" % (cpus, disks,
+                                                      interfaces, error)
+        return results
+    results.append(('updaterra',
+                    measure(lambda: collect_sysstat.updaterra(namespace,
+                                                              *values),
+                            repeat, nextsecond)))
+    graphpath = namespace['graphpath']
+    results.append(('draw_file',
+                    measure(lambda: collect_sysstat.draw_file(namespace,
+                                                              *values),
+                            repeat, lambda: resetdir(graphpath))))
+    return results
+
+
+# Empty a directory, creating it if needed
+def resetdir(path):
+    shutil.rmtree(path, ignore_errors=True)
+    os.makedirs(path)
+
+
+# Print results and their ratio to a previous run
+def printresults(records, baseline):
+    print "%-10s %5s %-24s %10s %10s %8s %7s %7s" % (
+        'axis', 'size', 'stage', 'median_ms', 'min_ms', 'allocs',
+        'syscr', 'syscw')
+    for record in records:
+        line = "%-10s %5d %-24s %10.3f %10.3f %8d %7d %7d" % (
+            record['axis'], record['size'], record['stage'],
+            record['median_s'] * 1000, record['min_s'] * 1000,
+            record['allocs'], record['syscr'], record['syscw'])
+        old = baseline.get((record['axis'], record['size'], record['stage']))
+        if old and old['median_s'] > 0:
+            line += " %6.2fx" % (record['median_s'] / old['median_s'])
+        print line
+
+
+# Create command line parser
+def createParser():
+    parser = argparse.ArgumentParser(description="""
+Benchmark collect_sysstat collectors, RRD update and graph rendering against
+synthetic /proc trees scaled along cpus, disks or interfaces.
+                                    """)
+    parser.add_argument("-a", "--axis", choices=sorted(AXES) + ['all'],
+                        default='all', help="Axis to scale")
+    parser.add_argument("-r", "--repeat", type=int, default=5,
+                        help="Timed calls per stage")
+    parser.add_argument("-o", "--output",
+                        help="Write results as JSON to this file")
+    parser.add_argument("-c", "--compare",
+                        help="JSON results of an earlier run to compare with")
+    return parser
+
+
+# Main func
+def main(args):
+    rrdtool = find_executable('rrdtool') is not None
+    if not rrdtool:
+        print "rrdtool not found, skipping updaterra and draw_file"
+    baseline = {}
+    if args.compare:
+        with open(args.compare, 'r') as f:
+            for record in json.load(f)['results']:
+                baseline[(record['axis'], record['size'],
+                          record['stage'])] = record
+    axes = sorted(AXES) if args.axis == 'all' else [args.axis]
+    records = []
+    for axis in axes:
+        for size in AXES[axis]:
+            sizes = dict((name, AXES[name][0]) for name in AXES)
+            sizes[axis] = size
+            workdir = tempfile.mkdtemp(prefix='bench_sysstat')
+            try:
+                for stage, result in benchfixture(workdir, sizes['cpus'],
+                                                  sizes['disks'],
+                                                  sizes['interfaces'],
+                                                  args.repeat, rrdtool):
+                    result.update(axis=axis, size=size, stage=stage)
+                    records.append(result)
+            finally:
+                collect_sysstat.closeprocfiles()
+                collect_sysstat.closecolumnstores()
+                collect_sysstat.closerrdsessions()
+                shutil.rmtree(workdir, ignore_errors=True)
+    printresults(records, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'version': collect_sysstat.__version__,
+                       'python': sys.version.split()[0],
+                       'repeat': args.repeat, 'rrdtool': rrdtool,
+                       'results': records}, f, indent=1, sort_keys=True)
+
+if __name__ == "__main__":
+    sys.exit(main(createParser().parse_args()))
@@ -1,12 +1,32 @@
 #!/usr/bin/env python
 
 import os
+import io
+import errno
 import time
 import argparse
 import sys
+import signal
+import operator
+import subprocess
+import json
+import hashlib
+import math
+import mmap
+import threading
+import resource
+import socket
+import BaseHTTPServer
+import SocketServer
+import struct
+from array import array
+from itertools import izip
+from multiprocessing.pool import ThreadPool
 from pyrrd.rrd import DataSource, RRA, RRD
 from pyrrd.graph import DEF, CDEF, VDEF, LINE, AREA, GPRINT
 from pyrrd.graph import ColorAttributes, Graph
+from pyrrd.exceptions import ExternalCommandError
+from pyrrd.backend import external
 __version__ = 0.3
 __author__ = "Sergey Bulavintsev"
 
@@ -14,21 +34,63 @@ __author__ = "Sergey Bulavintsev"
 # Initialize basic params
 def initnamespace(namespace_args):
     # Modify parameters below
+    procroot = '/proc'                 # Where to read proc files from
+    sysroot = '/sys'                   # Where to read sysfs files from
     rrdpath = '/tmp/test.rrd'          # Path to rrd database file
+    backend = 'rrd'                    # Storage backend: rrd or column
+    sharded = False                    # One rrd file per subsystem/device
     interface_list = 'eth0'            # List of interfaces to obtain data
+    netsource = 'proc'                 # Read interfaces from proc or netlink
     block_dev_list = 'vda vdb vdb1'    # List of block dev to obtain data
     graphpath = '/var/www/dhcpflood/'  # Path to store graph files
     gwidth = 800                       # Width of output graphs
     gheight = 600                      # Height of output graphs
     gtime = 86400                       # Create graphs from gtime to NOW
+    gworkers = 4                       # Graphs rendered in parallel
+    interval = 60                      # Seconds between samples in daemon mode
+    flushcount = 1                     # Samples buffered before RRD update
+    flushtime = 300                    # Max seconds a sample stays buffered
+    selfstats = True                   # Store the collector's own overhead
+    burst = ''                         # Sampled between steps: cpu disk net
+    burstinterval = 0.1                # Seconds between burst samples
+    exportaddr = ''                    # Address of the exporter, '' for all
+    exportport = 9133                  # Port of the exporter
+    exportttl = 15                     # Max seconds a scrape result is reused
+    shipto = ''                        # host:port to ship samples to
+    shipformat = 'graphite'            # graphite or influx line protocol
+    shipbatch = 1                      # Samples per write in daemon mode
+    spoolmax = 16 * 1024 * 1024        # Max bytes spooled while unreachable
     namedict = {}
+    namedict['procroot'] = procroot
+    namedict['sysroot'] = sysroot
     namedict['interface'] = interface_list
+    namedict['netsource'] = netsource
     namedict['disk'] = block_dev_list
     namedict['rrdpath'] = rrdpath
+    namedict['backend'] = backend
+    namedict['cpustate'] = rrdpath + '.cpustate'
+    namedict['rrdindex'] = rrdpath + '.index'
+    namedict['sharded'] = sharded
     namedict['graphpath'] = graphpath
     namedict['gwidth'] = gwidth
     namedict['gheight'] = gheight
     namedict['gtime'] = gtime
+    namedict['gworkers'] = gworkers
+    namedict['interval'] = interval
+    namedict['flushcount'] = flushcount
+    namedict['flushtime'] = flushtime
+    namedict['selfstats'] = selfstats
+    namedict['burst'] = burst.split()
+    namedict['burstinterval'] = burstinterval
+    namedict['exportaddr'] = exportaddr
+    namedict['exportport'] = exportport
+    namedict['exportttl'] = exportttl
+    namedict['shipto'] = shipto
+    namedict['shipformat'] = shipformat
+    namedict['shipudp'] = False
+    namedict['shipbatch'] = shipbatch
+    namedict['spoolpath'] = rrdpath + '.spool'
+    namedict['spoolmax'] = spoolmax
     namedict['cpu'] = True
     namedict['net'] = True
     namedict['block'] = True
@@ -38,6 +100,47 @@ def initnamespace(namespace_args):
         namedict['graph'] = True
     else:
         namedict['graph'] = False
+    namedict['daemon'] = namespace_args.daemon
+    namedict['migrate'] = namespace_args.migrate
+    if namespace_args.net_source:
+        namedict['netsource'] = namespace_args.net_source
+    if namespace_args.proc_root:
+        namedict['procroot'] = namespace_args.proc_root.rstrip('/')
+    if namespace_args.sys_root:
+        namedict['sysroot'] = namespace_args.sys_root.rstrip('/')
+    if namespace_args.backend:
+        namedict['backend'] = namespace_args.backend
+    if namespace_args.sharded:
+        namedict['sharded'] = True
+    namedict['gonrequest'] = namespace_args.render_on_request
+    if namespace_args.graph_workers:
+        namedict['gworkers'] = namespace_args.graph_workers
+    if namespace_args.interval:
+        namedict['interval'] = namespace_args.interval
+    if namespace_args.flush_count:
+        namedict['flushcount'] = namespace_args.flush_count
+    if namespace_args.flush_time:
+        namedict['flushtime'] = namespace_args.flush_time
+    if namespace_args.burst:
+        namedict['burst'] = namespace_args.burst
+    if namespace_args.burst_interval:
+        namedict['burstinterval'] = namespace_args.burst_interval
+    namedict['export'] = namespace_args.export
+    if namespace_args.export_port:
+        namedict['exportport'] = namespace_args.export_port
+    if namespace_args.export_ttl:
+        namedict['exportttl'] = namespace_args.export_ttl
+    if namespace_args.ship:
+        namedict['shipto'] = namespace_args.ship
+    if namespace_args.ship_format:
+        namedict['shipformat'] = namespace_args.ship_format
+    if namespace_args.ship_udp:
+        namedict['shipudp'] = True
+    if namespace_args.ship_batch:
+        namedict['shipbatch'] = namespace_args.ship_batch
+    if namedict['shipto']:
+        host, _, port = namedict['shipto'].rpartition(':')
+        namedict['shipto'] = (host, int(port))
     return namedict
 
 
@@ -50,110 +153,360 @@ Please set all required variables in script body
                                     """)
     parser.add_argument("-g", "--graph", action="store_true",
                         help="Create graph")
+    parser.add_argument("-d", "--daemon", action="store_true",
+                        help="Stay resident and collect every interval")
+    parser.add_argument("-i", "--interval", type=int,
+                        help="Seconds between samples in daemon mode")
+    parser.add_argument("--flush-count", type=int,
+                        help="Samples buffered before one RRD update "
+                             "in daemon mode")
+    parser.add_argument("--flush-time", type=int,
+                        help="Max seconds a sample stays buffered "
+                             "in daemon mode")
+    parser.add_argument("--burst", nargs='+', choices=BURST_SOURCES,
+                        help="Sample these sources every burst interval "
+                             "in daemon mode and store min/max/mean/p99")
+    parser.add_argument("--burst-interval", type=float,
+                        help="Seconds between burst samples")
+    parser.add_argument("--graph-workers", type=int,
+                        help="Number of graphs rendered in parallel")
+    parser.add_argument("--render-on-request", action="store_true",
+                        help="Redraw only graphs viewed since last render")
+    parser.add_argument("--proc-root",
+                        help="Read proc files below this directory, "
+                             "e.g. /host/proc")
+    parser.add_argument("--sys-root",
+                        help="Read sysfs files below this directory, "
+                             "e.g. /host/sys")
+    parser.add_argument("--net-source", choices=['proc', 'netlink'],
+                        help="Read interface stats from /proc/net/dev or "
+                             "over rtnetlink")
+    parser.add_argument("-e", "--export", action="store_true",
+                        help="Serve collected values in OpenMetrics format "
+                             "over HTTP")
+    parser.add_argument("--export-port", type=int,
+                        help="Port of the OpenMetrics exporter")
+    parser.add_argument("--export-ttl", type=int,
+                        help="Max seconds a scrape result is reused "
+                             "when not in daemon mode")
+    parser.add_argument("--ship", metavar="HOST:PORT",
+                        help="Ship samples to a Graphite or Influx receiver")
+    parser.add_argument("--ship-format", choices=['graphite', 'influx'],
+                        help="Line protocol used by --ship")
+    parser.add_argument("--ship-udp", action="store_true",
+                        help="Ship over UDP instead of TCP")
+    parser.add_argument("--ship-batch", type=int,
+                        help="Samples per write in daemon mode")
+    parser.add_argument("--backend", choices=sorted(STORAGE_BACKENDS),
+                        help="Store samples in RRD files or in a "
+                             "memory-mapped column store")
+    parser.add_argument("--sharded", action="store_true",
+                        help="Store each subsystem/device in its own RRD")
+    parser.add_argument("--migrate", action="store_true",
+                        help="Convert counter DS of an existing RRD "
+                             "from GAUGE to DERIVE")
     return parser
 
 
+# Open /proc files kept between samples: path -> [FileIO, bytearray]
+PROC_FILES = {}
+# Files opened by the collector so far, see openfile()
+FILE_OPENS = {'total': 0}
+
+
+# Open a file, counting it for the collector overhead
+def openfile(path, mode='r'):
+    FILE_OPENS['total'] += 1
+    return open(path, mode)
+
+
+# Reread a /proc file through a cached fd into a reusable buffer
+def readprocfile(path, files=PROC_FILES):
+    """Return the current contents of a /proc file as a str.
+
+    The file is opened once and kept in files (PROC_FILES unless a
+    thread of its own reads through another dict). Later calls rewind
+    the fd and read into the same bytearray, so no open/close happens
+    per sample. The buffer is doubled and the read restarted when the
+    file no longer fits, to keep the whole snapshot consistent.
+    """
+    entry = files.get(path)
+    if entry is None:
+        FILE_OPENS['total'] += 1
+        entry = [io.FileIO(path, 'r'), bytearray(4096)]
+        files[path] = entry
+    procfile, buf = entry
+    while True:
+        procfile.seek(0)
+        view = memoryview(buf)
+        size = 0
+        while size < len(buf):
+            count = procfile.readinto(view[size:])
+            if not count:
+                break
+            size += count
+        if size < len(buf):
+            return str(buffer(buf, 0, size))
+        buf = bytearray(len(buf) * 2)
+        entry[1] = buf
+
+
+# Close all cached /proc files
+def closeprocfiles(files=PROC_FILES):
+    for procfile, buf in files.values():
+        procfile.close()
+    files.clear()
+
+
+# Stages of a collection cycle, timed into STAGE_TIMES. store includes
+# template, the time spent building RRD templates and value lists.
+SELF_STAGES = ('read_mem', 'read_loadavg', 'read_cpu', 'cpu_delta',
+               'read_net', 'read_block', 'template', 'store', 'ship', 'graph')
+# Seconds spent in each stage of the current cycle
+STAGE_TIMES = {}
+
+
+# Add the seconds since started to a stage of the current cycle
+def stagetime(stage, started):
+    STAGE_TIMES[stage] = STAGE_TIMES.get(stage, 0.0) + time.time() - started
+
+
+# Tick columns of a cpu line in /proc/stat, see proc(5)
+STAT_COLUMNS = ('user', 'nice', 'system', 'idle', 'iowait', 'irq',
+                'softirq', 'steal', 'guest', 'guest-nice')
+# guest and guest-nice are already accounted in user and nice, so only
+# the columns before them add up to the ticks a cpu has elapsed
+STAT_ELAPSED_COLUMNS = 8
+# Saved snapshots older than this many seconds are not used for deltas
+STATE_MAX_AGE = 3600
+
+
 # Read and parse cpu data from /proc/stat
-def read_cpu_data():
-    """Read data for all cpus from /proc/stat
-    A dict is created for each cpu, mapping column names to values.
-    See proc(5) for information about the columns in /proc/stat
+def read_cpu_data(procroot='/proc'):
+    """Read tick counters for all cpus from /proc/stat.
+
+    Returns (names, ticks): names is a tuple of cpu line names and ticks
+    a flat array with one row of len(STAT_COLUMNS) counters per cpu, in
+    the same order. Columns missing on older kernels are left at 0.
     """
-    STAT_COLUMNS = ['name', 'user', 'nice', 'system', 'idle',
-                    'iowait', 'irq', 'softirq', 'steal',
-                    'guest', 'guest-nice']
-    cpus = {}
-    with open('/proc/stat', 'r') as stat_fd:
-        for line in stat_fd:
-            if not line.startswith('cpu'):
-                continue
-            # Create a dict mapping the cpu column names to values.
-            cpu = dict(zip(STAT_COLUMNS, line.strip().split()))
-            cpus[cpu['name']] = cpu
-    return cpus
+    ncol = len(STAT_COLUMNS)
+    lines = readprocfile(procroot + '/stat').splitlines()
+    names = []
+    flat = []
+    # cpu lines come first in /proc/stat
+    for line in lines:
+        if not line.startswith('cpu'):
+            break
+        fields = line.split()
+        names.append(fields[0])
+        values = fields[1:ncol + 1]
+        flat.extend(values)
+        if len(values) < ncol:
+            flat.extend(['0'] * (ncol - len(values)))
+    return tuple(names), array('L', map(int, flat))
 
 
 # Calculate difference between cpu data
-def diff_cpu_data(prev, cur, ticks_elapsed):
-    """Calculate the different between two sets of cpu data.
-
-    A new set with updated data is returned.
+def diff_cpu_data(prev, cur):
+    """Calculate per-cpu utilization between two read_cpu_data() results.
+
+    Each cpu is scaled by the ticks it actually elapsed between the two
+    readings, so the result does not depend on how long the caller slept.
+    The deltas of all cpus are taken in one pass over the flat arrays.
+    Returns a dict per cpu mapping column names to percent; cpus that
+    elapsed no ticks are left out.
     """
     if not prev or not cur:
         return None
+    prev_names, prev_ticks = prev
+    names, ticks = cur
+    ncol = len(STAT_COLUMNS)
+    if prev_names != names:
+        # A cpu went offline or came online: match rows by name and
+        # skip cpus that are not included in both sets.
+        index = dict((name, row) for row, name in enumerate(prev_names))
+        rows = [(row, index[name]) for row, name in enumerate(names)
+                if name in index]
+        names = tuple(names[row] for row, _ in rows)
+        ticks = [value for row, _ in rows
+                 for value in ticks[row * ncol:(row + 1) * ncol]]
+        prev_ticks = [value for _, row in rows
+                      for value in prev_ticks[row * ncol:(row + 1) * ncol]]
+    delta = map(operator.sub, ticks, prev_ticks)
     diff_cpus = {}
-    for cpu_name, prev_cpu in prev.iteritems():
-        # If a cpu is not included in both sets, skip it.
-        if cpu_name not in cur:
+    for row, name in enumerate(names):
+        start = row * ncol
+        elapsed = sum(delta[start:start + STAT_ELAPSED_COLUMNS])
+        if elapsed <= 0:
             continue
-        cur_cpu = cur[cpu_name]
-        diff_cpu = {'name': cpu_name}
-        diff_cpus[cpu_name] = diff_cpu
-        for column_name in prev_cpu:
-            if column_name == 'name' or column_name not in cur_cpu:
-                continue
-            try:
-                # This calculates the amount of time spent
-                # doing a cpu usage type, in percent.
-                # The diff value (cur-prev) is the amount of
-                # ticks spent on this task since the last
-                # reading, divided by the total amount of ticks
-                # elapsed.
-                diff_cpu[column_name] = float(int(cur_cpu[column_name]) - int(prev_cpu[column_name])) / ticks_elapsed * 100
-            except ValueError:
-                pass
+        scale = 100.0 / elapsed
+        diff_cpu = dict(izip(STAT_COLUMNS, [d * scale for d in
+                                            delta[start:start + ncol]]))
+        diff_cpu['name'] = name
+        diff_cpus[name] = diff_cpu
     return diff_cpus
 
 
+# Memory fields stored from /proc/meminfo
+DS_MEM = frozenset(['MemFree', 'MemTotal', 'SwapFree', 'SwapTotal',
+                    'Active(anon)', 'Active(file)', 'Active', 'Inactive(anon)',
+                    'Inactive(file)', 'Inactive', 'Slab', 'Buffers', 'Cached',
+                    'Dirty', 'HugePages_Free', 'HugePages_Total',
+                    'AnonHugePages', 'AnonPages'])
+
+# Offset and 'Name:' prefix of each wanted /proc/meminfo line, learned on
+# first read, by meminfo path
+MEMINFO_LAYOUT = {}
+
+
 # Read and parse memory stats from /proc/meminfo
-def readMemValues():
-    ds_mem = ['MemFree', 'MemTotal', 'SwapFree', 'SwapTotal',
-              'Active(anon)', 'Active(file)', 'Active', 'Inactive(anon)',
-              'Inactive(file)', 'Inactive', 'Slab', 'Buffers', 'Cached',
-              'Dirty', 'HugePages_Free', 'HugePages_Total', 'AnonHugePages',
-              'AnonPages']
+def readMemValues(procroot='/proc'):
+    """Return the DS_MEM fields of /proc/meminfo in kB.
+
+    The first call scans every line and remembers at which offset each
+    wanted field starts in MEMINFO_LAYOUT. Later calls only slice and
+    decode those lines, and fall back to a full scan if an offset no
+    longer starts the expected field (a value grew wider or the kernel
+    layout changed).
+    """
+    path = procroot + '/meminfo'
+    data = readprocfile(path)
+    layout = MEMINFO_LAYOUT.setdefault(path, {})
     memDict = {}
-    with open('/proc/meminfo', 'r') as f:
-        memory_data = f.readlines()
-    for line in memory_data:
+    if layout:
+        for key, (offset, prefix) in layout.iteritems():
+            if not data.startswith(prefix, offset):
+                break
+            end = data.find('\n', offset)
+            if end < 0:
+                end = len(data)
+            x = data[offset + len(prefix):end].split()
+            if not x:
+                break
+            memDict[key] = int(x[0])
+        else:
+            return memDict
+        layout.clear()
+    values = {}
+    offset = 0
+    for line in data.split('\n'):
         x = line.split()
-        key = x[0][:-1]
-        data = int(x[1])
-        if key in ds_mem:
-            memDict[key] = data
+        if len(x) > 1 and x[0][:-1] in DS_MEM:
+            values[x[0][:-1]] = int(x[1])
+            layout[x[0][:-1]] = (offset, x[0])
+        offset += len(line) + 1
+    # Fill memDict in layout order so later samples iterate the same way
+    memDict = {}
+    for key in layout:
+        memDict[key] = values[key]
     return memDict
 
 
 # Read average cpu load for 1,5,15 min from /proc/loadavg
-def readLoadAvgValues():
-    with open('/proc/loadavg', 'r') as f:
-        loadavg = f.readline()
-    loadvalues = {"loadavg1min": loadavg.split()[0],
-                  "loadavg5min": loadavg.split()[1],
-                  "loadavg15min": loadavg.split()[2]}
+def readLoadAvgValues(procroot='/proc'):
+    loadavg = readprocfile(procroot + '/loadavg').split()
+    loadvalues = {"loadavg1min": loadavg[0],
+                  "loadavg5min": loadavg[1],
+                  "loadavg15min": loadavg[2]}
     return loadvalues
 
 
+# Seconds since boot, used to timestamp saved cpu snapshots
+def readUptime(procroot='/proc'):
+    return float(readprocfile(procroot + '/uptime').split()[0])
+
+
+# Load the snapshots saved by a previous run into state
+def loadstate(path, state, procroot='/proc'):
+    """Put the /proc/stat snapshot, collector overhead and /proc/diskstats
+    snapshot saved in path into state['cpu'], state['self'] and
+    state['block'].
+
+    The file is ignored if it is missing or malformed, was written before
+    the last reboot, or is older than STATE_MAX_AGE seconds.
+    """
+    try:
+        with openfile(path, 'r') as f:
+            saved_uptime = float(f.readline())
+            names = tuple(f.readline().split())
+            ticks = array('L', map(int, f.readline().split()))
+            selfvalues = json.loads(f.readline() or '{}')
+            block = json.loads(f.readline() or 'null')
+    except (IOError, ValueError):
+        return
+    age = readUptime(procroot) - saved_uptime
+    if not 0 < age <= STATE_MAX_AGE:
+        return
+    if names and len(ticks) == len(names) * len(STAT_COLUMNS):
+        state['cpu'] = (names, ticks)
+    if selfvalues:
+        state['self'] = selfvalues
+    if block:
+        state['block'] = (block['time'], block['devices'])
+
+
+# Save the snapshots in state so the next run needs no sleep
+def savestate(path, state, procroot='/proc'):
+    """Write state['cpu'], state['self'] and state['block'] to path in
+    the format read by loadstate().
+    """
+    if not state.get('cpu') and not state.get('block'):
+        return
+    names, ticks = state.get('cpu') or ((), ())
+    block = None
+    if state.get('block'):
+        block = {'time': state['block'][0], 'devices': state['block'][1]}
+    tmppath = path + '.tmp'
+    try:
+        with openfile(tmppath, 'w') as f:
+            f.write('%r\n%s\n%s\n%s\n%s\n' % (readUptime(procroot),
+                                                ' '.join(names),
+                                                ' '.join(map(str, ticks)),
+                                                json.dumps(state.get('self')),
+                                                json.dumps(block)))
+        os.rename(tmppath, path)
+    except (IOError, OSError):
+        print "Error: cannot save state to %s" % path
+
+
 # Count difference between cpu ticks
-def readCpuValues():
+def readCpuValues(state=None, procroot='/proc'):
+    """Return per-cpu utilization in percent.
+
+    If state holds a snapshot from a previous call or run, the delta is
+    taken against it and no sleep is needed. Otherwise two readings
+    SLEEP_TIME seconds apart are used. If no cpu elapsed a tick between
+    the readings (a static or replayed procroot), the result of the
+    previous call kept in state is returned again, or NaN for every
+    column. The latest snapshot is left in state['cpu'].
+    """
     SLEEP_TIME = 2
-    ticks_elapsed = os.sysconf(os.sysconf_names['SC_CLK_TCK']) * SLEEP_TIME
-    cur_cpu_data = None
-    cpu_data_diff = False
-    while not cpu_data_diff:
-        prev_cpu_data = cur_cpu_data
-        cur_cpu_data = read_cpu_data()
-        cpu_data_diff = diff_cpu_data(prev_cpu_data, cur_cpu_data, ticks_elapsed)
-        if cpu_data_diff:
-            return cpu_data_diff
+    if state is None:
+        state = {}
+    prev_cpu_data = state.get('cpu')
+    if not prev_cpu_data:
+        prev_cpu_data = read_cpu_data(procroot)
         time.sleep(SLEEP_TIME)
+    cur_cpu_data = read_cpu_data(procroot)
+    state['cpu'] = cur_cpu_data
+    started = time.time()
+    cpu_data_diff = diff_cpu_data(prev_cpu_data, cur_cpu_data)
+    stagetime('cpu_delta', started)
+    if cpu_data_diff:
+        state['cpuvalues'] = cpu_data_diff
+        return cpu_data_diff
+    if state.get('cpuvalues'):
+        return state['cpuvalues']
+    for name in cur_cpu_data[0]:
+        cpu_data_diff[name] = dict.fromkeys(STAT_COLUMNS, float('nan'))
+        cpu_data_diff[name]['name'] = name
+    return cpu_data_diff
 
 
 # Read and parse network devices stats from /proc/net/dev
-def readNetValues(ninterfaces):
+def readNetValues(ninterfaces, procroot='/proc'):
     ninterfaces = ninterfaces.split(' ')
-    with open('/proc/net/dev', 'r') as f:
-        net_data = f.readlines()
+    net_data = readprocfile(procroot + '/net/dev').splitlines()
     columnLine = net_data[1]
     _, receiveCols, transmitCols = columnLine.split("|")
     receiveCols = map(lambda a: "recv_"+a, receiveCols.split())
@@ -174,29 +527,283 @@ def readNetValues(ninterfaces):
     return interfaces
 
 
+# rtnetlink constants, see linux/netlink.h, linux/rtnetlink.h and
+# linux/if_link.h
+NETLINK_ROUTE = 0
+RTMGRP_LINK = 1
+NLMSG_ERROR = 2
+NLMSG_DONE = 3
+NLM_F_REQUEST = 1
+NLM_F_MULTI = 2
+NLM_F_DUMP = 0x300
+RTM_NEWLINK = 16
+RTM_GETLINK = 18
+IFLA_IFNAME = 3
+IFLA_STATS = 7
+IFLA_STATS64 = 23
+NLMSG_HEADER = struct.Struct('=IHHII')
+IFINFOMSG = struct.Struct('=BxHiII')
+RTATTR = struct.Struct('=HH')
+# Leading fields of struct rtnl_link_stats64 (u64) and rtnl_link_stats (u32)
+LINK_STATS = ('rx_packets', 'tx_packets', 'rx_bytes', 'tx_bytes',
+              'rx_errors', 'tx_errors', 'rx_dropped', 'tx_dropped',
+              'multicast', 'collisions', 'rx_length_errors',
+              'rx_over_errors', 'rx_crc_errors', 'rx_frame_errors',
+              'rx_fifo_errors', 'rx_missed_errors', 'tx_aborted_errors',
+              'tx_carrier_errors', 'tx_fifo_errors', 'tx_heartbeat_errors',
+              'tx_window_errors', 'rx_compressed', 'tx_compressed')
+LINK_STATS64 = struct.Struct('=%dQ' % len(LINK_STATS))
+LINK_STATS32 = struct.Struct('=%dI' % len(LINK_STATS))
+# Links asked for in one send, so the answers fit the socket buffer
+NETLINK_BATCH = 64
+NETLINK_BUFFER = 65536
+NETLINK_TIMEOUT = 5
+
+# rtnetlink sockets and the name -> ifindex cache of readNetlinkValues()
+NETLINK = {}
+
+
+# Open the request socket and the link event socket
+def opennetlink():
+    sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, NETLINK_ROUTE)
+    sock.bind((0, 0))
+    sock.settimeout(NETLINK_TIMEOUT)
+    events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                           NETLINK_ROUTE)
+    events.bind((0, RTMGRP_LINK))
+    events.setblocking(False)
+    NETLINK.update(sock=sock, events=events, seq=0, index=None)
+
+
+# Close the rtnetlink sockets
+def closenetlink():
+    if NETLINK:
+        NETLINK['sock'].close()
+        NETLINK['events'].close()
+    NETLINK.clear()
+
+
+# Drain link events, return True if any link was added, removed or changed
+def linkchanged():
+    changed = False
+    while True:
+        try:
+            NETLINK['events'].recv(NETLINK_BUFFER)
+        except socket.error, error:
+            if error.errno == errno.ENOBUFS:
+                # Events were lost, which is a change as well
+                changed = True
+                continue
+            if error.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return changed
+            raise
+        changed = True
+
+
+# Build an RTM_GETLINK request for one ifindex, or a dump of all links
+def linkrequest(index=0):
+    NETLINK['seq'] += 1
+    flags = NLM_F_REQUEST if index else NLM_F_REQUEST | NLM_F_DUMP
+    return NETLINK['seq'], NLMSG_HEADER.pack(
+        NLMSG_HEADER.size + IFINFOMSG.size, RTM_GETLINK, flags,
+        NETLINK['seq'], 0) + IFINFOMSG.pack(0, 0, index, 0, 0)
+
+
+# Return ifindex, name and stats dict of an RTM_NEWLINK payload
+def parselink(payload):
+    index = IFINFOMSG.unpack_from(payload)[2]
+    name = None
+    stats = None
+    offset = IFINFOMSG.size
+    while offset + RTATTR.size <= len(payload):
+        length, attrtype = RTATTR.unpack_from(payload, offset)
+        if length < RTATTR.size:
+            break
+        value = payload[offset + RTATTR.size:offset + length]
+        attrtype &= 0x3fff
+        if attrtype == IFLA_IFNAME:
+            name = value.rstrip('\0')
+        elif attrtype == IFLA_STATS64 and len(value) >= LINK_STATS64.size:
+            stats = dict(izip(LINK_STATS, LINK_STATS64.unpack_from(value)))
+        elif attrtype == IFLA_STATS and stats is None and \
+                len(value) >= LINK_STATS32.size:
+            stats = dict(izip(LINK_STATS, LINK_STATS32.unpack_from(value)))
+        offset += (length + 3) & ~3
+    return index, name, stats
+
+
+# Send rtnetlink requests and collect the links in their answers
+def netlinkquery(requests):
+    """requests is a list of (seq, message) from linkrequest().
+
+    Returns (links, failed): links maps ifindex to (name, stats) and
+    failed is the number of requests answered with an error (a link that
+    went away).
+    """
+    sock = NETLINK['sock']
+    sock.send(''.join(message for seq, message in requests))
+    pending = set(seq for seq, message in requests)
+    links = {}
+    failed = 0
+    while pending:
+        data = sock.recv(NETLINK_BUFFER)
+        offset = 0
+        while offset + NLMSG_HEADER.size <= len(data):
+            length, msgtype, flags, seq, pid = \
+                NLMSG_HEADER.unpack_from(data, offset)
+            if length < NLMSG_HEADER.size:
+                break
+            payload = data[offset + NLMSG_HEADER.size:offset + length]
+            offset += (length + 3) & ~3
+            if seq not in pending:
+                continue
+            if msgtype == RTM_NEWLINK:
+                index, name, stats = parselink(payload)
+                links[index] = (name, stats)
+                if not flags & NLM_F_MULTI:
+                    pending.discard(seq)
+            elif msgtype == NLMSG_DONE:
+                pending.discard(seq)
+            elif msgtype == NLMSG_ERROR:
+                pending.discard(seq)
+                if struct.unpack_from('=i', payload)[0]:
+                    failed += 1
+    return links, failed
+
+
+# Map link stats to the /proc/net/dev fields, the way the kernel prints them
+def linkvalues(stats):
+    values = {'recv_bytes': stats['rx_bytes'],
+              'recv_packets': stats['rx_packets'],
+              'recv_errs': stats['rx_errors'],
+              'recv_drop': stats['rx_dropped'] + stats['rx_missed_errors'],
+              'recv_fifo': stats['rx_fifo_errors'],
+              'recv_frame': stats['rx_length_errors'] +
+              stats['rx_over_errors'] + stats['rx_crc_errors'] +
+              stats['rx_frame_errors'],
+              'recv_compressed': stats['rx_compressed'],
+              'recv_multicast': stats['multicast'],
+              'trans_bytes': stats['tx_bytes'],
+              'trans_packets': stats['tx_packets'],
+              'trans_errs': stats['tx_errors'],
+              'trans_drop': stats['tx_dropped'],
+              'trans_fifo': stats['tx_fifo_errors'],
+              'trans_colls': stats['collisions'],
+              'trans_carrier': stats['tx_carrier_errors'] +
+              stats['tx_aborted_errors'] + stats['tx_window_errors'] +
+              stats['tx_heartbeat_errors'],
+              'trans_compressed': stats['tx_compressed']}
+    for key in values:
+        values[key] = str(values[key])
+    return values
+
+
+# Read network device stats over rtnetlink instead of /proc/net/dev
+def readNetlinkValues(ninterfaces):
+    """Return the same dict as readNetValues(), from 64 bit link stats.
+
+    With interface names configured, only those links are asked for by
+    ifindex, in batches of NETLINK_BATCH requests. The name -> ifindex
+    cache is built from one dump of all links and built again after a
+    link event (added, removed, renamed) or a request for a link that is
+    gone. Without names every link but lo is dumped each time. Links of
+    the network namespace of the collector are read, whatever procroot
+    is.
+    """
+    if not NETLINK:
+        opennetlink()
+    wanted = set(name.upper() for name in ninterfaces.split(' ') if name)
+    if linkchanged():
+        NETLINK['index'] = None
+    if not wanted or NETLINK['index'] is None:
+        links, failed = netlinkquery([linkrequest()])
+        NETLINK['index'] = dict((name.upper(), index)
+                                for index, (name, stats) in links.iteritems())
+    else:
+        indexes = [NETLINK['index'][name] for name in wanted
+                   if name in NETLINK['index']]
+        links = {}
+        for start in xrange(0, len(indexes), NETLINK_BATCH):
+            found, failed = netlinkquery(
+                [linkrequest(index)
+                 for index in indexes[start:start + NETLINK_BATCH]])
+            links.update(found)
+            if failed:
+                NETLINK['index'] = None
+    interfaces = {}
+    for name, stats in links.itervalues():
+        if stats is None:
+            continue
+        if wanted:
+            if name.upper() in wanted:
+                interfaces[name] = linkvalues(stats)
+        elif 'lo' not in name:
+            interfaces[name] = linkvalues(stats)
+    return interfaces
+
+
+# Columns of /proc/diskstats, ref: https://www.kernel.org/doc/Documentation/
+# iostats.txt. Disk lines have the first DISKSTATS_DISK, 18 since Linux 4.18
+# (discard) and 20 since 5.5 (flush). sysfs stat files have the same
+# columns without m, mm and dev.
+DISKSTATS_COLUMNS = ('m', 'mm', 'dev', 'reads', 'rd_mrg', 'rd_sectors',
+                     'ms_reading', 'writes', 'wr_mrg', 'wr_sectors',
+                     'ms_writing', 'cur_ios', 'ms_doing_io', 'ms_weighted',
+                     'discards', 'dc_mrg', 'dc_sectors', 'ms_discard',
+                     'flushes', 'ms_flush')
+DISKSTATS_DISK = 14
+# Columns of partition lines on old kernels
+DISKSTATS_PARTITION = ('m', 'mm', 'dev', 'reads', 'rd_sectors', 'writes',
+                       'wr_sectors')
+
+
+# Read block device data, derive rates against the previous reading
+def readBlockValues(disks, procroot='/proc', state=None, sysroot=None):
+    """Return the /proc/diskstats fields of the wanted devices.
+
+    With sysroot and device names given, only the sysfs stat files of
+    those devices are read, see readSysBlockValues(); otherwise all of
+    /proc/diskstats is parsed. With state, the iostat style rates of
+    diskrates() since the snapshot kept in state['block'] are added to
+    every device that was in it, and the new snapshot is left there.
+    """
+    result = None
+    names = [name for name in disks.split(' ') if name]
+    if sysroot and names:
+        result = readSysBlockValues(names, sysroot)
+    if result is None:
+        result = readDiskstats(disks, procroot)
+    if state is not None:
+        now = time.time()
+        prevtime, prevdevices = state.get('block') or (None, {})
+        state['block'] = (now, dict((name, dict(data))
+                                    for name, data in result.iteritems()))
+        for name, data in result.iteritems():
+            if prevtime is not None and name in prevdevices:
+                rates = diskrates(prevdevices[name], data, now - prevtime)
+                if rates:
+                    data.update(rates)
+    return result
+
+
 # Read and parse block device data from /proc/diskstats
-def readBlockValues(disks):
-    file_path = '/proc/diskstats'
+def readDiskstats(disks, procroot='/proc'):
+    """Columns added by kernels newer than 5.5 are ignored."""
+    file_path = procroot + '/diskstats'
     result = {}
     dev = None
     disks = disks.split(' ')
 
-    # ref: http://lxr.osuosl.org/source/Documentation/iostats.txt
-    columns_disk = ['m', 'mm', 'dev', 'reads', 'rd_mrg', 'rd_sectors',
-                    'ms_reading', 'writes', 'wr_mrg', 'wr_sectors',
-                    'ms_writing', 'cur_ios', 'ms_doing_io', 'ms_weighted']
-
-    columns_partition = ['m', 'mm', 'dev', 'reads', 'rd_sectors', 'writes', 'wr_sectors']
-
-    lines = open(file_path, 'r').readlines()
+    lines = readprocfile(file_path).splitlines()
     for line in lines:
         if line == '':
             continue
         split = line.split()
-        if len(split) == len(columns_disk):
-            columns = columns_disk
-        elif len(split) == len(columns_partition):
-            columns = columns_partition
+        if len(split) >= DISKSTATS_DISK:
+            # zip() keeps only the columns this kernel has
+            columns = DISKSTATS_COLUMNS
+        elif len(split) == len(DISKSTATS_PARTITION):
+            columns = DISKSTATS_PARTITION
         else:
             # No match
             continue
@@ -216,6 +823,141 @@ def readBlockValues(disks):
     return result
 
 
+# [devices, <sysroot>/block mtime, samples since the lookup] by (sysroot,
+# device names); devices maps a device to its sysfs stat file, major and
+# minor, or is False if sysroot has no block devices
+SYS_BLOCK = {}
+# Samples after which configured devices still missing are looked up again
+SYS_BLOCK_RESCAN = 10
+
+
+# Find the sysfs directories of the named block devices
+def findsysblock(names, sysroot):
+    """Return {dev: (stat path, major, minor)}.
+
+    Disks are <sysroot>/block/<dev>, partitions <sysroot>/block/<disk>/
+    <dev>. Names match case-insensitively, like in /proc/diskstats. Only
+    disks whose name starts a wanted name that is still missing are
+    searched for partitions. Devices that do not exist are left out.
+    """
+    base = sysroot + '/block'
+    wanted = dict((name.upper(), name) for name in names)
+    paths = {}
+    disks = os.listdir(base)
+    for disk in disks:
+        if disk.upper() in wanted:
+            paths[disk] = '%s/%s' % (base, disk)
+    missing = set(wanted) - set(dev.upper() for dev in paths)
+    for disk in disks:
+        if not any(name.startswith(disk.upper()) for name in missing):
+            continue
+        for entry in os.listdir('%s/%s' % (base, disk)):
+            if entry.upper() in missing and \
+                    os.path.isfile('%s/%s/%s/stat' % (base, disk, entry)):
+                paths[entry] = '%s/%s/%s' % (base, disk, entry)
+                missing.discard(entry.upper())
+    devices = {}
+    for dev, path in paths.iteritems():
+        with openfile(path + '/dev', 'r') as f:
+            major, minor = f.read().strip().split(':')
+        devices[dev] = (path + '/stat', int(major), int(minor))
+    return devices
+
+
+# Read the named block devices from their sysfs stat files
+def readSysBlockValues(names, sysroot='/sys'):
+    """Return the same dict as readDiskstats() for the devices in names,
+    or None if sysroot has no block devices.
+
+    The devices are looked up once by findsysblock() and their stat
+    files stay open in PROC_FILES, so a sample costs one read per wanted
+    device whatever the number of devices on the host. While some of
+    names are missing, they are looked up again when <sysroot>/block
+    changes or every SYS_BLOCK_RESCAN samples, so hot-plugged devices
+    are picked up. A device whose file can no longer be read is skipped,
+    and the devices are looked up again on the next call.
+    """
+    key = (sysroot, ' '.join(names))
+    lookup = SYS_BLOCK.get(key)
+    if lookup and lookup[0] is not False and \
+            len(lookup[0]) < len(set(names)):
+        lookup[2] += 1
+        try:
+            changed = os.stat(sysroot + '/block').st_mtime != lookup[1]
+        except OSError:
+            changed = True
+        if changed or lookup[2] >= SYS_BLOCK_RESCAN:
+            lookup = None
+    if lookup is None:
+        try:
+            mtime = os.stat(sysroot + '/block').st_mtime
+            lookup = [findsysblock(names, sysroot), mtime, 0]
+        except (IOError, OSError, ValueError):
+            lookup = [False, None, 0]
+        SYS_BLOCK[key] = lookup
+    devices = lookup[0]
+    if devices is False:
+        return None
+    result = {}
+    for dev, (path, major, minor) in devices.iteritems():
+        try:
+            split = readprocfile(path).split()
+        except (IOError, OSError):
+            entry = PROC_FILES.pop(path, None)
+            if entry:
+                entry[0].close()
+            SYS_BLOCK.pop(key, None)
+            continue
+        if len(split) >= DISKSTATS_DISK - 3:
+            columns = DISKSTATS_COLUMNS[3:]
+        else:
+            columns = DISKSTATS_PARTITION[3:]
+        data = dict(izip(columns, map(int, split)))
+        data['m'] = major
+        data['mm'] = minor
+        data['dev'] = dev
+        result[dev] = data
+    return result
+
+
+# iostat -x style metrics derived from two /proc/diskstats readings
+DS_IOSTAT = ('r_s', 'w_s', 'rkB_s', 'wkB_s', 'r_await', 'w_await',
+             'aqu_sz', 'util')
+
+
+# Compute the DS_IOSTAT metrics of a device between two readings
+def diskrates(prev, cur, seconds):
+    """Return reads and writes per second (r_s, w_s), kB read and
+    written per second (rkB_s, wkB_s) and, for the disk layout, average
+    ms per read and write including queueing (r_await, w_await), average
+    requests in flight (aqu_sz) and percent of time busy (util).
+
+    Returns None if a counter went backwards (wrap or device reset).
+    """
+    if seconds <= 0:
+        return None
+    delta = {}
+    for key in ('reads', 'writes', 'rd_sectors', 'wr_sectors',
+                'ms_reading', 'ms_writing', 'ms_doing_io', 'ms_weighted'):
+        if key in cur and key in prev:
+            delta[key] = cur[key] - prev[key]
+            if delta[key] < 0:
+                return None
+    # diskstats sectors are 512 bytes whatever the device uses
+    rates = {'r_s': delta['reads'] / seconds,
+             'w_s': delta['writes'] / seconds,
+             'rkB_s': delta['rd_sectors'] / 2.0 / seconds,
+             'wkB_s': delta['wr_sectors'] / 2.0 / seconds}
+    if 'ms_doing_io' in delta:
+        rates['r_await'] = float(delta['ms_reading']) / delta['reads'] \
+            if delta['reads'] else 0.0
+        rates['w_await'] = float(delta['ms_writing']) / delta['writes'] \
+            if delta['writes'] else 0.0
+        rates['aqu_sz'] = delta['ms_weighted'] / (seconds * 1000)
+        rates['util'] = min(delta['ms_doing_io'] / (seconds * 10), 100.0)
+    return rates
+
+
 # Print gathered block devices values
 def printblockvalues(blockvalues):
     """ blockvalues is a dict
@@ -302,60 +1044,232 @@ def printmemvalues(memvalues):
         print "%s:%s" % (key, value)
 
 
+# Network interface fields stored in RRD
+DS_NET = ('recv_bytes', 'trans_bytes', 'recv_packets', 'trans_packets',
+          'recv_errs', 'trans_errs')
+
+# RRD data source type of collected network and block device fields.
+# Cumulative kernel counters are DERIVE with minval 0, so a counter wrap or
+# a reset after reboot gives one unknown sample instead of a bogus rate.
+# Fields not listed here are instantaneous values stored as GAUGE.
+DS_TYPES = {'recv_bytes': 'DERIVE', 'trans_bytes': 'DERIVE',
+            'recv_packets': 'DERIVE', 'trans_packets': 'DERIVE',
+            'recv_errs': 'DERIVE', 'trans_errs': 'DERIVE',
+            'reads': 'DERIVE', 'rd_mrg': 'DERIVE', 'rd_sectors': 'DERIVE',
+            'ms_reading': 'DERIVE', 'writes': 'DERIVE', 'wr_mrg': 'DERIVE',
+            'wr_sectors': 'DERIVE', 'ms_writing': 'DERIVE',
+            'ms_doing_io': 'DERIVE', 'ms_weighted': 'DERIVE',
+            'discards': 'DERIVE', 'dc_mrg': 'DERIVE', 'dc_sectors': 'DERIVE',
+            'ms_discard': 'DERIVE', 'flushes': 'DERIVE', 'ms_flush': 'DERIVE'}
+# Longest DS name rrdtool accepts
+DS_NAME_MAX = 19
+# Long DS names -> the short names they are stored under, see dsname()
+DS_NAME_SHORT = {}
+
+
+# Return RRD data source type for a collected field
+def dstype(field):
+    return DS_TYPES.get(field, 'GAUGE')
+
+
+# Return the name a DS is stored under, shortened if rrdtool rejects it
+def dsname(name):
+    """rrdtool create rejects the whole DS list if one name is longer
+    than DS_NAME_MAX. Such names (e.g. of a long interface name) are
+    stored as their first characters and 6 hex digits of their md5, the
+    same on every run and host. The mapping is kept in DS_NAME_SHORT.
+    """
+    if len(name) <= DS_NAME_MAX:
+        return name
+    short = DS_NAME_SHORT.get(name)
+    if short is None:
+        short = '%s_%s' % (name[:DS_NAME_MAX - 7],
+                           hashlib.md5(name).hexdigest()[:6])
+        DS_NAME_SHORT[name] = short
+    return short
+
+
 # Create list of DS based on cli options and gathered data
 def createDSList(namespace, memvalues, netvalues, blockvalues,
-                 cpuvalues, loadavgvalues):
+                 cpuvalues, loadavgvalues, selfvalues=None):
     dataSources = []
     if namespace['memory']:
         for ds in memvalues:
-            dataSource = DataSource(dsName=ds.replace('(', '_').strip(')'),
-                                    dsType='GAUGE',
-                                    heartbeat=180, minval=0)
+            dataSource = DataSource(
+                dsName=dsname(ds.replace('(', '_').strip(')')),
+                dsType='GAUGE', heartbeat=180, minval=0)
             dataSources.append(dataSource)
     if namespace['cpu']:
         ds_loadavg = ['loadavg1min', 'loadavg5min', 'loadavg15min']
         ds_cpu = ['system', 'user', 'idle', 'iowait', 'irq', 'softirq',
                   'nice', 'steal', 'guest']
-        for ds in ds_loadavg:
-            dataSource = DataSource(dsName=ds, dsType='GAUGE',
-                                    heartbeat=180, minval=0, maxval=100)
-            dataSources.append(dataSource)
+        if loadavgvalues:
+            for ds in ds_loadavg:
+                dataSource = DataSource(dsName=ds, dsType='GAUGE',
+                                        heartbeat=180, minval=0, maxval=100)
+                dataSources.append(dataSource)
         for cpu in cpuvalues:
-            for ds in ds_cpu:
-                dataSource = DataSource(dsName=cpu+'_'+ds, dsType='GAUGE',
-                                        heartbeat=180, minval=0)
+            for ds in ds_cpu + sorted(BURST_KEYS.intersection(
+                    cpuvalues[cpu])):
+                dataSource = DataSource(dsName=dsname(cpu+'_'+ds),
+                                        dsType='GAUGE', heartbeat=180,
+                                        minval=0)
                 dataSources.append(dataSource)
     if namespace['block']:
         for blockdevice, blockdata in blockvalues.items():
             for ds in blockdata.keys():
                 if ds != 'dev':
-                    dataSource = DataSource(dsName=blockdevice+'_'+ds,
-                                            dsType='GAUGE', heartbeat=180,
+                    dataSource = DataSource(dsName=dsname(blockdevice+'_'+ds),
+                                            dsType=dstype(ds), heartbeat=180,
                                             minval=0)
                     dataSources.append(dataSource)
     if namespace['net']:
-        ds_net = ['recv_bytes', 'trans_bytes', 'recv_packets', 'trans_packets',
-                  'recv_errs', 'trans_errs']
         for interface in netvalues:
-            for ds in ds_net:
-                dataSource = DataSource(dsName=interface+'_'+ds,
-                                        dsType='GAUGE', heartbeat=180,
+            for ds in DS_NET + tuple(sorted(BURST_KEYS.intersection(
+                    netvalues[interface]))):
+                dataSource = DataSource(dsName=dsname(interface+'_'+ds),
+                                        dsType=dstype(ds), heartbeat=180,
                                         minval=0)
                 dataSources.append(dataSource)
+    if selfvalues:
+        for ds in sorted(selfvalues):
+            dataSource = DataSource(dsName=dsname('self_'+ds), dsType='GAUGE',
+                                    heartbeat=180, minval=0)
+            dataSources.append(dataSource)
     return dataSources
 
 
+# Idle rrdtool sessions, shared by every rrdtool command of the process
+RRD_SESSIONS = []
+RRD_SESSIONS_LOCK = threading.Lock()
+# cpu seconds used so far by running sessions, as they report it
+RRD_SESSION_CPU = {'total': 0.0}
+
+
+# Start an rrdtool process reading commands from its stdin
+def openrrdsession():
+    process = subprocess.Popen(['rrdtool', '-'], stdin=subprocess.PIPE,
+                               stdout=subprocess.PIPE, close_fds=True)
+    return {'process': process, 'cpu': 0.0}
+
+
+# Stop one rrdtool session and wait for its process
+def closerrdsession(session):
+    process = session['process']
+    try:
+        process.stdin.close()
+    except IOError:
+        pass
+    process.wait()
+    process.stdout.close()
+    # Its cpu time is part of RUSAGE_CHILDREN from now on
+    with RRD_SESSIONS_LOCK:
+        RRD_SESSION_CPU['total'] -= session['cpu']
+
+
+# Stop every idle rrdtool session
+def closerrdsessions():
+    with RRD_SESSIONS_LOCK:
+        sessions = RRD_SESSIONS[:]
+        del RRD_SESSIONS[:]
+    for session in sessions:
+        closerrdsession(session)
+
+
+# Quote one argument for an rrdtool session command line
+def rrdquote(arg):
+    """rrdtool splits session lines at blanks and honours ' and " like a
+    shell without backslash escapes. Arguments already quoted by pyrrd
+    (legends) are passed as they are.
+    """
+    if isinstance(arg, unicode):
+        arg = arg.encode('utf-8')
+    arg = str(arg)
+    if '\n' in arg:
+        raise ExternalCommandError("newline in rrdtool argument %r" % arg)
+    if not arg:
+        return '""'
+    if (' ' in arg or '\t' in arg) and '"' not in arg and "'" not in arg:
+        return '"%s"' % arg
+    return arg
+
+
+# Run one rrdtool command through a session
+def rrdcommand(command, filename, args=()):
+    """Return the output lines of rrdtool command for filename.
+
+    Commands are written to a long-lived `rrdtool -` process instead of
+    starting rrdtool for every call. A session is taken out of
+    RRD_SESSIONS until its answer (OK or ERROR line) is read, so
+    concurrent callers such as graph render threads use one process each
+    and every answer belongs to the command that was sent. Raises
+    ExternalCommandError with the rrdtool message if the command failed.
+    """
+    line = ' '.join(rrdquote(arg) for arg in [command, filename] + list(args))
+    with RRD_SESSIONS_LOCK:
+        session = RRD_SESSIONS.pop() if RRD_SESSIONS else None
+    if session is None:
+        session = openrrdsession()
+    output = []
+    try:
+        session['process'].stdin.write(line + '\n')
+        session['process'].stdin.flush()
+        while True:
+            response = session['process'].stdout.readline()
+            if not response:
+                raise IOError("rrdtool session ended")
+            if response.startswith('OK ') or response.startswith('ERROR:'):
+                break
+            output.append(response.rstrip('\n'))
+    except IOError, error:
+        closerrdsession(session)
+        raise ExternalCommandError("rrdtool %s %s: %s" % (command, filename,
+                                                          error))
+    with RRD_SESSIONS_LOCK:
+        if response.startswith('OK '):
+            # OK u:<user> s:<system> r:<real>, totals of the session
+            usage = dict(field.split(':', 1)
+                         for field in response.split()[1:] if ':' in field)
+            cpu = float(usage.get('u', 0)) + float(usage.get('s', 0))
+            RRD_SESSION_CPU['total'] += cpu - session['cpu']
+            session['cpu'] = cpu
+        RRD_SESSIONS.append(session)
+    if response.startswith('ERROR:'):
+        raise ExternalCommandError(response[len('ERROR:'):].strip())
+    return output
+
+
+# pyrrd backend sending create, update and graph to rrdtool sessions
+class SessionBackend(object):
+    prepareObject = staticmethod(external.prepareObject)
+
+    def create(self, filename, parameters):
+        rrdcommand('create', filename, parameters)
+
+    def update(self, filename, data, debug=False):
+        rrdcommand('updatev' if debug else 'update', filename, data)
+
+    def graph(self, filename, parameters):
+        rrdcommand('graph', filename, parameters)
+
+
+RRD_BACKEND = SessionBackend()
+
+
 # Create new RRA database
 def createrra(namespace, memvalues, netvalues, blockvalues,
-              cpuvalues, loadavgvalues):
+              cpuvalues, loadavgvalues, selfvalues=None, rrdpath=None):
+    rrdpath = rrdpath or namespace.get('rrdpath')
     debug = False
     if namespace['verbose']:
         debug = True
-        print "-----Creating new RRD database: %s ------------" %\
-            namespace.get('rrdpath')
+        print "-----Creating new RRD database: %s ------------" % rrdpath
     dataSources = []
     dataSources = createDSList(namespace, memvalues, netvalues, blockvalues,
-                               cpuvalues, loadavgvalues)
+                               cpuvalues, loadavgvalues, selfvalues)
+    if namespace['verbose']:
+        for name, short in sorted(DS_NAME_SHORT.iteritems()):
+            print "DS name %s is stored as %s" % (name, short)
     roundRobinArchives = []
     roundRobinArchives.append(RRA(cf='AVERAGE', xff=0.5,
                                   steps=1, rows=10080))
@@ -372,76 +1286,1341 @@ def createrra(namespace, memvalues, netvalues, blockvalues,
     roundRobinArchives.append(RRA(cf='LAST', xff=0.5,
                                   steps=1, rows=10080))
     if dataSources:
-        myRRD = RRD(namespace.get('rrdpath'), ds=dataSources,
-                    rra=roundRobinArchives, start=int(time.time()))
+        myRRD = RRD(rrdpath, ds=dataSources,
+                    rra=roundRobinArchives, start=int(time.time()),
+                    backend=RRD_BACKEND)
         myRRD.create(debug)
     else:
-        print "ERROR: database %s not created:" % namespace.get('rrdpath')
+        print "ERROR: database %s not created:" % rrdpath
         print "Please check parameters in the beginning"
         raise BaseException("Error: Script executed without input data")
 
 
-# Create tempase and values strings to be used in RRD update
-def createTemplateAndValues(memvalues, netvalues,
-                            blockvalues, cpuvalues, loadavgvalues):
-    values = ''
-    templateds = ''
+# Switch DS types of an existing RRD to the ones from DS_TYPES
+def migraterra(namespace, memvalues, netvalues, blockvalues,
+               cpuvalues, loadavgvalues, selfvalues=None, rrdpath=None):
+    """Retype counters in an RRD created when everything was GAUGE.
+
+    Archived rows keep the raw counter totals they were stored with;
+    only samples written after the migration are rates.
+    """
+    rrdpath = rrdpath or namespace.get('rrdpath')
+    dataSources = createDSList(namespace, memvalues, netvalues, blockvalues,
+                               cpuvalues, loadavgvalues, selfvalues)
+    args = []
+    for dataSource in dataSources:
+        args.extend(['--data-source-type',
+                     '%s:%s' % (dataSource.name, dataSource.type)])
+    if namespace['verbose']:
+        print "-----Migrating DS types of RRD database: %s ---------" % rrdpath
+    try:
+        rrdcommand('tune', rrdpath, args)
+    except ExternalCommandError, error:
+        print "Error: migration of RRD %s failed: %s" % (rrdpath, error)
+
+
+# Update plans built from the last set of collected sources, by RRD file
+UPDATE_PLAN = {}
+
+
+# Build ordered DS slots and template string for RRD updates
+def createUpdatePlan(memvalues, netvalues,
+                     blockvalues, cpuvalues, loadavgvalues, selfvalues=None):
+    """Return a plan dict with 'slots', 'names' and 'template'.
+
+    Each slot is (source, device, key) and stores the DS at the same
+    position of 'names'. source indexes the tuple (memvalues,
+    loadavgvalues, cpuvalues, netvalues, blockvalues, selfvalues) and
+    device is None for sources that are not keyed by device. Devices and
+    fields are sorted, so the template does not depend on dict order.
+    """
+    slots = []
+    names = []
     if memvalues:
-        for ds, value in memvalues.items():
-            values += str(value) + ':'
-            templateds += (ds.replace('(', '_').strip(')') + ':')
+        for ds in sorted(memvalues):
+            slots.append((0, None, ds))
+            names.append(dsname(ds.replace('(', '_').strip(')')))
+    if loadavgvalues:
+        for key in sorted(loadavgvalues):
+            slots.append((1, None, key))
+            names.append(key)
     if cpuvalues:
-        for key, value in loadavgvalues.items():
-            values += str(value) + ':'
-            templateds += key + ':'
-        for cpu in cpuvalues.items():
-            for key, value in cpu[1].items():
+        for cpu in sorted(cpuvalues):
+            for key in sorted(cpuvalues[cpu]):
                 if key != 'name' and key != 'guest-nice':
-                    values += str(value) + ':'
-                    templateds += cpu[0] + '_' + key + ':'
+                    slots.append((2, cpu, key))
+                    names.append(dsname(cpu + '_' + key))
     if netvalues:
-        for interface in netvalues.items():
-            for key, value in interface[1].items():
-                if key in ['recv_bytes', 'trans_bytes', 'recv_packets',
-                           'trans_packets', 'recv_errs', 'trans_errs']:
-                    values += str(value) + ':'
-                    templateds += interface[0] + '_' + key + ':'
+        for interface in sorted(netvalues):
+            for key in sorted(netvalues[interface]):
+                if key in DS_NET or key in BURST_KEYS:
+                    slots.append((3, interface, key))
+                    names.append(dsname(interface + '_' + key))
     if blockvalues:
-        for blockdevice in blockvalues.items():
-            for key, value in blockdevice[1].items():
+        for blockdevice in sorted(blockvalues):
+            for key in sorted(blockvalues[blockdevice]):
                 if key != 'dev':
-                    values += str(value) + ':'
-                    templateds += blockdevice[0] + '_' + key + ':'
-    return values, templateds
+                    slots.append((4, blockdevice, key))
+                    names.append(dsname(blockdevice + '_' + key))
+    if selfvalues:
+        for key in sorted(selfvalues):
+            slots.append((5, None, key))
+            names.append(dsname('self_' + key))
+    return {'slots': tuple(slots), 'names': tuple(names),
+            'template': ':'.join(names)}
+
+
+# Return the update plan for a sample, reusing the one stored under plankey
+def updateplan(memvalues, netvalues, blockvalues, cpuvalues, loadavgvalues,
+               selfvalues=None, plankey=None):
+    """Return the plan of createUpdatePlan() for these sources.
+
+    The plan stored in UPDATE_PLAN under plankey is reused while the
+    same memory fields and devices, with the same number of fields each,
+    are collected, and rebuilt when they change (e.g. when the rates of
+    a device appear once it has a previous reading).
+    """
+    signature = (frozenset(memvalues), frozenset(loadavgvalues),
+                 frozenset((cpu, len(fields))
+                           for cpu, fields in cpuvalues.iteritems()),
+                 frozenset((interface, len(fields))
+                           for interface, fields in netvalues.iteritems()),
+                 frozenset((device, len(fields))
+                           for device, fields in blockvalues.iteritems()),
+                 frozenset(selfvalues or {}))
+    plan = UPDATE_PLAN.get(plankey)
+    if plan is None or plan['signature'] != signature:
+        plan = createUpdatePlan(memvalues, netvalues, blockvalues,
+                                cpuvalues, loadavgvalues, selfvalues)
+        plan['signature'] = signature
+        UPDATE_PLAN[plankey] = plan
+    return plan
+
+
+# Return the values of a sample in the slot order of plan
+def planvalues(plan, memvalues, netvalues, blockvalues, cpuvalues,
+               loadavgvalues, selfvalues=None, convert=str):
+    sources = (memvalues, loadavgvalues, cpuvalues, netvalues, blockvalues,
+               selfvalues)
+    values = [None] * len(plan['slots'])
+    for index, (source, device, key) in enumerate(plan['slots']):
+        if device is None:
+            values[index] = convert(sources[source][key])
+        else:
+            values[index] = convert(sources[source][device][key])
+    return values
+
+
+# Create tempase and values strings to be used in RRD update
+def createTemplateAndValues(memvalues, netvalues,
+                            blockvalues, cpuvalues, loadavgvalues,
+                            selfvalues=None, plankey=None):
+    """Return values and template strings for one RRD update."""
+    started = time.time()
+    plan = updateplan(memvalues, netvalues, blockvalues, cpuvalues,
+                      loadavgvalues, selfvalues, plankey)
+    values = planvalues(plan, memvalues, netvalues, blockvalues, cpuvalues,
+                        loadavgvalues, selfvalues)
+    stagetime('template', started)
+    return ':'.join(values), plan['template']
 
 
 # Update existing RRA based on DS list
 def updaterra(namespace, memvalues, netvalues,
-              blockvalues, cpuvalues, loadavgvalues):
+              blockvalues, cpuvalues, loadavgvalues, selfvalues=None,
+              state=None, rrdpath=None):
+    """Store one sample in the RRD.
+
+    Without state the sample is written at once. With state (daemon
+    mode) samples are kept per RRD file in state['rrd'] and written
+    together by flushrra() once flushcount samples or flushtime seconds
+    have been buffered, or when the template changes.
+    """
+    rrdpath = rrdpath or namespace.get('rrdpath')
     values, templateds = createTemplateAndValues(memvalues,
                                                  netvalues, blockvalues,
-                                                 cpuvalues, loadavgvalues)
-    debug = False
-    if namespace['verbose']:
-        print "-----Database file exists  ---------"
-        print "-----Updatine existing RRD database: %s ---------" %\
-            namespace.get('rrdpath')
-        debug = namespace['verbose']
+                                                 cpuvalues, loadavgvalues,
+                                                 selfvalues, rrdpath)
     now = int(time.time())
     now += 1
-    myRRD = RRD(namespace.get('rrdpath'))
-    myRRD.bufferValue(now, values[:-1])
+    buffered = state is not None
+    if not buffered:
+        state = {}
+    rrdbuffer = state.setdefault('rrd', {}).get(rrdpath)
+    if rrdbuffer and rrdbuffer['template'] != templateds:
+        flushrra(namespace, state, rrdpath)
+        rrdbuffer = None
+    if not rrdbuffer:
+        rrdbuffer = {'template': templateds, 'samples': [],
+                     'since': time.time()}
+        state['rrd'][rrdpath] = rrdbuffer
+    rrdbuffer['samples'].append((now, values))
+    rrdbuffer['sources'] = (memvalues, netvalues, blockvalues,
+                            cpuvalues, loadavgvalues, selfvalues)
+    if not buffered or \
+            len(rrdbuffer['samples']) >= namespace.get('flushcount') or \
+            time.time() - rrdbuffer['since'] >= namespace.get('flushtime'):
+        flushrra(namespace, state, rrdpath)
+
+
+# Write buffered samples to the RRD in one update per file
+def flushrra(namespace, state, rrdpath=None):
+    """Flush the buffer of rrdpath, or of every RRD file if not given."""
+    rrdbuffers = state.get('rrd', {})
+    if rrdpath is None:
+        rrdpaths = sorted(rrdbuffers)
+    else:
+        rrdpaths = [rrdpath]
+    for rrdpath in rrdpaths:
+        rrdbuffer = rrdbuffers.pop(rrdpath, None)
+        if not rrdbuffer or not rrdbuffer['samples']:
+            continue
+        debug = False
+        if namespace['verbose']:
+            print "-----Database file exists  ---------"
+            print "-----Updatine existing RRD database: %s, %s samples ---" %\
+                (rrdpath, len(rrdbuffer['samples']))
+            debug = namespace['verbose']
+        myRRD = RRD(rrdpath, backend=RRD_BACKEND)
+        for timestamp, values in rrdbuffer['samples']:
+            myRRD.bufferValue(timestamp, values)
+        try:
+            try:
+                myRRD.update(debug, dryRun=False,
+                             template=rrdbuffer['template'])
+            except ExternalCommandError:
+                # Devices may have appeared since the RRD was created
+                dataSources = createDSList(namespace, *rrdbuffer['sources'])
+                if not evolverra(namespace, rrdpath, dataSources):
+                    raise
+                myRRD.update(debug, dryRun=False,
+                             template=rrdbuffer['template'])
+        except ExternalCommandError, error:
+            print "----------------------------------------"
+            print "Error: update existing RRD %s failed: %s" % (rrdpath, error)
+            print "Please check that RRD contains valid DS list"
+
+
+# Return the rrdtool info output of an RRD as a dict
+def readrrdinfo(rrdpath):
     try:
-        myRRD.update(debug, dryRun=False, template=templateds[:-1])
-    except:
-        print "----------------------------------------"
-        print "Error: update existing RRD failed"
-        print "Please check that RRD contains valid DS list"
-        print "You can remove existing RRD and create new one with correct DS"
+        lines = rrdcommand('info', rrdpath)
+    except ExternalCommandError, error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return {}
+    info = {}
+    for line in lines:
+        key, sep, value = line.partition(' = ')
+        if sep:
+            info[key] = value.strip('"')
+    return info
+
+
+# Return names of the data sources stored in an existing RRD
+def readrrdschema(rrdpath):
+    return set(key[3:key.index(']')] for key in readrrdinfo(rrdpath)
+               if key.startswith('ds[') and key.endswith('].type'))
+
+
+# Add data sources missing from an existing RRD, keeping its archives
+def evolverra(namespace, rrdpath, dataSources):
+    """Bring the DS set of rrdpath in line with dataSources.
+
+    Missing data sources are added in place with rrdtool tune (rrdtool
+    1.5 or newer), so archived rows are kept and the new DS reads
+    unknown before now. Data sources that are no longer collected are
+    retired rather than deleted: they keep their history and simply get
+    no new values. Returns True if data sources were added.
+    """
+    existing = readrrdschema(rrdpath)
+    if not existing:
+        return False
+    missing = [ds for ds in dataSources if ds.name not in existing]
+    retired = existing - set(ds.name for ds in dataSources)
+    if retired and namespace['verbose']:
+        print "-----Retired DS kept in %s: %s ---------" %\
+            (rrdpath, ', '.join(sorted(retired)))
+    if not missing:
+        return False
+    print "-----Adding DS to RRD database %s: %s ---------" %\
+        (rrdpath, ', '.join(ds.name for ds in missing))
+    try:
+        rrdcommand('tune', rrdpath, [str(ds) for ds in missing])
+    except ExternalCommandError, error:
+        print "Error: adding DS to RRD %s failed: %s" % (rrdpath, error)
+        return False
+    if namespace['sharded']:
+        addrrdindex(namespace, rrdpath, [ds.name for ds in missing])
+    return True
+
+
+# Column store: every level of consolidation keeps one mean per COLUMN_RATIO
+# rows of the level below it, so level n holds COLUMN_RATIO ** n samples
+# per row
+COLUMN_RATIO = 10
+COLUMN_LEVELS = 4
+# Rows kept by every level, the same as the RRD archives
+COLUMN_ROWS = 10080
+# Bytes before the first column of a level file (row count)
+COLUMN_HEADER = struct.calcsize('q')
+COLUMN_NAN = float('nan')
+
+# Open column stores: path -> dict of columns, index, maps and plans
+COLUMN_STORES = {}
+
+
+# Return the column store path used instead of an RRD file
+def columnstorepath(rrdpath):
+    return os.path.splitext(rrdpath)[0] + '.tsdb'
+
+
+# Check whether a column store exists
+def columnstoreexists(path):
+    return os.path.isfile(os.path.join(path, 'columns.json'))
+
+
+# Return the byte offset of a row of a column in a level file
+def columnoffset(column, row):
+    """Column -1 is the timestamp column, DS columns start at 0.
+
+    Each column is a block of COLUMN_ROWS native doubles used as a ring:
+    sample n of a level is stored in row n % COLUMN_ROWS.
+    """
+    return COLUMN_HEADER + ((column + 1) * COLUMN_ROWS + row) * 8
+
+
+# Map the files of a column store, keeping them open between samples
+def opencolumnstore(path, writable=True):
+    """Return the store dict of path from COLUMN_STORES.
+
+    columns.json lists the (name, type) of every column in file order.
+    level<n>.col holds the row count followed by the timestamp column
+    and one column per DS. raw.col holds the time of the last sample and
+    the last raw value of every column, used for DERIVE rates. A store
+    cached read-only is mapped again when it is opened writable.
+    """
+    store = COLUMN_STORES.get(path)
+    if store is not None:
+        if store['writable'] or not writable:
+            return store
+        closecolumnstores(path)
+    with openfile(os.path.join(path, 'columns.json'), 'r') as f:
+        columns = [tuple(column) for column in json.load(f)]
+    access = mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ
+    mode = 'r+b' if writable else 'rb'
+    maps = []
+    for name in ['raw.col'] + ['level%d.col' % level
+                               for level in xrange(COLUMN_LEVELS)]:
+        with openfile(os.path.join(path, name), mode) as f:
+            maps.append(mmap.mmap(f.fileno(), 0, access=access))
+    store = {'path': path, 'columns': columns,
+             'index': dict((name, column)
+                           for column, (name, dstype) in enumerate(columns)),
+             'raw': maps[0], 'maps': maps[1:], 'plans': {},
+             'writable': writable, 'means': {}}
+    COLUMN_STORES[path] = store
+    return store
+
+
+# Unmap a column store, or all of them
+def closecolumnstores(path=None):
+    for path in [path] if path else COLUMN_STORES.keys():
+        store = COLUMN_STORES.pop(path, None)
+        if store:
+            store['raw'].close()
+            for columnmap in store['maps']:
+                columnmap.close()
+
+
+# Append columns for new data sources to every file of a column store
+def addcolumns(path, dataSources):
+    """Grow the store at path by one column per DS in dataSources.
+
+    Columns are blocks at the end of each file, so existing rows stay
+    where they are. New columns read NaN for the time before they were
+    added. columns.json is replaced last, so an interrupted resize only
+    leaves unused space that the next resize truncates.
+    """
+    closecolumnstores(path)
+    with openfile(os.path.join(path, 'columns.json'), 'r') as f:
+        columns = [tuple(column) for column in json.load(f)]
+    empty = array('d', [COLUMN_NAN])
+    with openfile(os.path.join(path, 'raw.col'), 'r+b') as f:
+        f.truncate(8 * (len(columns) + 1))
+        f.seek(0, os.SEEK_END)
+        (empty * len(dataSources)).tofile(f)
+    for level in xrange(COLUMN_LEVELS):
+        with openfile(os.path.join(path, 'level%d.col' % level), 'r+b') as f:
+            f.truncate(columnoffset(len(columns), 0))
+            f.seek(0, os.SEEK_END)
+            (empty * (COLUMN_ROWS * len(dataSources))).tofile(f)
+    columns.extend((ds.name, ds.type) for ds in dataSources)
+    tmppath = os.path.join(path, 'columns.json.tmp')
+    with openfile(tmppath, 'w') as f:
+        json.dump(columns, f)
+    os.rename(tmppath, os.path.join(path, 'columns.json'))
+
+
+# Create new column store
+def createcolumns(namespace, memvalues, netvalues, blockvalues,
+                  cpuvalues, loadavgvalues, selfvalues=None, rrdpath=None):
+    path = rrdpath or columnstorepath(namespace.get('rrdpath'))
+    if namespace['verbose']:
+        print "-----Creating new column store: %s ------------" % path
+    dataSources = createDSList(namespace, memvalues, netvalues, blockvalues,
+                               cpuvalues, loadavgvalues, selfvalues)
+    if not dataSources:
+        print "ERROR: column store %s not created:" % path
+        print "Please check parameters in the beginning"
+        raise BaseException("Error: Script executed without input data")
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    with openfile(os.path.join(path, 'raw.col'), 'wb') as f:
+        array('d', [COLUMN_NAN]).tofile(f)
+    for level in xrange(COLUMN_LEVELS):
+        with openfile(os.path.join(path, 'level%d.col' % level), 'wb') as f:
+            f.write(struct.pack('q', 0))
+            (array('d', [0.0]) * COLUMN_ROWS).tofile(f)
+    with openfile(os.path.join(path, 'columns.json'), 'w') as f:
+        json.dump([], f)
+    addcolumns(path, dataSources)
+
+
+# Append one row to a level of a column store
+def appendrow(store, level, timestamp, values):
+    """Write values (one per column) and return the new row count.
+
+    The row count in the header is written last, so readers never see
+    a partially written row.
+    """
+    columnmap = store['maps'][level]
+    count = struct.unpack_from('q', columnmap, 0)[0]
+    row = count % COLUMN_ROWS
+    for column, value in enumerate(values):
+        struct.pack_into('d', columnmap, columnoffset(column, row), value)
+    struct.pack_into('d', columnmap, columnoffset(-1, row), timestamp)
+    struct.pack_into('q', columnmap, 0, count + 1)
+    return count + 1
+
+
+# Add the row just appended to a level to the running means of its window
+def consolidaterow(store, level, count, values):
+    """Return the row for level + 1 once count completes a window of
+    COLUMN_RATIO rows of level, else None.
+
+    Sums and counts of the known values of the current window are kept
+    in store['means'], so a window costs one pass over each new row. If
+    they are missing (the store was just opened), they are rebuilt once
+    from the rows of the window already in the level file.
+    """
+    means = store['means'].get(level)
+    if means is None:
+        sums = [0.0] * len(values)
+        known = [0] * len(values)
+        first = count - 1 - (count - 1) % COLUMN_RATIO
+        for column in xrange(len(values)):
+            for value in readrows(store['maps'][level], column, first,
+                                  count):
+                if value == value:
+                    sums[column] += value
+                    known[column] += 1
+        store['means'][level] = (sums, known)
+    else:
+        sums, known = means
+        for column, value in enumerate(values):
+            if value == value:
+                sums[column] += value
+                known[column] += 1
+    if count % COLUMN_RATIO:
+        return None
+    store['means'][level] = ([0.0] * len(values), [0] * len(values))
+    return [total / number if number else COLUMN_NAN
+            for total, number in izip(sums, known)]
+
+
+# Read rows first..last-1 of one column of a level
+def readrows(columnmap, column, first, last):
+    """Return the rows as an array, copying only the requested range."""
+    result = array('d')
+    while first < last:
+        row = first % COLUMN_ROWS
+        count = min(last - first, COLUMN_ROWS - row)
+        offset = columnoffset(column, row)
+        result.fromstring(columnmap[offset:offset + count * 8])
+        first += count
+    return result
+
+
+# Store one sample in a column store
+def updatecolumns(namespace, memvalues, netvalues,
+                  blockvalues, cpuvalues, loadavgvalues, selfvalues=None,
+                  state=None, rrdpath=None):
+    """Append one sample to level 0 and consolidate the levels above.
+
+    Samples are written straight into the mapped files, so there is no
+    buffering and flushcount/flushtime do not apply. Data sources seen
+    for the first time get a new column. DERIVE columns store the rate
+    since the previous sample, or NaN after a counter reset.
+    """
+    path = rrdpath or columnstorepath(namespace.get('rrdpath'))
+    started = time.time()
+    plan = updateplan(memvalues, netvalues, blockvalues, cpuvalues,
+                      loadavgvalues, selfvalues, path)
+    store = opencolumnstore(path)
+    columns = store['plans'].get(plan['template'])
+    if columns is None:
+        dataSources = createDSList(namespace, memvalues, netvalues,
+                                   blockvalues, cpuvalues, loadavgvalues,
+                                   selfvalues)
+        missing = [ds for ds in dataSources if ds.name not in store['index']]
+        if missing:
+            print "-----Adding columns to column store %s: %s ---------" %\
+                (path, ', '.join(ds.name for ds in missing))
+            addcolumns(path, missing)
+            store = opencolumnstore(path)
+            if namespace['sharded']:
+                addrrdindex(namespace, path, [ds.name for ds in missing])
+        columns = [(store['index'][name],
+                    store['columns'][store['index'][name]][1] == 'DERIVE')
+                   for name in plan['names']]
+        store['plans'][plan['template']] = columns
+    if namespace['verbose']:
+        print "-----Updating column store: %s ---------" % path
+    samples = planvalues(plan, memvalues, netvalues, blockvalues, cpuvalues,
+                         loadavgvalues, selfvalues, float)
+    stagetime('template', started)
+    now = int(time.time())
+    raw = store['raw']
+    elapsed = now - struct.unpack_from('d', raw, 0)[0]
+    values = [COLUMN_NAN] * len(store['columns'])
+    for (column, derive), value in izip(columns, samples):
+        if derive:
+            last = struct.unpack_from('d', raw, 8 * (column + 1))[0]
+            struct.pack_into('d', raw, 8 * (column + 1), value)
+            if elapsed > 0 and value >= last:
+                value = (value - last) / elapsed
+            else:
+                value = COLUMN_NAN
+        values[column] = value
+    struct.pack_into('d', raw, 0, now)
+    count = appendrow(store, 0, now, values)
+    for level in xrange(1, COLUMN_LEVELS):
+        values = consolidaterow(store, level - 1, count, values)
+        if values is None:
+            break
+        count = appendrow(store, level, now, values)
+
+
+# Write mapped pages of column stores back to their files
+def flushcolumns(namespace, state, rrdpath=None):
+    for path in [rrdpath] if rrdpath else COLUMN_STORES.keys():
+        store = COLUMN_STORES.get(path)
+        if store:
+            store['raw'].flush()
+            for columnmap in store['maps']:
+                columnmap.flush()
+
+
+# Return the first row of a level at or after timestamp
+def findrow(columnmap, first, last, timestamp):
+    while first < last:
+        middle = (first + last) // 2
+        offset = columnoffset(-1, middle % COLUMN_ROWS)
+        if struct.unpack_from('d', columnmap, offset)[0] < timestamp:
+            first = middle + 1
+        else:
+            last = middle
+    return first
+
+
+# Read a time range of some columns of a column store
+def readcolumns(path, names, start, end, level=0):
+    """Return (timestamps, {name: values}) for start <= time <= end.
+
+    Only the rows in range are read from the mapped level file, found
+    by a binary search over its timestamp column. Names that the store
+    does not hold are left out of the result.
+    """
+    store = opencolumnstore(path, writable=False)
+    columnmap = store['maps'][level]
+    count = struct.unpack_from('q', columnmap, 0)[0]
+    first = findrow(columnmap, max(0, count - COLUMN_ROWS), count, start)
+    last = findrow(columnmap, first, count, end + 1)
+    result = {}
+    for name in names:
+        if name in store['index']:
+            result[name] = readrows(columnmap, store['index'][name],
+                                    first, last)
+    return readrows(columnmap, -1, first, last), result
+
+
+# Storage backends selectable with --backend. path maps the RRD file name
+# of a target to the backend's own path; create, update and flush take
+# the same arguments as createrra, updaterra and flushrra.
+STORAGE_BACKENDS = {
+    'rrd': {'path': lambda rrdpath: rrdpath, 'exists': os.path.isfile,
+            'create': createrra, 'update': updaterra, 'flush': flushrra,
+            'migrate': migraterra, 'close': None},
+    'column': {'path': columnstorepath, 'exists': columnstoreexists,
+               'create': createcolumns, 'update': updatecolumns,
+               'flush': flushcolumns, 'migrate': None,
+               'close': closecolumnstores},
+}
+
+
+# DS name -> RRD file of the sharded layout, loaded from rrdindex
+RRD_INDEX = {}
+
+
+# Split collected values into the RRD files that store them
+def rrdtargets(namespace, memvalues, netvalues, blockvalues,
+               cpuvalues, loadavgvalues, selfvalues=None):
+    """Return a list of (rrdfile, values) to store.
+
+    values is a (memvalues, netvalues, blockvalues, cpuvalues,
+    loadavgvalues[, selfvalues]) tuple holding only what goes to rrdfile.
+    Without sharding everything goes to rrdpath. With sharding there is
+    one file for memory, one per cpu (load average is kept with the 'cpu'
+    total), one per interface, one per block device and one for the
+    collector itself, next to rrdpath.
+    """
+    if not namespace['sharded']:
+        return [(namespace.get('rrdpath'), (memvalues, netvalues, blockvalues,
+                                            cpuvalues, loadavgvalues,
+                                            selfvalues))]
+    base = os.path.splitext(namespace.get('rrdpath'))[0]
+    targets = []
+    if memvalues:
+        targets.append((base + '_memory.rrd', (memvalues, {}, {}, {}, {})))
+    if loadavgvalues and 'cpu' not in cpuvalues:
+        targets.append((base + '_cpu.rrd', ({}, {}, {}, {}, loadavgvalues)))
+    for cpu in sorted(cpuvalues):
+        loadavg = loadavgvalues if cpu == 'cpu' else {}
+        targets.append(('%s_%s.rrd' % (base, cpu),
+                        ({}, {}, {}, {cpu: cpuvalues[cpu]}, loadavg)))
+    for interface in sorted(netvalues):
+        targets.append(('%s_net_%s.rrd' % (base, interface.strip(' ')),
+                        ({}, {interface: netvalues[interface]}, {}, {}, {})))
+    for blockdevice in sorted(blockvalues):
+        targets.append(('%s_block_%s.rrd' % (base, blockdevice.strip(' ')),
+                        ({}, {}, {blockdevice: blockvalues[blockdevice]},
+                         {}, {})))
+    if selfvalues:
+        targets.append((base + '_collector.rrd',
+                        ({}, {}, {}, {}, {}, selfvalues)))
+    return targets
+
+
+# Load the DS name -> RRD file index of the sharded layout
+def loadrrdindex(namespace):
+    if not RRD_INDEX:
+        try:
+            with openfile(namespace.get('rrdindex'), 'r') as f:
+                RRD_INDEX.update(json.load(f))
+        except (IOError, ValueError):
+            pass
+    return RRD_INDEX
+
+
+# Record which RRD file holds each DS of targets in the index file
+def saverrdindex(namespace, targets):
+    index = loadrrdindex(namespace)
+    for rrdfile, values in targets:
+        for dataSource in createDSList(namespace, *values):
+            index[dataSource.name] = rrdfile
+    writerrdindex(namespace)
+
+
+# Record that rrdfile now also holds the named data sources
+def addrrdindex(namespace, rrdfile, names):
+    index = loadrrdindex(namespace)
+    for name in names:
+        index[name] = rrdfile
+    writerrdindex(namespace)
+
+
+# Write the loaded index to the index file
+def writerrdindex(namespace):
+    tmppath = namespace.get('rrdindex') + '.tmp'
+    with openfile(tmppath, 'w') as f:
+        json.dump(RRD_INDEX, f, indent=1, sort_keys=True)
+    os.rename(tmppath, namespace.get('rrdindex'))
+
+
+# Seconds per unit of relative times given to query, e.g. -1h
+TIME_UNITS = {'s': 1, 'm': 60, 'h': 3600, 'd': 86400, 'w': 604800}
+
+
+# Parse a query time: 'now', seconds since epoch or relative like -1h
+def parsetime(value, now):
+    if value == 'now':
+        return now
+    if value.startswith('-'):
+        unit = TIME_UNITS.get(value[-1])
+        if unit is None:
+            return now - int(value[1:])
+        return now - int(value[1:-1]) * unit
+    return int(value)
+
+
+# Consolidation functions accepted by query
+CONSOLIDATION = {'AVERAGE': lambda values: sum(values) / len(values),
+                 'MIN': min, 'MAX': max, 'LAST': lambda values: values[-1]}
+
+
+# Return the resolution of the coarsest RRA of cf that satisfies step
+def rraresolution(info, cf, step):
+    """Pick among the RRAs of consolidation function cf.
+
+    Returns the largest resolution in seconds that is not coarser than
+    step, or the finest one if they all are.
+    """
+    base = int(info.get('step', 300))
+    resolutions = []
+    index = 0
+    while 'rra[%d].cf' % index in info:
+        if info['rra[%d].cf' % index] == cf:
+            resolutions.append(base *
+                               int(info['rra[%d].pdp_per_row' % index]))
+        index += 1
+    if not resolutions:
+        return None
+    fitting = [resolution for resolution in resolutions
+               if resolution <= step]
+    return max(fitting) if fitting else min(resolutions)
+
+
+# Read data sources of one RRD with rrdtool fetch
+def fetchrrd(rrdpath, names, start, end, step, cf):
+    """Return (timestamps, {name: values}) from the best RRA of rrdpath."""
+    resolution = rraresolution(readrrdinfo(rrdpath), cf, step)
+    if resolution is None:
+        return [], {}
+    # rrdtool only serves an RRA at its own resolution for aligned times
+    start = start // resolution * resolution
+    end = end // resolution * resolution
+    try:
+        lines = rrdcommand('fetch', rrdpath, [cf, '-r', str(resolution),
+                                              '-s', str(start),
+                                              '-e', str(end)])
+    except ExternalCommandError, error:
+        sys.stderr.write("ERROR: %s\n" % error)
+        return [], {}
+    if not lines:
+        return [], {}
+    header = lines[0].split()
+    wanted = [(header.index(name), name) for name in names if name in header]
+    timestamps = []
+    columns = dict((name, []) for position, name in wanted)
+    for line in lines[1:]:
+        timestamp, sep, values = line.partition(':')
+        if not sep:
+            continue
+        timestamps.append(int(timestamp))
+        values = values.split()
+        for position, name in wanted:
+            columns[name].append(float(values[position]))
+    return timestamps, columns
+
+
+# Read data sources of one column store from the best level
+def fetchcolumns(namespace, path, names, start, end, step):
+    """Return (timestamps, {name: values}) from the coarsest level of path
+    whose resolution (interval * COLUMN_RATIO ** level) is not coarser
+    than step.
+    """
+    level = 0
+    while level + 1 < COLUMN_LEVELS and \
+            namespace.get('interval') * COLUMN_RATIO ** (level + 1) <= step:
+        level += 1
+    return readcolumns(path, names, start, end, level)
+
+
+# Merge rows of several files into buckets of step seconds
+def consolidate(parts, names, step, cf):
+    """Yield (timestamp, values) with one value per name or NaN.
+
+    parts is a list of (timestamps, {name: values}). Rows are grouped
+    into buckets that end at multiples of step and reduced with the
+    CONSOLIDATION function of cf, leaving unknown (NaN) values out.
+    """
+    function = CONSOLIDATION[cf]
+    buckets = {}
+    for timestamps, columns in parts:
+        for name, values in columns.iteritems():
+            position = names.index(name)
+            for timestamp, value in izip(timestamps, values):
+                if value != value:
+                    continue
+                bucket = -(-int(timestamp) // step) * step
+                row = buckets.get(bucket)
+                if row is None:
+                    row = buckets[bucket] = [[] for name in names]
+                row[position].append(value)
+        for timestamp in timestamps:
+            bucket = -(-int(timestamp) // step) * step
+            if bucket not in buckets:
+                buckets[bucket] = [[] for name in names]
+    for bucket in sorted(buckets):
+        yield bucket, [function(values) if values else COLUMN_NAN
+                       for values in buckets[bucket]]
+
+
+# Read a time range of data sources from the configured storage
+def querydata(namespace, names, start, end, step, cf='AVERAGE'):
+    """Return rows of (timestamp, values) for names between start and end.
+
+    Each file holding some of names is read once: RRD files through
+    rrdtool fetch from the coarsest RRA of cf that satisfies step, column
+    stores from the mapped files of the matching level. Rows are then
+    consolidated to step seconds.
+    """
+    files = {}
+    for name in names:
+        if namespace['sharded']:
+            rrdfile = loadrrdindex(namespace).get(name)
+            if rrdfile is None:
+                sys.stderr.write("ERROR: %s is not in the RRD index %s\n" %
+                                 (name, namespace.get('rrdindex')))
+                continue
+        else:
+            rrdfile = namespace.get('rrdpath')
+        if namespace['backend'] == 'column':
+            rrdfile = columnstorepath(rrdfile)
+        files.setdefault(rrdfile, []).append(name)
+    parts = []
+    for path, filenames in sorted(files.iteritems()):
+        if namespace['backend'] == 'column':
+            parts.append(fetchcolumns(namespace, path, filenames,
+                                      start, end, step))
+        else:
+            parts.append(fetchrrd(path, filenames, start, end, step, cf))
+    return consolidate(parts, names, step, cf)
+
+
+# Create command line parser of the query subcommand
+def createQueryParser():
+    parser = argparse.ArgumentParser(prog="collect_sysstat.py query",
+                                     description="""
+Print stored values of data sources for a time range as CSV or JSON lines
+                                     """)
+    parser.add_argument("--ds", nargs='+', required=True,
+                        help="Data source names, e.g. sda_reads")
+    parser.add_argument("--from", dest="start", default='-1h',
+                        help="Start time: seconds since epoch, 'now' or "
+                             "relative like -1h (default -1h)")
+    parser.add_argument("--to", dest="end", default='now',
+                        help="End time, same format as --from")
+    parser.add_argument("--step", type=int,
+                        help="Seconds per returned row (default interval)")
+    parser.add_argument("--cf", default='AVERAGE',
+                        choices=sorted(CONSOLIDATION),
+                        help="Consolidation function")
+    parser.add_argument("--format", default='csv', choices=['csv', 'json'],
+                        help="Output format")
+    parser.add_argument("--backend", choices=sorted(STORAGE_BACKENDS),
+                        help="Storage backend to read from")
+    parser.add_argument("--sharded", action="store_true",
+                        help="Read the sharded RRD layout")
+    # Everything else initnamespace() expects keeps its default
+    parser.set_defaults(graph=False, daemon=False, migrate=False,
+                        render_on_request=False, graph_workers=None,
+                        interval=None, flush_count=None, flush_time=None,
+                        burst=None, burst_interval=None,
+                        export=False, export_port=None, export_ttl=None,
+                        ship=None, ship_format=None, ship_udp=False,
+                        ship_batch=None, proc_root=None, net_source=None,
+                        sys_root=None)
+    return parser
+
+
+# Join relative times to their option, argparse takes '-1h' for an option
+def queryargv(argv):
+    args = []
+    for arg in argv:
+        if args and args[-1] in ('--from', '--to') and arg.startswith('-'):
+            args[-1] += '=' + arg
+        else:
+            args.append(arg)
+    return args
+
+
+# Print query results for the query subcommand
+def query(namespace, query_args):
+    now = int(time.time())
+    step = query_args.step or namespace.get('interval')
+    try:
+        rows = querydata(namespace, map(dsname, query_args.ds),
+                         parsetime(query_args.start, now),
+                         parsetime(query_args.end, now), step, query_args.cf)
+    finally:
+        closerrdsessions()
+    if query_args.format == 'csv':
+        sys.stdout.write('time,%s\n' % ','.join(query_args.ds))
+    for timestamp, values in rows:
+        if query_args.format == 'csv':
+            sys.stdout.write('%d,%s\n' % (timestamp, ','.join(
+                '' if value != value else repr(value) for value in values)))
+        else:
+            row = {'time': timestamp}
+            for name, value in izip(query_args.ds, values):
+                row[name] = None if value != value else value
+            sys.stdout.write(json.dumps(row, sort_keys=True) + '\n')
+
+
+# Check whether a graph file is worth redrawing now
+def needsrender(namespace, path):
+    """Return False if redrawing path would not change what anybody sees.
+
+    A graph is only redrawn once its window moved by at least one pixel,
+    i.e. gtime / gwidth seconds after it was last written. With
+    gonrequest set it is also skipped until it was read since then (atime
+    newer than mtime) or a <graph>.request marker file was touched.
+    """
+    try:
+        graphstat = os.stat(path)
+    except OSError:
+        return True
+    pixel = float(namespace.get('gtime')) / namespace.get('gwidth')
+    if time.time() - graphstat.st_mtime < pixel:
+        return False
+    if namespace['gonrequest']:
+        if graphstat.st_atime > graphstat.st_mtime:
+            return True
+        try:
+            return os.stat(path + '.request').st_mtime > graphstat.st_mtime
+        except OSError:
+            return False
+    return True
+
+
+# Render one graph and return how long it took, None if it failed
+def rendergraph(g):
+    started = time.time()
+    try:
+        g.write()
+    except ExternalCommandError, error:
+        print "Error: rendering graph %s failed: %s" % (g.filename, error)
+        return g.filename, None
+    return g.filename, time.time() - started
+
+
+# Render graph jobs on a pool of gworkers threads
+def rendergraphs(namespace, jobs):
+    """Render the Graph objects in jobs.
+
+    rrdtool does the work in its own process, and every thread renders
+    through a session of its own, so threads are enough to keep several
+    renders running at once. Returns a list of (filename, seconds) for
+    every graph, seconds is None for graphs that failed to render.
+    """
+    if not jobs:
+        return []
+    workers = min(namespace.get('gworkers'), len(jobs))
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            timings = pool.map(rendergraph, jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        timings = map(rendergraph, jobs)
+    if namespace['verbose']:
+        for filename, seconds in timings:
+            if seconds is not None:
+                print "Graph:%s, render_time:%.3fs" % (filename, seconds)
+    return timings
+
+
+# VDEF functions printed in graph legends and their labels
+GRAPH_PRINTS = ('LAST', 'AVERAGE', 'MINIMUM', 'MAXIMUM')
+GRAPH_PRINT_LABELS = {'LAST': ('LAST', 'last'), 'AVERAGE': ('AVG', 'avg'),
+                      'MINIMUM': ('MIN', 'min'), 'MAXIMUM': ('MAX', 'max')}
+# Printed when only the maximum of a series is shown
+GRAPH_PRINT_MAX = ('MAXIMUM',)
+
+
+# Describe one series of a graph spec
+def graphseries(vname, ds=None, rpn=None, draw='LINE', color=None,
+                legend=None, stack=False, derive=None, hrule=False,
+                prints=GRAPH_PRINTS):
+    """Return a series dict for GRAPH_SPECS.
+
+    vname names the DEF of DS ds ({dev} is replaced by the device of
+    the graph), rpn is an optional CDEF applied to it, e.g. '1024,*'.
+    A series with derive is a CDEF over other series instead of a DEF.
+    draw is 'AREA', 'LINE' or None to only print the series; hrule
+    draws its maximum as a horizontal line instead.
+    """
+    return {'vname': vname, 'ds': ds, 'rpn': rpn, 'draw': draw,
+            'color': color, 'legend': legend or vname, 'stack': stack,
+            'derive': derive, 'hrule': hrule, 'prints': prints}
+
+
+# Graphs drawn by draw_file, one entry per graph family. source selects
+# the collected values that give the devices to draw the graph for;
+# {dev} and {gtime} are replaced in filename and title.
+GRAPH_SPECS = [
+    {'source': 'memory', 'filename': 'memory_summary.png',
+     'title': 'Memory_utilization', 'vertical_label': 'Memory_usage',
+     'format': '%8.2lf%s',
+     'series': [
+         graphseries('mem_used', draw='AREA', color='#ff0000',
+                     legend='Processes',
+                     derive='MemTotal_c,MemFree_c,-,Slab_c,-,'
+                            'Cached_c,-,Buffers_c,-'),
+         graphseries('Buffers', 'Buffers', '1024,*', 'AREA', '#FFF200FF',
+                     stack=True),
+         graphseries('Cached', 'Cached', '1024,*', 'AREA', '#6EA100FF',
+                     stack=True),
+         graphseries('Slab', 'Slab', '1024,*', 'AREA', '#1EA100FF',
+                     stack=True),
+         graphseries('MemFree', 'MemFree', '1024,*', 'AREA', '#12B3B5FF',
+                     stack=True),
+         graphseries('MemTotal', 'MemTotal', '1024,*', 'LINE', '#FFFFFFFF',
+                     prints=GRAPH_PRINT_MAX)]},
+    {'source': 'memory', 'filename': 'memory_active.png',
+     'title': 'Memory_active', 'vertical_label': 'Memory_usage',
+     'format': '%8.2lf%s',
+     'series': [
+         graphseries('Active_anon', 'Active_anon', '1024,*', 'AREA',
+                     '#006600'),
+         graphseries('Active_file', 'Active_file', '1024,*', 'AREA',
+                     '#00cc99', stack=True),
+         graphseries('Inactive_anon', 'Inactive_anon', '1024,*', 'AREA',
+                     '#000099', stack=True),
+         graphseries('Inactive_file', 'Inactive_file', '1024,*', 'AREA',
+                     '#0066ff', stack=True),
+         graphseries('Active', 'Active', '1024,*', 'LINE', '#FFFFFFFF',
+                     hrule=True, prints=GRAPH_PRINT_MAX),
+         graphseries('Inactive', 'Inactive', '1024,*', None,
+                     prints=GRAPH_PRINT_MAX)]},
+    {'source': 'memory', 'filename': 'memory_swap.png',
+     'title': 'Memory_swap', 'vertical_label': 'Memory_usage',
+     'format': '%8.2lf%s',
+     'series': [
+         graphseries('SwapFree', 'SwapFree', '1024,*', 'AREA', '#006600',
+                     legend='Swap_Free'),
+         graphseries('SwapTotal', 'SwapTotal', '1024,*', 'LINE', '#FFFFFFFF',
+                     legend='Memory_Total', hrule=True,
+                     prints=GRAPH_PRINT_MAX)]},
+    {'source': 'memory', 'filename': 'memory_pages.png',
+     'title': 'Memory_Pages', 'vertical_label': 'Memory_usage',
+     'format': '%8.2lf%s',
+     'series': [
+         graphseries('Dirty', 'Dirty', '1024,*', 'AREA', '#FFF200FF',
+                     stack=True),
+         graphseries('AnonPages', 'AnonPages', '1024,*', 'AREA', '#6EA100FF',
+                     stack=True),
+         graphseries('HugePages_Free', 'HugePages_Free', '1024,*', 'AREA',
+                     '#12B3B5FF', stack=True),
+         graphseries('HugePages_Total', 'HugePages_Total', '1024,*', 'LINE',
+                     '#FFFFFFFF', hrule=True, prints=GRAPH_PRINT_MAX)]},
+    {'source': 'loadavg', 'filename': 'cpu_loadavg.png',
+     'title': 'Load_Average', 'vertical_label': 'CPU_utilization',
+     'format': '%3.2lf', 'rules': [(100, '#990000', 'Max 100%')],
+     'series': [
+         graphseries('loadavg15min', 'loadavg15min', None, 'AREA',
+                     '#12B3B5FF', legend='Load AVG 15 Min'),
+         graphseries('loadavg5min', 'loadavg5min', None, 'LINE',
+                     '#6EA100FF', legend='Load AVG 5 Min'),
+         graphseries('loadavg1min', 'loadavg1min', None, 'LINE',
+                     '#FFFFFFFF', legend='Load AVG 1 Min')]},
+    {'source': 'cpu', 'filename': '{dev}_util.png',
+     'title': '{dev}_utilizaton_for_{gtime}_seconds', 'vertical_label': 'Load',
+     'format': '%3.2lf',
+     'series': [
+         graphseries('cpu_system', '{dev}_system', None, 'AREA', '#ff0000'),
+         graphseries('cpu_user', '{dev}_user', None, 'AREA', '#ff8000',
+                     stack=True),
+         graphseries('cpu_iowait', '{dev}_iowait', None, 'AREA', '#80ff00',
+                     stack=True),
+         graphseries('cpu_irq', '{dev}_irq', None, 'AREA', '#00ff00',
+                     stack=True),
+         graphseries('cpu_softirq', '{dev}_softirq', None, 'AREA', '#00ff80',
+                     stack=True),
+         graphseries('cpu_nice', '{dev}_nice', None, 'AREA', '#00ffff',
+                     stack=True),
+         graphseries('cpu_steal', '{dev}_steal', None, 'AREA', '#00bfff',
+                     stack=True),
+         graphseries('cpu_guest', '{dev}_guest', None, 'AREA', '#0040ff',
+                     stack=True),
+         graphseries('cpu_idle', '{dev}_idle', None, 'AREA', '#ffff00',
+                     stack=True)]},
+    {'source': 'net', 'filename': '{dev}_bytes.png',
+     'title': '{dev}_utilizaton_for_{gtime}_seconds',
+     'vertical_label': 'Bytes_per_second', 'format': '%3.2lf %sBytes/s',
+     'series': [
+         graphseries('if_recv_bytes', '{dev}_recv_bytes', None, 'AREA',
+                     '#339933', prints=GRAPH_PRINT_MAX),
+         graphseries('if_trans_bytes', '{dev}_trans_bytes', None, 'LINE',
+                     '#0000ff', prints=GRAPH_PRINT_MAX)]},
+    {'source': 'net', 'filename': '{dev}_packets.png',
+     'title': '{dev}_packets_for_{gtime}_seconds',
+     'vertical_label': 'Packets_per_second', 'format': '%3.2lf',
+     'series': [
+         graphseries('if_recv_packets', '{dev}_recv_packets', None, 'AREA',
+                     '#006600'),
+         graphseries('if_trans_packets', '{dev}_trans_packets', None, 'LINE',
+                     '#0000ff'),
+         graphseries('if_recv_errs', '{dev}_recv_errs', None, 'LINE',
+                     '#ffff00'),
+         graphseries('if_trans_errs', '{dev}_trans_errs', None, 'LINE',
+                     '#ff0000')]},
+    {'source': 'block', 'filename': '{dev}_msstat.png',
+     'title': '{dev}_msstat_for_{gtime}_seconds', 'vertical_label': 'ms/s',
+     'format': '%3.2lf',
+     'series': [
+         graphseries('dev_ms_doing_io', '{dev}_ms_doing_io', None, 'LINE',
+                     '#006600'),
+         graphseries('dev_ms_writing', '{dev}_ms_writing', None, 'LINE',
+                     '#0000ff'),
+         graphseries('dev_ms_weighted', '{dev}_ms_weighted', None, 'LINE',
+                     '#ffff00'),
+         graphseries('dev_ms_reading', '{dev}_ms_reading', None, 'LINE',
+                     '#ff0000')]},
+    {'source': 'block', 'filename': '{dev}_ios.png',
+     'title': '{dev}_ios_for_{gtime}_seconds', 'vertical_label': 'ios',
+     'format': '%3.2lf',
+     'series': [
+         graphseries('dev_writes', '{dev}_writes', None, 'AREA', '#006600'),
+         graphseries('dev_reads', '{dev}_reads', None, 'LINE', '#0000ff'),
+         graphseries('dev_cur_ios', '{dev}_cur_ios', None, 'LINE',
+                     '#ffff00')]},
+    {'source': 'blockrates', 'filename': '{dev}_iostat_ops.png',
+     'title': '{dev}_iops_for_{gtime}_seconds',
+     'vertical_label': 'IOs_per_second', 'format': '%3.2lf',
+     'series': [
+         graphseries('dev_r_s', '{dev}_r_s', None, 'AREA', '#006600',
+                     legend='r/s'),
+         graphseries('dev_w_s', '{dev}_w_s', None, 'LINE', '#0000ff',
+                     legend='w/s')]},
+    {'source': 'blockrates', 'filename': '{dev}_iostat_bytes.png',
+     'title': '{dev}_throughput_for_{gtime}_seconds',
+     'vertical_label': 'Bytes_per_second', 'format': '%3.2lf %sBytes/s',
+     'series': [
+         graphseries('dev_rkB_s', '{dev}_rkB_s', '1024,*', 'AREA', '#006600',
+                     legend='read'),
+         graphseries('dev_wkB_s', '{dev}_wkB_s', '1024,*', 'LINE', '#0000ff',
+                     legend='written')]},
+    {'source': 'blockbusy', 'filename': '{dev}_iostat_await.png',
+     'title': '{dev}_await_for_{gtime}_seconds', 'vertical_label': 'ms',
+     'format': '%3.2lf',
+     'series': [
+         graphseries('dev_r_await', '{dev}_r_await', None, 'LINE', '#ff0000',
+                     legend='r_await'),
+         graphseries('dev_w_await', '{dev}_w_await', None, 'LINE', '#0000ff',
+                     legend='w_await')]},
+    {'source': 'blockbusy', 'filename': '{dev}_iostat_util.png',
+     'title': '{dev}_utilization_for_{gtime}_seconds',
+     'vertical_label': 'Percent_and_requests', 'format': '%3.2lf',
+     'rules': [(100, '#990000', 'Max 100%')],
+     'series': [
+         graphseries('dev_util', '{dev}_util', None, 'AREA', '#12B3B5FF',
+                     legend='%util'),
+         graphseries('dev_aqu_sz', '{dev}_aqu_sz', None, 'LINE', '#FFFFFFFF',
+                     legend='aqu-sz')]},
+    {'source': 'cpuburst', 'filename': '{dev}_busy_burst.png',
+     'title': '{dev}_busy_bursts_for_{gtime}_seconds',
+     'vertical_label': 'Percent', 'format': '%3.2lf',
+     'series': [
+         graphseries('busy_max', '{dev}_busy_max', None, 'AREA', '#ff0000',
+                     legend='max'),
+         graphseries('busy_p99', '{dev}_busy_p99', None, 'AREA', '#ff8000',
+                     legend='p99'),
+         graphseries('busy_mean', '{dev}_busy_mean', None, 'AREA',
+                     '#ffff00', legend='mean'),
+         graphseries('busy_min', '{dev}_busy_min', None, 'LINE', '#00ff00',
+                     legend='min')]},
+    {'source': 'blockburst', 'filename': '{dev}_ios_burst.png',
+     'title': '{dev}_ios_in_flight_bursts_for_{gtime}_seconds',
+     'vertical_label': 'ios', 'format': '%3.2lf',
+     'series': [
+         graphseries('ios_max', '{dev}_ios_max', None, 'AREA', '#ff0000',
+                     legend='max'),
+         graphseries('ios_p99', '{dev}_ios_p99', None, 'AREA', '#ff8000',
+                     legend='p99'),
+         graphseries('ios_mean', '{dev}_ios_mean', None, 'AREA', '#ffff00',
+                     legend='mean'),
+         graphseries('ios_min', '{dev}_ios_min', None, 'LINE', '#00ff00',
+                     legend='min')]},
+    {'source': 'netburst', 'filename': '{dev}_bytes_burst.png',
+     'title': '{dev}_bursts_for_{gtime}_seconds',
+     'vertical_label': 'Bytes_per_second', 'format': '%3.2lf %sBytes/s',
+     'series': [
+         graphseries('rx_max', '{dev}_rx_max', None, 'AREA', '#339933',
+                     legend='recv_max', prints=GRAPH_PRINT_MAX),
+         graphseries('rx_p99', '{dev}_rx_p99', None, 'LINE', '#80ff00',
+                     legend='recv_p99', prints=GRAPH_PRINT_MAX),
+         graphseries('rx_mean', '{dev}_rx_mean', None, 'LINE', '#ffff00',
+                     legend='recv_mean', prints=GRAPH_PRINT_MAX),
+         graphseries('tx_max', '{dev}_tx_max', None, 'LINE', '#0000ff',
+                     legend='trans_max', prints=GRAPH_PRINT_MAX),
+         graphseries('tx_p99', '{dev}_tx_p99', None, 'LINE', '#00bfff',
+                     legend='trans_p99', prints=GRAPH_PRINT_MAX),
+         graphseries('tx_mean', '{dev}_tx_mean', None, 'LINE', '#00ffff',
+                     legend='trans_mean', prints=GRAPH_PRINT_MAX)]},
+    {'source': 'self', 'filename': 'collector_stages.png',
+     'title': 'Collector_stage_times', 'vertical_label': 'Seconds',
+     'format': '%3.3lf%s',
+     'series': [
+         graphseries('stage_read_mem', 'self_read_mem', None, 'AREA',
+                     '#ff0000', legend='read_mem', prints=GRAPH_PRINT_MAX),
+         graphseries('stage_read_loadavg', 'self_read_loadavg', None, 'AREA',
+                     '#ff8000', legend='read_loadavg', stack=True,
+                     prints=GRAPH_PRINT_MAX),
+         graphseries('stage_read_cpu', 'self_read_cpu', None, 'AREA',
+                     '#80ff00', legend='read_cpu', stack=True,
+                     prints=GRAPH_PRINT_MAX),
+         graphseries('stage_read_net', 'self_read_net', None, 'AREA',
+                     '#00ff80', legend='read_net', stack=True,
+                     prints=GRAPH_PRINT_MAX),
+         graphseries('stage_read_block', 'self_read_block', None, 'AREA',
+                     '#00ffff', legend='read_block', stack=True,
+                     prints=GRAPH_PRINT_MAX),
+         graphseries('stage_store', 'self_store', None, 'AREA', '#00bfff',
+                     legend='store', stack=True, prints=GRAPH_PRINT_MAX),
+         graphseries('stage_ship', 'self_ship', None, 'AREA', '#0040ff',
+                     legend='ship', stack=True, prints=GRAPH_PRINT_MAX),
+         graphseries('stage_graph', 'self_graph', None, 'AREA', '#ffff00',
+                     legend='graph', stack=True, prints=GRAPH_PRINT_MAX),
+         graphseries('stage_cpu_delta', 'self_cpu_delta', None, 'LINE',
+                     '#FFFFFFFF', legend='cpu_delta',
+                     prints=GRAPH_PRINT_MAX)]},
+    {'source': 'self', 'filename': 'collector_overhead.png',
+     'title': 'Collector_cpu_overhead', 'vertical_label': 'Percent',
+     'format': '%3.3lf',
+     'series': [
+         graphseries('self_cpu', 'self_cpu_pct', None, 'AREA', '#12B3B5FF',
+                     legend='Collector'),
+         graphseries('self_child', 'self_child_pct', None, 'AREA',
+                     '#6EA100FF', legend='rrdtool', stack=True)]},
+]
+
+# rrdtool arguments compiled from GRAPH_SPECS, keyed by spec filename and
+# the DS left out
+GRAPH_ARGS = {}
+
+
+# Compile a graph spec into rrdtool graph arguments
+def compilegraphspec(spec, missing=()):
+    """Return the DEF/CDEF/VDEF/draw arguments of spec as a list of str.
+
+    The arguments keep the {rrd} and {dev} placeholders, so a spec is
+    compiled once and only filled in for each graph that is rendered.
+    Series whose DS is in missing are left out along with the series
+    derived from them, as rrdtool fails the whole graph on an unknown
+    DS. A spec left without any drawn series compiles to [].
+    """
+    defs = []
+    cdefs = []
+    derived = []
+    vdefs = []
+    draws = []
+    dropped = set()
+    for series in spec['series']:
+        if series['ds'] in missing:
+            dropped.update((series['vname'], series['vname'] + '_c'))
+    drawn = False
+    for series in spec['series']:
+        if series['derive']:
+            if dropped.intersection(series['derive'].split(',')):
+                dropped.add(series['vname'])
+                continue
+            value = CDEF(vname=series['vname'], rpn=series['derive'])
+            derived.append(value)
+        elif series['vname'] in dropped:
+            continue
+        else:
+            value = DEF(rrdfile='{rrd}', vname=series['vname'],
+                        dsName=series['ds'])
+            defs.append(value)
+            if series['rpn']:
+                value = CDEF(vname=series['vname'] + '_c',
+                             rpn='%s,%s' % (value.vname, series['rpn']))
+                cdefs.append(value)
+        stats = {}
+        for function in series['prints']:
+            vdef = VDEF(vname='%s_%s' % (value.vname,
+                                         GRAPH_PRINT_LABELS[function][1]),
+                        rpn='%s,%s' % (value.vname, function))
+            stats[function] = vdef
+            vdefs.append(vdef)
+        if series['draw']:
+            drawobj = AREA if series['draw'] == 'AREA' else LINE
+            # Nothing to stack onto when the series below were left out
+            draws.append(drawobj(defObj=(stats['MAXIMUM'] if series['hrule']
+                                         else value),
+                                 color=series['color'],
+                                 legend=series['legend'],
+                                 stack=series['stack'] and drawn))
+            drawn = True
+        for function in series['prints']:
+            label = '%s:%s' % (GRAPH_PRINT_LABELS[function][0],
+                               spec['format'])
+            if function == series['prints'][-1]:
+                label += '\\l'
+            draws.append(GPRINT(stats[function], label))
+    if not drawn:
+        return []
+    for value, color, legend in spec.get('rules', []):
+        draws.append(LINE(value=value, color=color, legend=legend))
+    return [str(arg) for arg in defs + cdefs + derived + vdefs + draws]
+
+
+# Return the RRD file holding the data sources of a graph
+def graphrrd(namespace, spec, dev):
+    """With sharding, None if the index has no file for the graph."""
+    if not namespace['sharded']:
+        return namespace.get('rrdpath')
+    for series in spec['series']:
+        if series['ds']:
+            return loadrrdindex(namespace).get(
+                dsname(series['ds'].replace('{dev}', dev or '')))
+    return None
+
+
+# Fill compiled graph arguments for one device
+def graphargs(spec, rrdpath, dev, stored=None):
+    """Return the graph arguments of spec for dev, [] if nothing is left
+    to draw.
+
+    DS names are mapped through dsname(). With stored, the set of DS
+    names written for this sample, series whose DS is not in it are
+    left out, see compilegraphspec().
+    """
+    missing = []
+    renamed = []
+    for series in spec['series']:
+        if series['ds']:
+            name = series['ds'].replace('{dev}', dev or '')
+            if stored is not None and dsname(name) not in stored:
+                missing.append(series['ds'])
+            elif dsname(name) != name:
+                renamed.append((':%s:' % name, ':%s:' % dsname(name)))
+    key = (spec['filename'], tuple(missing))
+    args = GRAPH_ARGS.get(key)
+    if args is None:
+        args = compilegraphspec(spec, missing)
+        GRAPH_ARGS[key] = args
+    rrdfile = rrdpath.replace(':', '\\:')
+    args = [arg.replace('{rrd}', rrdfile).replace('{dev}', dev or '')
+            for arg in args]
+    for name, short in renamed:
+        args = [arg.replace(name, short, 1) if arg.startswith('DEF:')
+                else arg for arg in args]
+    return args
 
 
 def draw_file(namespace, memvalues, netvalues, blockvalues,
-              cpuvalues, loadavgvalues):
+              cpuvalues, loadavgvalues, selfvalues=None):
+    """Render the GRAPH_SPECS graphs for the collected devices.
+
+    Graphs that needsrender() skips are not built at all, and lines
+    whose DS this sample did not store are left out, see graphargs().
+    Returns the render timings from rendergraphs().
+    """
     gtime = namespace.get('gtime')
     ca = ColorAttributes()
     ca.back = '#333333'
@@ -453,847 +2632,912 @@ def draw_file(namespace, memvalues, netvalues, blockvalues,
     ca.frame = '#AAAAAA'
     ca.font = '#FFFFFF'
     ca.arrow = '#FFFFFF'
-    """
-    colors = ['#ff0000', '#ff4000', '#ff8000', '#ffbf00', '#ffff00', '#bfff00',
-              '#80ff00', '#40ff00', '#00ff00', '#00ff40', '#00ff80', '#00ffbf',
-              '#00ffff', '#00bfff', '#0080ff', '#0040ff', '#0000ff', '#4000ff',
-              '#8000ff', '#bf00ff', '#ff00ff', '#ff00bf', '#ff0080', '#ff0040',
-              '#ff0000']
-    lines = []
-    """
-    if memvalues:
-        ##########################
-        # Memory summary
-        ##########################
-        def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='Buffers',
-                   dsName='Buffers')
-        def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='Cached',
-                   dsName='Cached')
-        def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='Slab',
-                   dsName='Slab')
-        def4 = DEF(rrdfile=namespace.get('rrdpath'), vname='MemFree',
-                   dsName='MemFree')
-        def5 = DEF(rrdfile=namespace.get('rrdpath'), vname='MemTotal',
-                   dsName='MemTotal')
-
-        cdef1 = CDEF(vname='buffers_c', rpn='%s,1024,*' % def1.vname)
-        cdef2 = CDEF(vname='cached_c', rpn='%s,1024,*' % def2.vname)
-        cdef3 = CDEF(vname='slab_c', rpn='%s,1024,*' % def3.vname)
-        cdef4 = CDEF(vname='memfree_c', rpn='%s,1024,*' % def4.vname)
-        cdef5 = CDEF(vname='memtotal_c', rpn='%s,1024,*' % def5.vname)
-        cdef6 = CDEF(vname='mem_used',
-                     rpn='memtotal_c,memfree_c,-,slab_c,-,cached_c,-,buffers_c,-')
-
-        vdef1 = VDEF(vname='buffers_last', rpn='%s,LAST' % cdef1.vname)
-        vdef2 = VDEF(vname='cached_last', rpn='%s,LAST' % cdef2.vname)
-        vdef3 = VDEF(vname='slab_last', rpn='%s,LAST' % cdef3.vname)
-        vdef4 = VDEF(vname='memfree_last', rpn='%s,LAST' % cdef4.vname)
-        vdef6 = VDEF(vname='used_last', rpn='%s,LAST' % cdef6.vname)
-
-        vdef11 = VDEF(vname='buffers_avg', rpn='%s,AVERAGE' % cdef1.vname)
-        vdef12 = VDEF(vname='cached_avg', rpn='%s,AVERAGE' % cdef2.vname)
-        vdef13 = VDEF(vname='slab_avg', rpn='%s,AVERAGE' % cdef3.vname)
-        vdef14 = VDEF(vname='memfree_avg', rpn='%s,AVERAGE' % cdef4.vname)
-        vdef16 = VDEF(vname='used_avgg', rpn='%s,AVERAGE' % cdef6.vname)
-
-        vdef21 = VDEF(vname='buffers_min', rpn='%s,MINIMUM' % cdef1.vname)
-        vdef22 = VDEF(vname='cached_min', rpn='%s,MINIMUM' % cdef2.vname)
-        vdef23 = VDEF(vname='slab_min', rpn='%s,MINIMUM' % cdef3.vname)
-        vdef24 = VDEF(vname='memfree_min', rpn='%s,MINIMUM' % cdef4.vname)
-        vdef26 = VDEF(vname='used_min', rpn='%s,MINIMUM' % cdef6.vname)
-
-        vdef31 = VDEF(vname='buffers_max', rpn='%s,MAXIMUM' % cdef1.vname)
-        vdef32 = VDEF(vname='cached_max', rpn='%s,MAXIMUM' % cdef2.vname)
-        vdef33 = VDEF(vname='slab_max', rpn='%s,MAXIMUM' % cdef3.vname)
-        vdef34 = VDEF(vname='memfree_max', rpn='%s,MAXIMUM' % cdef4.vname)
-        vdef35 = VDEF(vname='memtotal_max', rpn='%s,MAXIMUM' % cdef5.vname)
-        vdef36 = VDEF(vname='used_max', rpn='%s,MAXIMUM' % cdef5.vname)
-
-        area1 = AREA(defObj=cdef1, color='#FFF200FF', legend='Buffers',
-                     stack=True)
-        gprint1 = GPRINT(vdef1, 'LAST:%8.2lf%s')
-        gprint11 = GPRINT(vdef11, 'AVG:%8.2lf%s')
-        gprint21 = GPRINT(vdef21, 'MIN:%8.2lf%s')
-        gprint31 = GPRINT(vdef31, 'MAX:%8.2lf%s\l')
-
-        area2 = AREA(defObj=cdef2, color='#6EA100FF', legend='Cached',
-                     stack=True)
-        gprint2 = GPRINT(vdef2, 'LAST:%8.2lf%s')
-        gprint12 = GPRINT(vdef12, 'AVG:%8.2lf%s')
-        gprint22 = GPRINT(vdef22, 'MIN:%8.2lf%s')
-        gprint32 = GPRINT(vdef32, 'MAX:%8.2lf%s\l')
-
-        area3 = AREA(defObj=cdef3, color='#1EA100FF', legend='Slab',
-                     stack=True)
-        gprint3 = GPRINT(vdef3, 'LAST:%8.2lf%s')
-        gprint13 = GPRINT(vdef13, 'AVG:%8.2lf%s')
-        gprint23 = GPRINT(vdef23, 'MIN:%8.2lf%s')
-        gprint33 = GPRINT(vdef33, 'MAX:%8.2lf%s\l')
-
-        area4 = AREA(defObj=cdef4, color='#12B3B5FF', legend='MemFree',
-                     stack=True)
-        gprint4 = GPRINT(vdef4, 'LAST:%8.2lf%s')
-        gprint14 = GPRINT(vdef14, 'AVG:%8.2lf%s')
-        gprint24 = GPRINT(vdef24, 'MIN:%8.2lf%s')
-        gprint34 = GPRINT(vdef34, 'MAX:%8.2lf%s\l')
-
-        area6 = AREA(defObj=cdef6, color='#ff0000', legend='Processes')
-        gprint6 = GPRINT(vdef6, 'LAST:%8.2lf%s')
-        gprint16 = GPRINT(vdef16, 'AVG:%8.2lf%s')
-        gprint26 = GPRINT(vdef26, 'MIN:%8.2lf%s')
-        gprint36 = GPRINT(vdef36, 'MAX:%8.2lf%s\l')
-
-        line5 = LINE(defObj=cdef5, color='#FFFFFFFF', legend='MemTotal')
-        gprint5 = GPRINT(vdef35, 'MAX:%8.2lf%s\l')
-        paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                     def2, cdef2, vdef2, vdef12, vdef22, vdef32,
-                     def3, cdef3, vdef3, vdef13, vdef23, vdef33,
-                     def4, cdef4, vdef4, vdef14, vdef24, vdef34,
-                     def5, cdef5, vdef35,
-                     cdef6, vdef6, vdef16, vdef26, vdef36,
-                     area6, gprint6, gprint16, gprint26, gprint36,
-                     area1, gprint1, gprint11, gprint21, gprint31,
-                     area2, gprint2, gprint12, gprint22, gprint32,
-                     area3, gprint3, gprint13, gprint23, gprint33,
-                     area4, gprint4, gprint14, gprint24, gprint34,
-                     line5, gprint5]
-        g = Graph(namespace.get('graphpath')+'memory_summary.png',
-                  start=(int(time.time())-gtime),
-                  end=int(time.time()),
-                  vertical_label='Memory_usage', color=ca)
-        g.data.extend(paramlist)
-        g.title = "Memory_utilization"
-        g.width = namespace.get('gwidth')
-        g.height = namespace.get('gheight')
-        g.write()
-        # #########################
-        # Memory active
-        # #########################
-        def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='Active_anon',
-                   dsName='Active_anon')
-        def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='Active_file',
-                   dsName='Active_file')
-        def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='Active',
-                   dsName='Active')
-        def4 = DEF(rrdfile=namespace.get('rrdpath'), vname='Inactive_anon',
-                   dsName='Inactive_anon')
-        def5 = DEF(rrdfile=namespace.get('rrdpath'), vname='Inactive_file',
-                   dsName='Inactive_file')
-        def6 = DEF(rrdfile=namespace.get('rrdpath'), vname='Inactive',
-                   dsName='Inactive')
-        cdef1 = CDEF(vname='active_anon_c', rpn='%s,1024,*' % def1.vname)
-        cdef2 = CDEF(vname='active_file_c', rpn='%s,1024,*' % def2.vname)
-        cdef3 = CDEF(vname='active_c', rpn='%s,1024,*' % def3.vname)
-        cdef4 = CDEF(vname='inactive_anon_c', rpn='%s,1024,*' % def4.vname)
-        cdef5 = CDEF(vname='inactive_file_c', rpn='%s,1024,*' % def5.vname)
-        cdef6 = CDEF(vname='inactive_c', rpn='%s,1024,*' % def6.vname)
-
-        vdef1 = VDEF(vname='active_anon_last', rpn='%s,LAST' % cdef1.vname)
-        vdef2 = VDEF(vname='active_file_last', rpn='%s,LAST' % cdef2.vname)
-        vdef4 = VDEF(vname='inactive_anon_last', rpn='%s,LAST' % cdef4.vname)
-        vdef5 = VDEF(vname='inactive_file_last', rpn='%s,LAST' % cdef5.vname)
-
-        vdef11 = VDEF(vname='active_anon_avg', rpn='%s,AVERAGE' % cdef1.vname)
-        vdef12 = VDEF(vname='active_file_avg', rpn='%s,AVERAGE' % cdef2.vname)
-        vdef14 = VDEF(vname='inactive_anon_avg', rpn='%s,AVERAGE' % cdef4.vname)
-        vdef15 = VDEF(vname='inactive_file_avg', rpn='%s,AVERAGE' % cdef5.vname)
-
-        vdef21 = VDEF(vname='active_anon_min', rpn='%s,MINIMUM' % cdef1.vname)
-        vdef22 = VDEF(vname='active_file_min', rpn='%s,MINIMUM' % cdef2.vname)
-        vdef24 = VDEF(vname='inactive_anon_min', rpn='%s,MINIMUM' % cdef4.vname)
-        vdef25 = VDEF(vname='inactive_file_min', rpn='%s,MINIMUM' % cdef5.vname)
-
-        vdef31 = VDEF(vname='active_anon_max', rpn='%s,MAXIMUM' % cdef1.vname)
-        vdef32 = VDEF(vname='active_file_max', rpn='%s,MAXIMUM' % cdef2.vname)
-        vdef33 = VDEF(vname='active_max', rpn='%s,MAXIMUM' % cdef3.vname)
-        vdef34 = VDEF(vname='inactive_anon_max', rpn='%s,MAXIMUM' % cdef4.vname)
-        vdef35 = VDEF(vname='inactive_file_max', rpn='%s,MAXIMUM' % cdef5.vname)
-        vdef36 = VDEF(vname='inactive_max', rpn='%s,MAXIMUM' % cdef6.vname)
-
-        area1 = AREA(defObj=cdef1, color='#006600', legend='Active_anon')
-        gprint1 = GPRINT(vdef1, 'LAST:%8.2lf%s')
-        gprint11 = GPRINT(vdef11, 'AVG:%8.2lf%s')
-        gprint21 = GPRINT(vdef21, 'MIN:%8.2lf%s')
-        gprint31 = GPRINT(vdef31, 'MAX:%8.2lf%s\l')
-
-        area2 = AREA(defObj=cdef2, color='#00cc99', legend='Active_file',
-                     stack=True)
-        gprint2 = GPRINT(vdef2, 'LAST:%8.2lf%s')
-        gprint12 = GPRINT(vdef12, 'AVG:%8.2lf%s')
-        gprint22 = GPRINT(vdef22, 'MIN:%8.2lf%s')
-        gprint32 = GPRINT(vdef32, 'MAX:%8.2lf%s\l')
-
-        line3 = LINE(defObj=vdef33, color='#FFFFFFFF', legend='Active')
-        gprint3 = GPRINT(vdef33, 'MAX:%8.2lf%s\l')
-
-        area4 = AREA(defObj=cdef4, color='#000099', legend='Inactive_anon',
-                     stack=True)
-        gprint4 = GPRINT(vdef4, 'LAST:%8.2lf%s')
-        gprint14 = GPRINT(vdef14, 'AVG:%8.2lf%s')
-        gprint24 = GPRINT(vdef24, 'MIN:%8.2lf%s')
-        gprint34 = GPRINT(vdef34, 'MAX:%8.2lf%s\l')
-
-        area5 = AREA(defObj=cdef5, color='#0066ff', legend='Inactive_file',
-                     stack=True)
-        gprint5 = GPRINT(vdef5, 'LAST:%8.2lf%s')
-        gprint15 = GPRINT(vdef15, 'AVG:%8.2lf%s')
-        gprint25 = GPRINT(vdef25, 'MIN:%8.2lf%s')
-        gprint35 = GPRINT(vdef35, 'MAX:%8.2lf%s\l')
-
-        gprint6 = GPRINT(vdef36, 'MAX:%8.2lf%s\l')
-
-        paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                     def2, cdef2, vdef2, vdef12, vdef22, vdef32,
-                     def3, cdef3, vdef33,
-                     def4, cdef4, vdef4, vdef14, vdef24, vdef34,
-                     def5, cdef5, vdef5, vdef15, vdef25, vdef35,
-                     def6, cdef6, vdef36,
-                     area1, gprint1, gprint11, gprint21, gprint31,
-                     area2, gprint2, gprint12, gprint22, gprint32,
-                     line3, gprint3,
-                     area4, gprint4, gprint14, gprint24, gprint34,
-                     area5, gprint5, gprint15, gprint25, gprint35,
-                     gprint6]
-        g = Graph(namespace.get('graphpath')+'memory_active.png',
-                  start=(int(time.time())-gtime),
-                  end=int(time.time()),
-                  vertical_label='Memory_usage', color=ca)
-        g.data.extend(paramlist)
-        g.title = "Memory_active"
-        g.width = namespace.get('gwidth')
-        g.height = namespace.get('gheight')
-        g.write()
-        # #########################
-        # Memory swap
-        # #########################
-        def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='SwapFree',
-                   dsName='SwapFree')
-        def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='SwapTotal',
-                   dsName='SwapTotal')
-        cdef1 = CDEF(vname='swap_free_c', rpn='%s,1024,*' % def1.vname)
-        cdef2 = CDEF(vname='swap_total_c', rpn='%s,1024,*' % def2.vname)
-
-        vdef1 = VDEF(vname='swap_free_last', rpn='%s,LAST' % cdef1.vname)
-        vdef11 = VDEF(vname='swap_free_avg', rpn='%s,AVERAGE' % cdef1.vname)
-        vdef21 = VDEF(vname='swap_free_min', rpn='%s,MINIMUM' % cdef1.vname)
-        vdef31 = VDEF(vname='swap_free_max', rpn='%s,MAXIMUM' % cdef1.vname)
-        vdef32 = VDEF(vname='swap_total_max', rpn='%s,MAXIMUM' % cdef2.vname)
-
-        area1 = AREA(defObj=cdef1, color='#006600', legend='Swap_Free')
-        gprint1 = GPRINT(vdef1, 'LAST:%8.2lf%s')
-        gprint11 = GPRINT(vdef11, 'AVG:%8.2lf%s')
-        gprint21 = GPRINT(vdef21, 'MIN:%8.2lf%s')
-        gprint31 = GPRINT(vdef31, 'MAX:%8.2lf%s\l')
-
-        line2 = LINE(defObj=vdef32, color='#FFFFFFFF', legend='Memory_Total')
-        gprint2 = GPRINT(vdef31, 'MAX:%8.2lf%s\l')
-        paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                     def2, cdef2, vdef32,
-                     area1, gprint1, gprint11, gprint21, gprint31,
-                     line2, gprint31]
-
-        g = Graph(namespace.get('graphpath')+'memory_swap.png',
-                  start=(int(time.time())-gtime),
-                  end=int(time.time()),
-                  vertical_label='Memory_usage', color=ca)
-        g.data.extend(paramlist)
-        g.title = "Memory_swap"
-        g.width = namespace.get('gwidth')
-        g.height = namespace.get('gheight')
-        g.write()
-        # #########################
-        # Memory pages
-        # #########################
-        def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='Dirty',
-                   dsName='Dirty')
-        def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='AnonPages',
-                   dsName='AnonPages')
-        def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='HugePages_Free',
-                   dsName='HugePages_Free')
-        def4 = DEF(rrdfile=namespace.get('rrdpath'), vname='HugePages_Total',
-                   dsName='HugePages_Total')
-
-        cdef1 = CDEF(vname='dirty_c', rpn='%s,1024,*' % def1.vname)
-        cdef2 = CDEF(vname='anonpages_c', rpn='%s,1024,*' % def2.vname)
-        cdef3 = CDEF(vname='hugepages_free_c', rpn='%s,1024,*' % def3.vname)
-        cdef4 = CDEF(vname='hugepages_total_c', rpn='%s,1024,*' % def4.vname)
-
-        vdef1 = VDEF(vname='dirty_last', rpn='%s,LAST' % cdef1.vname)
-        vdef2 = VDEF(vname='anonpages_last', rpn='%s,LAST' % cdef2.vname)
-        vdef3 = VDEF(vname='hugepages_free_last', rpn='%s,LAST' % cdef3.vname)
-
-        vdef11 = VDEF(vname='dirty_avg', rpn='%s,AVERAGE' % cdef1.vname)
-        vdef12 = VDEF(vname='anonpages_avg', rpn='%s,AVERAGE' % cdef2.vname)
-        vdef13 = VDEF(vname='hugepages_free_avg', rpn='%s,AVERAGE' % cdef3.vname)
-
-        vdef21 = VDEF(vname='dirty_min', rpn='%s,MINIMUM' % cdef1.vname)
-        vdef22 = VDEF(vname='anonpages_min', rpn='%s,MINIMUM' % cdef2.vname)
-        vdef23 = VDEF(vname='hugepages_free_min', rpn='%s,MINIMUM' % cdef3.vname)
-
-        vdef31 = VDEF(vname='dirty_max', rpn='%s,MAXIMUM' % cdef1.vname)
-        vdef32 = VDEF(vname='anonpages_max', rpn='%s,MAXIMUM' % cdef2.vname)
-        vdef33 = VDEF(vname='hugepages_free_max', rpn='%s,MAXIMUM' % cdef3.vname)
-        vdef34 = VDEF(vname='hugepages_total_max', rpn='%s,MAXIMUM' % cdef4.vname)
-
-        area1 = AREA(defObj=cdef1, color='#FFF200FF', legend='Dirty',
-                     stack=True)
-        gprint1 = GPRINT(vdef1, 'LAST:%8.2lf%s')
-        gprint11 = GPRINT(vdef11, 'AVG:%8.2lf%s')
-        gprint21 = GPRINT(vdef21, 'MIN:%8.2lf%s')
-        gprint31 = GPRINT(vdef31, 'MAX:%8.2lf%s\l')
-
-        area2 = AREA(defObj=cdef2, color='#6EA100FF', legend='AnonPages',
-                     stack=True)
-        gprint2 = GPRINT(vdef2, 'LAST:%8.2lf%s')
-        gprint12 = GPRINT(vdef12, 'AVG:%8.2lf%s')
-        gprint22 = GPRINT(vdef22, 'MIN:%8.2lf%s')
-        gprint32 = GPRINT(vdef32, 'MAX:%8.2lf%s\l')
-
-        area3 = AREA(defObj=cdef3, color='#12B3B5FF', legend='HugePages_Free',
-                     stack=True)
-        gprint3 = GPRINT(vdef3, 'LAST:%8.2lf%s')
-        gprint13 = GPRINT(vdef13, 'AVG:%8.2lf%s')
-        gprint23 = GPRINT(vdef23, 'MIN:%8.2lf%s')
-        gprint33 = GPRINT(vdef33, 'MAX:%8.2lf%s\l')
-
-        line4 = LINE(defObj=vdef34, color='#FFFFFFFF', legend='HugePages_Total')
-        gprint4 = GPRINT(vdef34, 'MAX:%8.2lf%s\l')
-
-        paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                     def2, cdef2, vdef2, vdef12, vdef22, vdef32,
-                     def3, cdef3, vdef3, vdef13, vdef23, vdef33,
-                     def4, cdef4, vdef34,
-                     area1, gprint1, gprint11, gprint21, gprint31,
-                     area2, gprint2, gprint12, gprint22, gprint32,
-                     area3, gprint3, gprint13, gprint23, gprint33,
-                     line4, gprint4]
-
-        g = Graph(namespace.get('graphpath')+'memory_pages.png',
-                  start=(int(time.time())-gtime),
-                  end=int(time.time()),
-                  vertical_label='Memory_usage', color=ca)
-        g.data.extend(paramlist)
-        g.title = "Memory_Pages"
-        g.width = namespace.get('gwidth')
-        g.height = namespace.get('gheight')
-        g.write()
-
-    if cpuvalues:
-        ######################
-        # CPU LOAD AVERAGE
-        # ####################
-        def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='loadavg1min',
-                   dsName='loadavg1min')
-        def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='loadavg5min',
-                   dsName='loadavg5min')
-        def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='loadavg15min',
-                   dsName='loadavg15min')
-
-        cdef1 = CDEF(vname='loadavg1min_c', rpn='%s,1,*' % def1.vname)
-        cdef2 = CDEF(vname='loadavg5min_c', rpn='%s,1,*' % def2.vname)
-        cdef3 = CDEF(vname='loadavg15min_c', rpn='%s,1,*' % def3.vname)
-
-        vdef1 = VDEF(vname='loadavg1min_last', rpn='%s,LAST' % cdef1.vname)
-        vdef2 = VDEF(vname='loadavg5min_last', rpn='%s,LAST' % cdef2.vname)
-        vdef3 = VDEF(vname='loadavg15min_last', rpn='%s,LAST' % cdef3.vname)
-
-        vdef11 = VDEF(vname='loadavg1min_avg', rpn='%s,AVERAGE' % cdef1.vname)
-        vdef12 = VDEF(vname='loadavg5min_avg', rpn='%s,AVERAGE' % cdef2.vname)
-        vdef13 = VDEF(vname='loadavg15min_avg', rpn='%s,AVERAGE' % cdef3.vname)
-
-        vdef21 = VDEF(vname='loadavg1min_min', rpn='%s,MINIMUM' % cdef1.vname)
-        vdef22 = VDEF(vname='loadavg5min_min', rpn='%s,MINIMUM' % cdef2.vname)
-        vdef23 = VDEF(vname='loadavg15min_min', rpn='%s,MINIMUM' % cdef3.vname)
-
-        vdef31 = VDEF(vname='loadavg1min_max', rpn='%s,MAXIMUM' % cdef1.vname)
-        vdef32 = VDEF(vname='loadavg5min_max', rpn='%s,MAXIMUM' % cdef2.vname)
-        vdef33 = VDEF(vname='loadavg15min_max', rpn='%s,MAXIMUM' % cdef3.vname)
-
-        constline1 = LINE(value=100, color='#990000', legend='Max 100%')
-        line1 = LINE(defObj=cdef1, color='#FFFFFFFF', legend='Load AVG 1 Min')
-        gprint1 = GPRINT(vdef1, 'LAST:%3.2lf')
-        gprint11 = GPRINT(vdef11, 'AVG:%3.2lf')
-        gprint21 = GPRINT(vdef21, 'MIN:%3.2lf')
-        gprint31 = GPRINT(vdef31, 'MAX:%3.2lf\l')
-
-        line2 = LINE(defObj=cdef2, color='#6EA100FF', legend='Load AVG 5 Min')
-        gprint2 = GPRINT(vdef2, 'LAST:%3.2lf')
-        gprint12 = GPRINT(vdef12, 'AVG:%3.2lf')
-        gprint22 = GPRINT(vdef22, 'MIN:%3.2lf')
-        gprint32 = GPRINT(vdef32, 'MAX:%3.2lf\l')
-
-        area3 = AREA(defObj=cdef3, color='#12B3B5FF', legend='Load AVG 15 Min',
-                     stack=True)
-        gprint3 = GPRINT(vdef3, 'LAST:%3.2lf')
-        gprint13 = GPRINT(vdef13, 'AVG:%3.2lf')
-        gprint23 = GPRINT(vdef23, 'MIN:%3.2lf')
-        gprint33 = GPRINT(vdef33, 'MAX:%3.2lf\l')
-
-        paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                     def2, cdef2, vdef2, vdef12, vdef22, vdef32,
-                     def3, cdef3, vdef3, vdef13, vdef23, vdef33,
-                     area3, gprint3, gprint13, gprint23, gprint33,
-                     line2, gprint2, gprint12, gprint22, gprint32,
-                     line1, gprint1, gprint11, gprint21, gprint31,
-                     constline1]
-
-        g = Graph(namespace.get('graphpath')+'cpu_loadavg.png',
-                  start=(int(time.time())-gtime),
-                  end=int(time.time()),
-                  vertical_label='CPU_utilization', color=ca)
-        g.data.extend(paramlist)
-        g.title = "Load_Average"
-        g.width = namespace.get('gwidth')
-        g.height = namespace.get('gheight')
-        g.write()
-        for cpu in cpuvalues.itervalues():
-            ################################
-            # CPU Utilization for each cpu
-            # #############################
-            cn = cpu.get('name')
-            def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_system',
-                       dsName='%s_system' % cn)
-            def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_user',
-                       dsName='%s_user' % cn)
-            def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_idle',
-                       dsName='%s_idle' % cn)
-            def4 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_iowait',
-                       dsName='%s_iowait' % cn)
-            def5 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_irq',
-                       dsName='%s_irq' % cn)
-            def6 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_softirq',
-                       dsName='%s_softirq' % cn)
-            def7 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_nice',
-                       dsName='%s_nice' % cn)
-            def8 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_steal',
-                       dsName='%s_steal' % cn)
-            def9 = DEF(rrdfile=namespace.get('rrdpath'), vname='cpu_guest',
-                       dsName='%s_guest' % cn)
-
-            vdef1 = VDEF(vname='cpu_system_last', rpn='%s,LAST' % def1.vname)
-            vdef2 = VDEF(vname='cpu_user_last', rpn='%s,LAST' % def2.vname)
-            vdef3 = VDEF(vname='cpu_idle_last', rpn='%s,LAST' % def3.vname)
-            vdef4 = VDEF(vname='cpu_iowait_last', rpn='%s,LAST' % def4.vname)
-            vdef5 = VDEF(vname='cpu_irq_last', rpn='%s,LAST' % def5.vname)
-            vdef6 = VDEF(vname='cpu_softirq_last', rpn='%s,LAST' % def6.vname)
-            vdef7 = VDEF(vname='cpu_nice_last', rpn='%s,LAST' % def7.vname)
-            vdef8 = VDEF(vname='cpu_steal_last', rpn='%s,LAST' % def8.vname)
-            vdef9 = VDEF(vname='cpu_guest_last', rpn='%s,LAST' % def9.vname)
-
-            vdef11 = VDEF(vname='cpu_system_avg', rpn='%s,AVERAGE' % def1.vname)
-            vdef12 = VDEF(vname='cpu_user_avg', rpn='%s,AVERAGE' % def2.vname)
-            vdef13 = VDEF(vname='cpu_idle_avg', rpn='%s,AVERAGE' % def3.vname)
-            vdef14 = VDEF(vname='cpu_iowait_avg', rpn='%s,AVERAGE' % def4.vname)
-            vdef15 = VDEF(vname='cpu_irq_avg', rpn='%s,AVERAGE' % def5.vname)
-            vdef16 = VDEF(vname='cpu_softirq_avg', rpn='%s,AVERAGE' % def6.vname)
-            vdef17 = VDEF(vname='cpu_nice_avg', rpn='%s,AVERAGE' % def7.vname)
-            vdef18 = VDEF(vname='cpu_steal_avg', rpn='%s,AVERAGE' % def8.vname)
-            vdef19 = VDEF(vname='cpu_guest_avg', rpn='%s,AVERAGE' % def9.vname)
-
-            vdef21 = VDEF(vname='cpu_system_min', rpn='%s,MINIMUM' % def1.vname)
-            vdef22 = VDEF(vname='cpu_user_min', rpn='%s,MINIMUM' % def2.vname)
-            vdef23 = VDEF(vname='cpu_idle_min', rpn='%s,MINIMUM' % def3.vname)
-            vdef24 = VDEF(vname='cpu_iowait_min', rpn='%s,MINIMUM' % def4.vname)
-            vdef25 = VDEF(vname='cpu_irq_min', rpn='%s,MINIMUM' % def5.vname)
-            vdef26 = VDEF(vname='cpu_softirq_min', rpn='%s,MINIMUM' % def6.vname)
-            vdef27 = VDEF(vname='cpu_nice_min', rpn='%s,MINIMUM' % def7.vname)
-            vdef28 = VDEF(vname='cpu_steal_min', rpn='%s,MINIMUM' % def8.vname)
-            vdef29 = VDEF(vname='cpu_guest_min', rpn='%s,MINIMUM' % def9.vname)
-
-            vdef31 = VDEF(vname='cpu_system_max', rpn='%s,MAXIMUM' % def1.vname)
-            vdef32 = VDEF(vname='cpu_user_max', rpn='%s,MAXIMUM' % def2.vname)
-            vdef33 = VDEF(vname='cpu_idle_max', rpn='%s,MAXIMUM' % def3.vname)
-            vdef34 = VDEF(vname='cpu_iowait_max', rpn='%s,MAXIMUM' % def4.vname)
-            vdef35 = VDEF(vname='cpu_irq_max', rpn='%s,MAXIMUM' % def5.vname)
-            vdef36 = VDEF(vname='cpu_softirq_max', rpn='%s,MAXIMUM' % def6.vname)
-            vdef37 = VDEF(vname='cpu_nice_max', rpn='%s,MAXIMUM' % def7.vname)
-            vdef38 = VDEF(vname='cpu_steal_max', rpn='%s,MAXIMUM' % def8.vname)
-            vdef39 = VDEF(vname='cpu_guest_max', rpn='%s,MAXIMUM' % def9.vname)
-
-            area1 = AREA(defObj=def1, color='#ff0000', legend=def1.vname)
-            gprint1 = GPRINT(vdef1, 'LAST:%3.2lf')
-            gprint11 = GPRINT(vdef11, 'AVG:%3.2lf')
-            gprint21 = GPRINT(vdef21, 'MIN:%3.2lf')
-            gprint31 = GPRINT(vdef31, 'MAX:%3.2lf\l')
-
-            area2 = AREA(defObj=def2, color='#ff8000', legend=def2.vname,
-                         stack=True)
-            gprint2 = GPRINT(vdef2, 'LAST:%3.2lf')
-            gprint12 = GPRINT(vdef12, 'AVG:%3.2lf')
-            gprint22 = GPRINT(vdef22, 'MIN:%3.2lf')
-            gprint32 = GPRINT(vdef32, 'MAX:%3.2lf\l')
-
-            area3 = AREA(defObj=def3, color='#ffff00', legend=def3.vname,
-                         stack=True)
-            gprint3 = GPRINT(vdef3, 'LAST:%3.2lf')
-            gprint13 = GPRINT(vdef13, 'AVG:%3.2lf')
-            gprint23 = GPRINT(vdef23, 'MIN:%3.2lf')
-            gprint33 = GPRINT(vdef33, 'MAX:%3.2lf\l')
-
-            area4 = AREA(defObj=def4, color='#80ff00', legend=def4.vname,
-                         stack=True)
-            gprint4 = GPRINT(vdef4, 'LAST:%3.2lf')
-            gprint14 = GPRINT(vdef14, 'AVG:%3.2lf')
-            gprint24 = GPRINT(vdef24, 'MIN:%3.2lf')
-            gprint34 = GPRINT(vdef34, 'MAX:%3.2lf\l')
-
-            area5 = AREA(defObj=def5, color='#00ff00', legend=def5.vname,
-                         stack=True)
-            gprint5 = GPRINT(vdef5, 'LAST:%3.2lf')
-            gprint15 = GPRINT(vdef15, 'AVG:%3.2lf')
-            gprint25 = GPRINT(vdef25, 'MIN:%3.2lf')
-            gprint35 = GPRINT(vdef35, 'MAX:%3.2lf\l')
-
-            area6 = AREA(defObj=def6, color='#00ff80', legend=def6.vname,
-                         stack=True)
-            gprint6 = GPRINT(vdef6, 'LAST:%3.2lf')
-            gprint16 = GPRINT(vdef16, 'AVG:%3.2lf')
-            gprint26 = GPRINT(vdef26, 'MIN:%3.2lf')
-            gprint36 = GPRINT(vdef36, 'MAX:%3.2lf\l')
-
-            area7 = AREA(defObj=def7, color='#00ffff', legend=def7.vname,
-                         stack=True)
-            gprint7 = GPRINT(vdef7, 'LAST:%3.2lf')
-            gprint17 = GPRINT(vdef17, 'AVG:%3.2lf')
-            gprint27 = GPRINT(vdef27, 'MIN:%3.2lf')
-            gprint37 = GPRINT(vdef37, 'MAX:%3.2lf\l')
-
-            area8 = AREA(defObj=def8, color='#00bfff', legend=def8.vname,
-                         stack=True)
-            gprint8 = GPRINT(vdef8, 'LAST:%3.2lf')
-            gprint18 = GPRINT(vdef18, 'AVG:%3.2lf')
-            gprint28 = GPRINT(vdef28, 'MIN:%3.2lf')
-            gprint38 = GPRINT(vdef38, 'MAX:%3.2lf\l')
-
-            area9 = AREA(defObj=def9, color='#0040ff', legend=def9.vname,
-                         stack=True)
-            gprint9 = GPRINT(vdef9, 'LAST:%3.2lf')
-            gprint19 = GPRINT(vdef19, 'AVG:%3.2lf')
-            gprint29 = GPRINT(vdef29, 'MIN:%3.2lf')
-            gprint39 = GPRINT(vdef39, 'MAX:%3.2lf\l')
-
-            paramlist = [def1, vdef1, vdef11, vdef21, vdef31,
-                         def2, vdef2, vdef12, vdef22, vdef32,
-                         def3, vdef3, vdef13, vdef23, vdef33,
-                         def4, vdef4, vdef14, vdef24, vdef34,
-                         def5, vdef5, vdef15, vdef25, vdef35,
-                         def6, vdef6, vdef16, vdef26, vdef36,
-                         def7, vdef7, vdef17, vdef27, vdef37,
-                         def8, vdef8, vdef18, vdef28, vdef38,
-                         def9, vdef9, vdef19, vdef29, vdef39,
-                         area1, gprint1, gprint11, gprint21, gprint31,
-                         area2, gprint2, gprint12, gprint22, gprint32,
-                         area4, gprint4, gprint14, gprint24, gprint34,
-                         area5, gprint5, gprint15, gprint25, gprint33,
-                         area6, gprint6, gprint16, gprint26, gprint33,
-                         area7, gprint7, gprint17, gprint27, gprint37,
-                         area8, gprint8, gprint18, gprint28, gprint38,
-                         area9, gprint9, gprint19, gprint29, gprint39,
-                         area3, gprint3, gprint13, gprint23, gprint33,
-                         ]
-            g = Graph(namespace.get('graphpath')+'%s_util.png' % cn,
-                      start=(int(time.time())-gtime),
-                      end=int(time.time()),
-                      vertical_label='Load', color=ca)
-            g.data.extend(paramlist)
-            g.title = "%s_utilizaton_for_%s_seconds" % (cn, gtime)
-            g.width = namespace.get('gwidth')
-            g.height = namespace.get('gheight')
-            g.write()
-    if netvalues:
-        for interface in netvalues.items():
-            ##################################
-            # INTERFACE BYTES
-            # ################################
-            ifname = interface[0].strip(' ')
-            def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='if_recv_bytes',
-                       dsName='%s_recv_bytes' % ifname)
-            def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='if_trans_bytes',
-                       dsName='%s_trans_bytes' % ifname)
-            cdef1 = CDEF(vname='if_recv_bytes_c', rpn='%s,1000000,/' % def1.vname)
-            cdef2 = CDEF(vname='if_trans_bytes_c', rpn='%s,1000000,/' % def2.vname)
-
-            vdef31 = VDEF(vname='if_recv_bytes_max', rpn='%s,MAXIMUM' % cdef1.vname)
-            vdef32 = VDEF(vname='if_trans_bytes_max', rpn='%s,MAXIMUM' % cdef2.vname)
-
-            area1 = AREA(defObj=def1, color='#339933', legend=def1.vname)
-            gprint31 = GPRINT(vdef31, 'Total:%3.2lf MBytes\l')
-
-            line2 = LINE(defObj=def2, color='#0000ff', legend=def2.vname)
-            gprint32 = GPRINT(vdef32, 'Total:%3.2lf MBytes\l')
-
-            paramlist = [def1, cdef1, vdef31,
-                         def2, cdef2, vdef32,
-                         area1, gprint31,
-                         line2, gprint32,
-                         ]
-            g = Graph(namespace.get('graphpath')+'%s_bytes.png' % ifname,
-                      start=(int(time.time())-gtime),
-                      end=int(time.time()),
-                      vertical_label='Traffic,Bytes', color=ca)
-            g.data.extend(paramlist)
-            g.title = "%s_utilizaton_for_%s_seconds" % (ifname, gtime)
-            g.width = namespace.get('gwidth')
-            g.height = namespace.get('gheight')
-            g.write()
-            ######################################
-            # INTERFACE PACKETS
-            #####################################
-            def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='if_recv_packets',
-                       dsName='%s_recv_packets' % ifname)
-            def4 = DEF(rrdfile=namespace.get('rrdpath'), vname='if_trans_packets',
-                       dsName='%s_trans_packets' % ifname)
-            def5 = DEF(rrdfile=namespace.get('rrdpath'), vname='if_recv_errs',
-                       dsName='%s_recv_errs' % ifname)
-            def6 = DEF(rrdfile=namespace.get('rrdpath'), vname='if_trans_errs',
-                       dsName='%s_trans_errs' % ifname)
-            vdef3 = VDEF(vname='if_recv_packets_last', rpn='%s,LAST' % def3.vname)
-            vdef4 = VDEF(vname='if_trans_packets_last', rpn='%s,LAST' % def4.vname)
-            vdef5 = VDEF(vname='if_recv_errs_last', rpn='%s,LAST' % def5.vname)
-            vdef6 = VDEF(vname='if_trans_errs_last', rpn='%s,LAST' % def6.vname)
-            vdef13 = VDEF(vname='if_recv_packets_avg', rpn='%s,AVERAGE' % def3.vname)
-            vdef14 = VDEF(vname='if_trans_packets_avg', rpn='%s,AVERAGE' % def4.vname)
-            vdef15 = VDEF(vname='if_recv_errs_avg', rpn='%s,AVERAGE' % def5.vname)
-            vdef16 = VDEF(vname='if_trans_errs_avg', rpn='%s,AVERAGE' % def6.vname)
-
-            vdef23 = VDEF(vname='if_recv_packets_min', rpn='%s,MINIMUM' % def3.vname)
-            vdef24 = VDEF(vname='if_trans_packets_min', rpn='%s,MINIMUM' % def4.vname)
-            vdef25 = VDEF(vname='if_recv_errs_min', rpn='%s,MINIMUM' % def5.vname)
-            vdef26 = VDEF(vname='if_trans_errs_min', rpn='%s,MINIMUM' % def6.vname)
-
-            vdef33 = VDEF(vname='if_recv_packets_max', rpn='%s,MAXIMUM' % def3.vname)
-            vdef34 = VDEF(vname='if_trans_packets_max', rpn='%s,MAXIMUM' % def4.vname)
-            vdef35 = VDEF(vname='if_recv_errs_max', rpn='%s,MAXIMUM' % def5.vname)
-            vdef36 = VDEF(vname='if_trans_errs_max', rpn='%s,MAXIMUM' % def6.vname)
-
-            area3 = AREA(defObj=def3, color='#006600', legend=def3.vname)
-            gprint3 = GPRINT(vdef3, 'LAST:%3.2lf')
-            gprint13 = GPRINT(vdef13, 'AVG:%3.2lf')
-            gprint23 = GPRINT(vdef23, 'MIN:%3.2lf')
-            gprint33 = GPRINT(vdef33, 'MAX:%3.2lf\l')
-
-            line4 = LINE(defObj=def4, color='#0000ff', legend=def4.vname)
-            gprint4 = GPRINT(vdef4, 'LAST:%3.2lf')
-            gprint14 = GPRINT(vdef14, 'AVG:%3.2lf')
-            gprint24 = GPRINT(vdef24, 'MIN:%3.2lf')
-            gprint34 = GPRINT(vdef34, 'MAX:%3.2lf\l')
-
-            line5 = LINE(defObj=def5, color='#ffff00', legend=def5.vname)
-            gprint5 = GPRINT(vdef5, 'LAST:%3.2lf')
-            gprint15 = GPRINT(vdef15, 'AVG:%3.2lf')
-            gprint25 = GPRINT(vdef25, 'MIN:%3.2lf')
-            gprint35 = GPRINT(vdef35, 'MAX:%3.2lf\l')
-
-            line6 = LINE(defObj=def6, color='#ff0000', legend=def6.vname)
-            gprint6 = GPRINT(vdef6, 'LAST:%3.2lf')
-            gprint16 = GPRINT(vdef16, 'AVG:%3.2lf')
-            gprint26 = GPRINT(vdef26, 'MIN:%3.2lf')
-            gprint36 = GPRINT(vdef36, 'MAX:%3.2lf\l')
-
-            paramlist = [def3, vdef3, vdef13, vdef23, vdef33,
-                         def4, vdef4, vdef14, vdef24, vdef34,
-                         def5, vdef5, vdef15, vdef25, vdef35,
-                         def6, vdef6, vdef16, vdef26, vdef36,
-                         area3, gprint3, gprint13, gprint23, gprint33,
-                         line4, gprint4, gprint14, gprint24, gprint34,
-                         line5, gprint5, gprint15, gprint25, gprint33,
-                         line6, gprint6, gprint16, gprint26, gprint33,
-                         ]
-            g = Graph(namespace.get('graphpath')+'%s_packets.png' % ifname,
-                      start=(int(time.time())-gtime),
-                      end=int(time.time()),
-                      vertical_label='Packets_per_second', color=ca)
-            g.data.extend(paramlist)
-            g.title = "%s_packets_for_%s_seconds" % (ifname, gtime)
+    devices = {'memory': [None] if memvalues else [],
+               'loadavg': [None] if cpuvalues else [],
+               'cpu': sorted(cpuvalues),
+               'net': sorted(interface.strip(' ') for interface in netvalues),
+               'block': sorted(dev.strip(' ') for dev in blockvalues),
+               'cpuburst': sorted(cpu for cpu in cpuvalues
+                                  if 'busy_max' in cpuvalues[cpu]),
+               'netburst': sorted(interface.strip(' ')
+                                  for interface in netvalues
+                                  if 'rx_max' in netvalues[interface]),
+               'blockrates': sorted(dev.strip(' ') for dev in blockvalues
+                                    if 'r_s' in blockvalues[dev]),
+               'blockbusy': sorted(dev.strip(' ') for dev in blockvalues
+                                   if 'util' in blockvalues[dev]),
+               'blockburst': sorted(dev.strip(' ') for dev in blockvalues
+                                    if 'ios_max' in blockvalues[dev]),
+               'self': [None] if selfvalues else []}
+    stored = frozenset(updateplan(memvalues, netvalues, blockvalues,
+                                  cpuvalues, loadavgvalues, selfvalues,
+                                  namespace.get('rrdpath'))['names'])
+    end = int(time.time())
+    jobs = []
+    for spec in GRAPH_SPECS:
+        for dev in devices[spec['source']]:
+            filename = namespace.get('graphpath') + \
+                spec['filename'].format(dev=dev)
+            if not needsrender(namespace, filename):
+                if namespace['verbose']:
+                    print "-----Skipping unchanged graph: %s ---------" % \
+                        filename
+                continue
+            rrdfile = graphrrd(namespace, spec, dev)
+            if rrdfile is None:
+                print "Error: no RRD file in the index for graph %s" % \
+                    filename
+                continue
+            args = graphargs(spec, rrdfile, dev, stored)
+            if not args:
+                continue
+            g = Graph(filename, start=(end-gtime), end=end,
+                      vertical_label=spec['vertical_label'], color=ca,
+                      backend=RRD_BACKEND)
+            g.data.extend(args)
+            g.title = spec['title'].format(dev=dev, gtime=gtime)
             g.width = namespace.get('gwidth')
             g.height = namespace.get('gheight')
-            g.write()
+            jobs.append(g)
+    return rendergraphs(namespace, jobs)
 
-    if blockvalues:
-        for blockdevice in blockvalues.items():
-            ######################
-            # BLOCK DEVICE MS
-            # ####################
-            devname = blockdevice[0].strip(' ')
-            def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_ms_doing_io',
-                       dsName='%s_ms_doing_io' % devname)
-            def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_ms_writing',
-                       dsName='%s_ms_writing' % devname)
-            def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_ms_weighted',
-                       dsName='%s_ms_weighted' % devname)
-            def4 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_ms_reading',
-                       dsName='%s_ms_reading' % devname)
-
-            cdef1 = CDEF(vname='dev_ms_doing_io_c', rpn='%s,1,/' % def1.vname)
-            cdef2 = CDEF(vname='dev_ms_writing_c', rpn='%s,1,/' % def2.vname)
-            cdef3 = CDEF(vname='dev_ms_weighted_c', rpn='%s,1,/' % def3.vname)
-            cdef4 = CDEF(vname='dev_ms_reading_c', rpn='%s,1,/' % def4.vname)
-
-            vdef1 = VDEF(vname='dev_ms_doing_io_last', rpn='%s,LAST' % cdef1.vname)
-            vdef2 = VDEF(vname='dev_ms_writing_last', rpn='%s,LAST' % cdef2.vname)
-            vdef3 = VDEF(vname='dev_ms_weighted_last', rpn='%s,LAST' % cdef3.vname)
-            vdef4 = VDEF(vname='dev_ms_reading_last', rpn='%s,LAST' % cdef4.vname)
-
-            vdef11 = VDEF(vname='dev_ms_doing_io_avg', rpn='%s,AVERAGE' % cdef1.vname)
-            vdef12 = VDEF(vname='dev_ms_writing_avg', rpn='%s,AVERAGE' % cdef2.vname)
-            vdef13 = VDEF(vname='dev_ms_weighted_avg', rpn='%s,AVERAGE' % cdef3.vname)
-            vdef14 = VDEF(vname='dev_ms_reading_avg', rpn='%s,AVERAGE' % cdef4.vname)
-
-            vdef21 = VDEF(vname='dev_ms_doing_io_min', rpn='%s,MINIMUM' % cdef1.vname)
-            vdef22 = VDEF(vname='dev_ms_writing_min', rpn='%s,MINIMUM' % cdef2.vname)
-            vdef23 = VDEF(vname='dev_ms_weighted_min', rpn='%s,MINIMUM' % cdef3.vname)
-            vdef24 = VDEF(vname='dev_ms_reading_min', rpn='%s,MINIMUM' % cdef4.vname)
-
-            vdef31 = VDEF(vname='dev_ms_doing_io_max', rpn='%s,MAXIMUM' % cdef1.vname)
-            vdef32 = VDEF(vname='dev_ms_writing_max', rpn='%s,MAXIMUM' % cdef2.vname)
-            vdef33 = VDEF(vname='dev_ms_weighted_max', rpn='%s,MAXIMUM' % cdef3.vname)
-            vdef34 = VDEF(vname='dev_ms_reading_max', rpn='%s,MAXIMUM' % cdef4.vname)
-
-            line1 = LINE(defObj=cdef1, color='#006600', legend=def1.vname)
-            gprint1 = GPRINT(vdef1, 'LAST:%3.2lf')
-            gprint11 = GPRINT(vdef11, 'AVG:%3.2lf')
-            gprint21 = GPRINT(vdef21, 'MIN:%3.2lf')
-            gprint31 = GPRINT(vdef31, 'MAX:%3.2lf\l')
-
-            line2 = LINE(defObj=cdef2, color='#0000ff', legend=def2.vname)
-            gprint2 = GPRINT(vdef2, 'LAST:%3.2lf')
-            gprint12 = GPRINT(vdef12, 'AVG:%3.2lf')
-            gprint22 = GPRINT(vdef22, 'MIN:%3.2lf')
-            gprint32 = GPRINT(vdef32, 'MAX:%3.2lf\l')
-
-            line3 = LINE(defObj=cdef3, color='#ffff00', legend=def3.vname)
-            gprint3 = GPRINT(vdef3, 'LAST:%3.2lf')
-            gprint13 = GPRINT(vdef13, 'AVG:%3.2lf')
-            gprint23 = GPRINT(vdef23, 'MIN:%3.2lf')
-            gprint33 = GPRINT(vdef33, 'MAX:%3.2lf\l')
-
-            line4 = LINE(defObj=cdef4, color='#ff0000', legend=def4.vname)
-            gprint4 = GPRINT(vdef4, 'LAST:%3.2lf')
-            gprint14 = GPRINT(vdef14, 'AVG:%3.2lf')
-            gprint24 = GPRINT(vdef24, 'MIN:%3.2lf')
-            gprint34 = GPRINT(vdef34, 'MAX:%3.2lf\l')
-
-            paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                         def2, cdef2, vdef2, vdef12, vdef22, vdef32,
-                         def3, cdef3, vdef3, vdef13, vdef23, vdef33,
-                         def4, cdef4, vdef4, vdef14, vdef24, vdef34,
-                         line1, gprint1, gprint11, gprint21, gprint31,
-                         line2, gprint2, gprint12, gprint22, gprint32,
-                         line3, gprint3, gprint13, gprint23, gprint33,
-                         line4, gprint4, gprint14, gprint24, gprint34
-                         ]
-            g = Graph(namespace.get('graphpath')+'%s_msstat.png' % devname,
-                      start=(int(time.time())-gtime),
-                      end=int(time.time()),
-                      vertical_label='ms', color=ca)
-            g.data.extend(paramlist)
-            g.title = "%s_msstat_for_%s_seconds" % (devname, gtime)
-            g.width = namespace.get('gwidth')
-            g.height = namespace.get('gheight')
-            g.write()
-            ######################
-            # BLOCK DEVICE IOS
-            # ####################
-
-            def1 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_writes',
-                       dsName='%s_writes' % devname)
-            def2 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_reads',
-                       dsName='%s_reads' % devname)
-            def3 = DEF(rrdfile=namespace.get('rrdpath'), vname='dev_cur_ios',
-                       dsName='%s_cur_ios' % devname)
-
-            cdef1 = CDEF(vname='dev_writes_c', rpn='%s,1,/' % def1.vname)
-            cdef2 = CDEF(vname='dev_reads_c', rpn='%s,1,/' % def2.vname)
-            cdef3 = CDEF(vname='dev_cur_ios_c', rpn='%s,1,/' % def3.vname)
-
-            vdef1 = VDEF(vname='dev_writes_last', rpn='%s,LAST' % cdef1.vname)
-            vdef2 = VDEF(vname='dev_reads_last', rpn='%s,LAST' % cdef2.vname)
-            vdef3 = VDEF(vname='dev_cur_ios_last', rpn='%s,LAST' % cdef3.vname)
-
-            vdef11 = VDEF(vname='dev_writes_avg', rpn='%s,AVERAGE' % cdef1.vname)
-            vdef12 = VDEF(vname='dev_reads_avg', rpn='%s,AVERAGE' % cdef2.vname)
-            vdef13 = VDEF(vname='dev_cur_ios_avg', rpn='%s,AVERAGE' % cdef3.vname)
-
-            vdef21 = VDEF(vname='dev_writes_min', rpn='%s,MINIMUM' % cdef1.vname)
-            vdef22 = VDEF(vname='dev_reads_min', rpn='%s,MINIMUM' % cdef2.vname)
-            vdef23 = VDEF(vname='dev_cur_ios_min', rpn='%s,MINIMUM' % cdef3.vname)
-
-            vdef31 = VDEF(vname='dev_writes_max', rpn='%s,MAXIMUM' % cdef1.vname)
-            vdef32 = VDEF(vname='dev_reads_max', rpn='%s,MAXIMUM' % cdef2.vname)
-            vdef33 = VDEF(vname='dev_cur_ios_max', rpn='%s,MAXIMUM' % cdef3.vname)
-
-            area1 = AREA(defObj=cdef1, color='#006600', legend=def1.vname)
-            gprint1 = GPRINT(vdef1, 'LAST:%3.2lf')
-            gprint11 = GPRINT(vdef11, 'AVG:%3.2lf')
-            gprint21 = GPRINT(vdef21, 'MIN:%3.2lf')
-            gprint31 = GPRINT(vdef31, 'MAX:%3.2lf\l')
-
-            line2 = LINE(defObj=cdef2, color='#0000ff', legend=def2.vname)
-            gprint2 = GPRINT(vdef2, 'LAST:%3.2lf')
-            gprint12 = GPRINT(vdef12, 'AVG:%3.2lf')
-            gprint22 = GPRINT(vdef22, 'MIN:%3.2lf')
-            gprint32 = GPRINT(vdef32, 'MAX:%3.2lf\l')
-
-            line3 = LINE(defObj=cdef3, color='#ffff00', legend=def3.vname)
-            gprint3 = GPRINT(vdef3, 'LAST:%3.2lf')
-            gprint13 = GPRINT(vdef13, 'AVG:%3.2lf')
-            gprint23 = GPRINT(vdef23, 'MIN:%3.2lf')
-            gprint33 = GPRINT(vdef33, 'MAX:%3.2lf\l')
-
-            paramlist = [def1, cdef1, vdef1, vdef11, vdef21, vdef31,
-                         def2, cdef2, vdef2, vdef12, vdef22, vdef32,
-                         def3, cdef3, vdef3, vdef13, vdef23, vdef33,
-                         area1, gprint1, gprint11, gprint21, gprint31,
-                         line2, gprint2, gprint12, gprint22, gprint32,
-                         line3, gprint3, gprint13, gprint23, gprint33,
-                         ]
-            g = Graph(namespace.get('graphpath')+'%s_ios.png' % devname,
-                      start=(int(time.time())-gtime),
-                      end=int(time.time()),
-                      vertical_label='ios', color=ca)
-            g.data.extend(paramlist)
-            g.title = "%s_ios_for_%s_seconds" % (devname, gtime)
-            g.width = namespace.get('gwidth')
-            g.height = namespace.get('gheight')
-            g.write()
 
+# Record what the cycle that just ended cost the collector
+def endcycle(namespace, state, graphs):
+    """Put the stage times and resource usage of this cycle in
+    state['self'], where the next collect() picks them up as selfvalues.
 
-# Main func
-def main(namespace):
+    cpu_pct and child_pct are the cpu time of the collector and of its
+    rrdtool processes (sessions still running included) since the
+    previous cycle (since start for a single run), in percent of
+    interval. rss is the resident size in bytes, opens the number of
+    files the cycle opened (see openfile()).
+    """
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    cputime = (usage.ru_utime + usage.ru_stime,
+               children.ru_utime + children.ru_stime +
+               RRD_SESSION_CPU['total'])
+    prevtime = state.get('rusage', (0.0, 0.0))
+    state['rusage'] = cputime
+    interval = float(namespace.get('interval'))
+    selfvalues = dict((stage, STAGE_TIMES.get(stage, 0.0))
+                      for stage in SELF_STAGES)
+    selfvalues['graphs'] = graphs
+    selfvalues['cpu_pct'] = (cputime[0] - prevtime[0]) * 100 / interval
+    selfvalues['child_pct'] = (cputime[1] - prevtime[1]) * 100 / interval
+    selfvalues['rss'] = int(readprocfile('/proc/self/statm').split()[1]) *\
+        resource.getpagesize()
+    selfvalues['opens'] = FILE_OPENS['total'] - state.get('opens', 0)
+    state['opens'] = FILE_OPENS['total']
+    state['self'] = selfvalues
+
+
+# Print the collector's own cost of a cycle
+def printselfvalues(selfvalues):
+    print("-----Collector stages and overhead -------------------")
+    print ", ".join("%s:%.4fs" % (stage, selfvalues[stage])
+                    for stage in SELF_STAGES)
+    print "graphs:%s, cpu:%.3f%%, children_cpu:%.3f%%, rss:%s, opens:%s" % (
+        selfvalues['graphs'], selfvalues['cpu_pct'],
+        selfvalues['child_pct'], selfvalues['rss'], selfvalues['opens'])
+
+
+# Read all enabled stats once
+def readall(namespace, state):
+    """Return (memvalues, netvalues, blockvalues, cpuvalues, loadavgvalues).
+
+    Disabled subsystems are returned as empty dicts. The cpu delta is
+    taken against the snapshot in state, see readCpuValues(). Rollups of
+    a burst sampler kept in state are added to their devices, see
+    mergeburst(). Files are read below the procroot of namespace, so the
+    same process can sample a host /proc mounted into a container or
+    recorded snapshots, with one state per root.
+    """
+    procroot = namespace.get('procroot')
     memvalues = {}
     netvalues = {}
     blockvalues = {}
     cpuvalues = {}
     loadavgvalues = {}
     if namespace['memory']:
-        memvalues = readMemValues()
+        started = time.time()
+        memvalues = readMemValues(procroot)
+        stagetime('read_mem', started)
         if namespace['verbose']:
             printmemvalues(memvalues)
     if namespace['cpu']:
-        loadavgvalues = readLoadAvgValues()
-        cpuvalues = readCpuValues()
+        started = time.time()
+        loadavgvalues = readLoadAvgValues(procroot)
+        stagetime('read_loadavg', started)
+        started = time.time()
+        cpuvalues = readCpuValues(state, procroot)
+        stagetime('read_cpu', started)
         if namespace['verbose']:
             printcpuvalues(cpuvalues, loadavgvalues)
     if namespace['net']:
-        netvalues = readNetValues(namespace.get('interface'))
+        started = time.time()
+        if namespace['netsource'] == 'netlink':
+            try:
+                netvalues = readNetlinkValues(namespace.get('interface'))
+            except socket.error, error:
+                print "Error: reading interfaces over netlink failed: %s, " \
+                    "using /proc/net/dev" % error
+                closenetlink()
+                namespace['netsource'] = 'proc'
+        if namespace['netsource'] == 'proc':
+            netvalues = readNetValues(namespace.get('interface'), procroot)
+        stagetime('read_net', started)
         if namespace['verbose']:
             printnetvalues(netvalues)
     if namespace['block']:
-        blockvalues = readBlockValues(namespace.get('disk'))
+        started = time.time()
+        blockvalues = readBlockValues(namespace.get('disk'), procroot,
+                                      state, namespace.get('sysroot'))
+        stagetime('read_block', started)
         if namespace['verbose']:
             printblockvalues(blockvalues)
-    if os.path.isfile(namespace.get('rrdpath')):
-        updaterra(namespace, memvalues, netvalues, blockvalues,
-                  cpuvalues, loadavgvalues)
-    else:
-        print "File %s not found, creating new one" % namespace.get('rrdpath')
-        createrra(namespace, memvalues, netvalues, blockvalues,
-                  cpuvalues, loadavgvalues)
+    if state.get('burst'):
+        rollups = burstrollup(state['burst'])
+        mergeburst(rollups, netvalues, blockvalues, cpuvalues)
+        if namespace['verbose']:
+            printburstvalues(rollups)
+    return memvalues, netvalues, blockvalues, cpuvalues, loadavgvalues
+
+
+# Collect all enabled stats once, store them and optionally draw graphs
+def collect(namespace, state=None):
+    """Run one collection cycle.
+
+    With selfstats the stage times and overhead of the previous cycle
+    (kept in state, or in the cpustate file between single runs) are
+    stored along with this sample as the self_* data sources.
+    """
+    if state is None:
+        state = {}
+    STAGE_TIMES.clear()
+    if (namespace['cpu'] and 'cpu' not in state) or \
+            (namespace['block'] and 'block' not in state):
+        loadstate(namespace.get('cpustate'), state,
+                  namespace.get('procroot'))
+    memvalues, netvalues, blockvalues, cpuvalues, loadavgvalues = \
+        readall(namespace, state)
+    selfvalues = state.get('self') if namespace['selfstats'] else None
+    if namespace['export']:
+        updateexport(memvalues, netvalues, blockvalues, cpuvalues,
+                     loadavgvalues, selfvalues)
+    started = time.time()
+    backend = STORAGE_BACKENDS[namespace['backend']]
+    created = []
+    for rrdfile, values in rrdtargets(namespace, memvalues, netvalues,
+                                      blockvalues, cpuvalues, loadavgvalues,
+                                      selfvalues):
+        rrdfile = backend['path'](rrdfile)
+        if backend['exists'](rrdfile):
+            if namespace['migrate'] and backend['migrate']:
+                backend['migrate'](namespace, *values, rrdpath=rrdfile)
+            backend['update'](namespace, *values,
+                              state=state if namespace['daemon'] else None,
+                              rrdpath=rrdfile)
+        else:
+            print "File %s not found, creating new one" % rrdfile
+            backend['create'](namespace, *values, rrdpath=rrdfile)
+            created.append((rrdfile, values))
+    if created and namespace['sharded']:
+        saverrdindex(namespace, created)
+    stagetime('store', started)
+    if namespace['shipto']:
+        started = time.time()
+        ship(namespace, state, memvalues, netvalues, blockvalues,
+             cpuvalues, loadavgvalues, selfvalues)
+        stagetime('ship', started)
+    timings = []
     if namespace['graph']:
-        draw_file(namespace, memvalues, netvalues, blockvalues,
-                  cpuvalues, loadavgvalues)
+        if namespace['backend'] != 'rrd':
+            print "Error: graphs are only drawn from the rrd backend"
+        else:
+            started = time.time()
+            timings = draw_file(namespace, memvalues, netvalues, blockvalues,
+                                cpuvalues, loadavgvalues, selfvalues)
+            stagetime('graph', started)
+    if namespace['selfstats']:
+        endcycle(namespace, state, sum(1 for _, seconds in timings
+                                       if seconds is not None))
+        if namespace['verbose']:
+            printselfvalues(state['self'])
+    if (namespace['cpu'] or namespace['block']) and not namespace['daemon']:
+        savestate(namespace.get('cpustate'), state,
+                  namespace.get('procroot'))
+
+
+# Sources the burst sampler can poll between steps
+BURST_SOURCES = ('cpu', 'disk', 'net')
+# Rollups stored for every burst series at each step
+BURST_STATS = ('min', 'max', 'mean', 'p99')
+# Collected value keys the rollups are stored under, e.g. busy_p99
+BURST_KEYS = frozenset('%s_%s' % (field, stat)
+                       for field in ('busy', 'ios', 'rx', 'tx')
+                       for stat in BURST_STATS)
+
+
+# Return the device names a burst source should sample, None for all
+def burstdevices(names):
+    wanted = set(name.upper() for name in names.split(' ') if name)
+    return wanted or None
+
+
+# Read the burst sources once and add one value per series to the rings
+def burstsample(namespace, burst):
+    """Sample busy percent of every cpu line of /proc/stat (the total and
+    each cpu), cur_ios of /proc/diskstats and received/transmitted bytes
+    per second of /proc/net/dev.
+
+    Devices are picked like readBlockValues() and readNetValues() do.
+    Counters are turned into rates against the previous burst sample, so
+    the first sample of a device only sets its baseline.
+    """
+    procroot = namespace.get('procroot')
+    files = burst['files']
+    now = time.time()
+    values = []
+    if 'cpu' in namespace['burst']:
+        for line in readprocfile(procroot + '/stat', files).split('\n'):
+            if not line.startswith('cpu'):
+                break
+            split = line.split()
+            ticks = map(int, split[1:STAT_ELAPSED_COLUMNS + 1])
+            values.append((('cpu', split[0], 'busy'), sum(ticks),
+                           sum(ticks) - ticks[3] - ticks[4]))
+    if 'disk' in namespace['burst']:
+        wanted = burst['disks']
+        for line in readprocfile(procroot + '/diskstats', files).splitlines():
+            split = line.split()
+            if len(split) < 14:
+                continue
+            dev = split[2]
+            if wanted is None:
+                if 'loop' in dev or 'ram' in dev:
+                    continue
+            elif dev.upper() not in wanted:
+                continue
+            values.append((('disk', dev, 'ios'), None, int(split[11])))
+    if 'net' in namespace['burst']:
+        wanted = burst['interfaces']
+        for line in readprocfile(procroot + '/net/dev',
+                                 files).splitlines()[2:]:
+            interface, sep, data = line.partition(':')
+            interface = interface.strip()
+            if not sep:
+                continue
+            if wanted is None:
+                if 'lo' in interface:
+                    continue
+            elif interface.upper() not in wanted:
+                continue
+            data = data.split()
+            values.append((('net', interface, 'rx'), now, int(data[0])))
+            values.append((('net', interface, 'tx'), now, int(data[8])))
+    last = burst['last']
+    with burst['lock']:
+        for key, base, value in values:
+            if base is not None:
+                # Counter: rate against the previous sample of the series
+                previous = last.get(key)
+                last[key] = (base, value)
+                if previous is None or base <= previous[0] or \
+                        value < previous[1]:
+                    continue
+                value = float(value - previous[1]) / (base - previous[0])
+                if key[0] == 'cpu':
+                    value *= 100
+            ring = burst['rings'].get(key)
+            if ring is None:
+                ring = [array('d', [0.0]) * burst['size'], 0, 0]
+                burst['rings'][key] = ring
+            ring[0][ring[1] % burst['size']] = value
+            ring[1] += 1
+
+
+# Take burst samples every burstinterval seconds until stopped
+def runburst(namespace, burst):
+    interval = namespace['burstinterval']
+    start = time.time()
+    tick = 0
+    while not burst['stop']:
+        tick += 1
+        now = time.time()
+        next_run = start + tick * interval
+        if next_run <= now:
+            tick = int((now - start) // interval) + 1
+            next_run = start + tick * interval
+        time.sleep(next_run - now)
+        try:
+            burstsample(namespace, burst)
+        except (IOError, OSError, ValueError, IndexError), error:
+            if not burst.get('failed'):
+                print "Error: burst sample failed: %s" % error
+                burst['failed'] = True
+
+
+# Start the burst sampler thread
+def startburst(namespace):
+    """Return the sampler state, with the thread already running.
+
+    The ring of every series holds two steps worth of samples. The first
+    two samples are taken before returning, so the first step already
+    has a rate for every counter.
+    """
+    size = int(2 * namespace.get('interval') / namespace['burstinterval'])
+    burst = {'size': max(size, 1), 'rings': {}, 'last': {}, 'files': {},
+             'lock': threading.Lock(), 'stop': False,
+             'disks': burstdevices(namespace.get('disk')),
+             'interfaces': burstdevices(namespace.get('interface'))}
+    burstsample(namespace, burst)
+    time.sleep(namespace['burstinterval'])
+    burstsample(namespace, burst)
+    thread = threading.Thread(target=runburst, args=(namespace, burst))
+    thread.daemon = True
+    thread.start()
+    burst['thread'] = thread
+    if namespace['verbose']:
+        print "-----Burst sampling %s every %ss ---------" %\
+            (', '.join(namespace['burst']), namespace['burstinterval'])
+    return burst
+
+
+# Stop the burst sampler thread and close its files
+def stopburst(burst):
+    burst['stop'] = True
+    burst['thread'].join()
+    closeprocfiles(burst['files'])
+
+
+# Return min, max, mean and p99 of the samples taken since the last call
+def burstrollup(burst):
+    """Return {(source, device, field): {stat: value}}.
+
+    Series without a sample since the last rollup (devices that went
+    away) are dropped. p99 is the nearest-rank percentile.
+    """
+    windows = {}
+    with burst['lock']:
+        for key, ring in burst['rings'].items():
+            samples, count, rolled = ring
+            taken = min(count - rolled, burst['size'])
+            if not taken:
+                del burst['rings'][key]
+                burst['last'].pop(key, None)
+                continue
+            windows[key] = [samples[index % burst['size']]
+                            for index in xrange(count - taken, count)]
+            ring[2] = count
+    rollups = {}
+    for key, window in windows.iteritems():
+        window.sort()
+        rollups[key] = {'min': window[0], 'max': window[-1],
+                        'mean': sum(window) / len(window),
+                        'p99': window[int(math.ceil(0.99 * len(window))) - 1]}
+    return rollups
+
+
+# Add burst rollups to the collected values of their devices
+def mergeburst(rollups, netvalues, blockvalues, cpuvalues):
+    """Store the rollups as <field>_<stat> keys (busy_p99, ios_max, rx_mean,
+    ...) of the cpu, block device or interface they belong to, so they
+    end up in that device's data sources, e.g. sda_ios_p99.
+    """
+    sources = {'cpu': cpuvalues, 'disk': blockvalues, 'net': netvalues}
+    for (source, device, field), stats in rollups.iteritems():
+        values = sources[source].get(device)
+        if values is None:
+            continue
+        for stat in BURST_STATS:
+            values['%s_%s' % (field, stat)] = stats[stat]
+
+
+# Print burst rollups of a step
+def printburstvalues(rollups):
+    print("-----Burst rollups since last step --------------------")
+    for (source, device, field), stats in sorted(rollups.iteritems()):
+        print "%s:%s:%s" % (device, field, ", ".join(
+            "%s:%.2f" % (stat, stats[stat]) for stat in BURST_STATS))
+
+
+# Signals received asking the daemon to stop
+STOP_REQUESTS = []
+
+
+# Stop the daemon loop on SIGTERM/SIGINT after the current sample
+def stopdaemon(signum, frame):
+    STOP_REQUESTS.append(signum)
+
+
+# Signals received asking the daemon to flush its RRD buffer
+FLUSH_REQUESTS = []
+
+
+# Ask the daemon to flush buffered RRD samples (SIGUSR1)
+def requestflush(signum, frame):
+    FLUSH_REQUESTS.append(signum)
+
+
+# Run collect() every interval seconds without drifting
+def rundaemon(namespace):
+    """Keep one process resident and sample on a fixed time grid.
+
+    Ticks are scheduled as start + n * interval, so time spent collecting
+    does not shift later samples. Ticks missed because a sample overran
+    the interval are skipped rather than run back to back. Buffered RRD
+    and shipped samples are flushed on SIGUSR1 and on exit. SIGTERM and
+    SIGINT only set a flag that is checked between samples, so a sample
+    or flush in progress is never cut short. A sample that fails is
+    logged and the next one is taken on schedule. With burst sources a
+    sampler thread polls them in between.
+    """
+    interval = namespace.get('interval')
+    backend = STORAGE_BACKENDS[namespace['backend']]
+    state = {}
+    signal.signal(signal.SIGTERM, stopdaemon)
+    signal.signal(signal.SIGINT, stopdaemon)
+    signal.signal(signal.SIGUSR1, requestflush)
+    if namespace['verbose']:
+        print "-----Starting daemon, interval %s seconds ---------" % interval
+    start = time.time()
+    tick = 0
+    try:
+        if namespace['burst']:
+            state['burst'] = startburst(namespace)
+        while not STOP_REQUESTS:
+            try:
+                collect(namespace, state)
+            except Exception, error:
+                print "Error: sample failed: %s" % error
+            tick += 1
+            now = time.time()
+            next_run = start + tick * interval
+            if next_run <= now:
+                tick = int((now - start) // interval) + 1
+                next_run = start + tick * interval
+            # A signal ends sleep() early, so sleep until next_run again
+            while now < next_run and not STOP_REQUESTS:
+                time.sleep(next_run - now)
+                if FLUSH_REQUESTS:
+                    del FLUSH_REQUESTS[:]
+                    backend['flush'](namespace, state)
+                    flushship(namespace, state)
+                now = time.time()
+    finally:
+        if state.get('burst'):
+            stopburst(state['burst'])
+        backend['flush'](namespace, state)
+        flushship(namespace, state)
+        if state.get('shipsock'):
+            state['shipsock'].close()
+        if backend['close']:
+            backend['close']()
+        closerrdsessions()
+        closenetlink()
+        savestate(namespace.get('cpustate'), state,
+                  namespace.get('procroot'))
+        closeprocfiles()
+
+
+# Exposition text served by the exporter and when it was rendered
+EXPORT_CACHE = {'text': None, 'time': 0}
+# Held while the exporter reads /proc for a scrape
+EXPORT_LOCK = threading.Lock()
+OPENMETRICS_CONTENT_TYPE = \
+    'application/openmetrics-text; version=1.0.0; charset=utf-8'
+# Exported metric names of the DS_NET fields
+OPENMETRICS_NET = {'recv_bytes': 'receive_bytes',
+                   'trans_bytes': 'transmit_bytes',
+                   'recv_packets': 'receive_packets',
+                   'trans_packets': 'transmit_packets',
+                   'recv_errs': 'receive_errs',
+                   'trans_errs': 'transmit_errs'}
+# Exported metric names and help of the DS_IOSTAT fields
+OPENMETRICS_IOSTAT = {
+    'r_s': ('sysstat_disk_reads_per_second', 'Reads completed per second.'),
+    'w_s': ('sysstat_disk_writes_per_second',
+            'Writes completed per second.'),
+    'rkB_s': ('sysstat_disk_read_kilobytes_per_second',
+              'Kilobytes read per second.'),
+    'wkB_s': ('sysstat_disk_written_kilobytes_per_second',
+              'Kilobytes written per second.'),
+    'r_await': ('sysstat_disk_read_await_milliseconds',
+                'Average time of a read, queueing included.'),
+    'w_await': ('sysstat_disk_write_await_milliseconds',
+                'Average time of a write, queueing included.'),
+    'aqu_sz': ('sysstat_disk_queue_size',
+               'Average number of requests queued or in service.'),
+    'util': ('sysstat_disk_utilization_percent',
+             'Percent of time the device was busy.')}
+# Exported metric names of the burst fields
+OPENMETRICS_BURST = (('busy', 'sysstat_cpu_busy_burst_percent',
+                      'Busy cpu percent'),
+                     ('ios', 'sysstat_disk_in_flight_burst',
+                      'I/Os in flight'),
+                     ('rx', 'sysstat_network_receive_burst_bytes_per_second',
+                      'Received bytes per second'),
+                     ('tx', 'sysstat_network_transmit_burst_bytes_per_second',
+                      'Transmitted bytes per second'))
+
+
+# Append one metric family in OpenMetrics text format to lines
+def metricfamily(lines, name, metrictype, helptext, samples):
+    """samples is a list of (labels, value), labels like 'cpu="cpu0"'."""
+    if not samples:
+        return
+    lines.append('# TYPE %s %s' % (name, metrictype))
+    lines.append('# HELP %s %s' % (name, helptext))
+    suffix = '_total' if metrictype == 'counter' else ''
+    for labels, value in samples:
+        if labels:
+            lines.append('%s%s{%s} %s' % (name, suffix, labels, value))
+        else:
+            lines.append('%s%s %s' % (name, suffix, value))
+
+
+# Quote a label value for the OpenMetrics text format
+def labelvalue(value):
+    return '"%s"' % value.strip(' ').replace('\\', '\\\\')\
+        .replace('"', '\\"').replace('\n', '\\n')
+
+
+# Render collected values as OpenMetrics text
+def renderopenmetrics(memvalues, netvalues, blockvalues,
+                      cpuvalues, loadavgvalues, selfvalues=None):
+    lines = []
+    metricfamily(lines, 'sysstat_memory_bytes', 'gauge',
+                 'Memory fields of /proc/meminfo.',
+                 [('field=%s' % labelvalue(key), value * 1024)
+                  for key, value in sorted(memvalues.iteritems())
+                  if not key.startswith('HugePages_')])
+    metricfamily(lines, 'sysstat_memory_hugepages', 'gauge',
+                 'Huge page counts of /proc/meminfo.',
+                 [('field=%s' % labelvalue(key), value)
+                  for key, value in sorted(memvalues.iteritems())
+                  if key.startswith('HugePages_')])
+    for key, minutes in (('loadavg1min', 1), ('loadavg5min', 5),
+                         ('loadavg15min', 15)):
+        if key in loadavgvalues:
+            metricfamily(lines, 'sysstat_load%d' % minutes, 'gauge',
+                         '%d minute load average.' % minutes,
+                         [('', loadavgvalues[key])])
+    metricfamily(lines, 'sysstat_cpu_percent', 'gauge',
+                 'Cpu time share of each mode over the last interval.',
+                 [('cpu=%s,mode=%s' % (labelvalue(cpu), labelvalue(mode)),
+                   repr(value))
+                  for cpu in sorted(cpuvalues)
+                  for mode, value in sorted(cpuvalues[cpu].iteritems())
+                  if mode != 'name' and mode not in BURST_KEYS])
+    for field in DS_NET:
+        metricfamily(lines, 'sysstat_network_%s' % OPENMETRICS_NET[field],
+                     'counter' if dstype(field) == 'DERIVE' else 'gauge',
+                     'Field %s of /proc/net/dev.' % field,
+                     [('device=%s' % labelvalue(interface),
+                       netvalues[interface][field])
+                      for interface in sorted(netvalues)
+                      if field in netvalues[interface]])
+    fields = set()
+    for blockdata in blockvalues.itervalues():
+        fields.update(blockdata)
+    fields -= set(['m', 'mm', 'dev'])
+    fields -= BURST_KEYS
+    fields -= set(DS_IOSTAT)
+    for field in sorted(fields):
+        metricfamily(lines, 'sysstat_disk_%s' % field,
+                     'counter' if dstype(field) == 'DERIVE' else 'gauge',
+                     'Field %s of /proc/diskstats.' % field,
+                     [('device=%s' % labelvalue(blockdevice),
+                       blockvalues[blockdevice][field])
+                      for blockdevice in sorted(blockvalues)
+                      if field in blockvalues[blockdevice]])
+    for field in DS_IOSTAT:
+        name, helptext = OPENMETRICS_IOSTAT[field]
+        metricfamily(lines, name, 'gauge', helptext,
+                     [('device=%s' % labelvalue(blockdevice),
+                       repr(blockvalues[blockdevice][field]))
+                      for blockdevice in sorted(blockvalues)
+                      if field in blockvalues[blockdevice]])
+    for field, name, helptext in OPENMETRICS_BURST:
+        samples = []
+        for values in (cpuvalues, blockvalues, netvalues):
+            for device in sorted(values):
+                if field + '_max' in values[device]:
+                    samples.extend(
+                        ('device=%s,stat=%s' % (labelvalue(device),
+                                                labelvalue(stat)),
+                         repr(values[device]['%s_%s' % (field, stat)]))
+                        for stat in BURST_STATS)
+        metricfamily(lines, name, 'gauge',
+                     '%s over the burst samples of the last step.' % helptext,
+                     samples)
+    if selfvalues:
+        metricfamily(lines, 'sysstat_collector_stage_seconds', 'gauge',
+                     'Seconds the previous collection spent in each stage.',
+                     [('stage=%s' % labelvalue(stage), repr(selfvalues[stage]))
+                      for stage in SELF_STAGES if stage in selfvalues])
+        metricfamily(lines, 'sysstat_collector_cpu_percent', 'gauge',
+                     'Cpu time of the previous collection in percent of '
+                     'the interval.',
+                     [('process="collector"', repr(selfvalues['cpu_pct'])),
+                      ('process="rrdtool"', repr(selfvalues['child_pct']))])
+        metricfamily(lines, 'sysstat_collector_resident_bytes', 'gauge',
+                     'Resident memory of the collector.',
+                     [('', selfvalues['rss'])])
+        metricfamily(lines, 'sysstat_collector_opened_files', 'gauge',
+                     'Files the previous collection opened.',
+                     [('', selfvalues['opens'])])
+    lines.append('# EOF\n')
+    return '\n'.join(lines)
+
+
+# Render the exposition text once for a collection cycle
+def updateexport(memvalues, netvalues, blockvalues,
+                 cpuvalues, loadavgvalues, selfvalues=None):
+    EXPORT_CACHE['text'] = renderopenmetrics(memvalues, netvalues,
+                                             blockvalues, cpuvalues,
+                                             loadavgvalues, selfvalues)
+    EXPORT_CACHE['time'] = time.time()
+
+
+# Return the exposition text for a scrape
+def exporttext(namespace, state):
+    """Return the cached text, collecting again if it is too old.
+
+    In daemon mode the text is rendered by collect() every interval and
+    only served here. Otherwise the first scrape after exportttl seconds
+    reads /proc while holding EXPORT_LOCK; scrapes arriving meanwhile
+    wait for it and get the same text.
+    """
+    if namespace['daemon']:
+        return EXPORT_CACHE['text']
+    with EXPORT_LOCK:
+        if EXPORT_CACHE['text'] is None or \
+                time.time() - EXPORT_CACHE['time'] >= namespace['exportttl']:
+            updateexport(*readall(namespace, state))
+        return EXPORT_CACHE['text']
+
+
+# HTTP handler serving /metrics
+class ExportHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        text = exporttext(self.server.namespace, self.server.state)
+        if text is None:
+            self.send_error(503)
+            return
+        self.send_response(200)
+        self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(text)))
+        self.end_headers()
+        self.wfile.write(text)
+
+    def log_message(self, format, *args):
+        if self.server.namespace['verbose']:
+            BaseHTTPServer.BaseHTTPRequestHandler.log_message(self, format,
+                                                              *args)
+
+
+# HTTP server answering every scrape in its own thread
+class ExportServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+# Start the OpenMetrics exporter
+def startexporter(namespace):
+    """Return the HTTP server of the exporter.
+
+    In daemon mode it is already serving from a background thread;
+    otherwise the caller runs serve_forever(). On its own the exporter
+    takes a cpu snapshot here, so no scrape has to sleep for the delta.
+    """
+    server = ExportServer((namespace['exportaddr'], namespace['exportport']),
+                          ExportHandler)
+    server.namespace = namespace
+    server.state = {}
+    if namespace['verbose']:
+        print "-----Serving OpenMetrics on %s:%s/metrics ---------" %\
+            (namespace['exportaddr'] or '*', namespace['exportport'])
+    if namespace['daemon']:
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+    elif namespace['cpu']:
+        server.state['cpu'] = read_cpu_data(namespace.get('procroot'))
+    return server
+
+
+# Plan sources as named in shipped metrics, see createUpdatePlan()
+SHIP_SOURCES = ('memory', 'loadavg', 'cpu', 'net', 'disk', 'collector')
+# Seconds to wait for the receiver before spooling
+SHIP_TIMEOUT = 5
+# Max bytes of one UDP datagram, lines are never split across datagrams
+SHIP_DATAGRAM = 1400
+
+
+# Format one sample as Graphite plaintext or Influx line protocol
+def shiplines(namespace, timestamp, memvalues, netvalues, blockvalues,
+              cpuvalues, loadavgvalues, selfvalues=None):
+    """Return the lines of one sample as a str.
+
+    Graphite paths are sysstat.<host>.<source>[.<device>].<field>. Influx
+    gets one line per source and device, measurement sysstat_<source>
+    with host and device tags.
+    """
+    plan = updateplan(memvalues, netvalues, blockvalues, cpuvalues,
+                      loadavgvalues, selfvalues, 'ship')
+    values = planvalues(plan, memvalues, netvalues, blockvalues, cpuvalues,
+                        loadavgvalues, selfvalues)
+    host = socket.gethostname()
+    lines = []
+    if namespace['shipformat'] == 'graphite':
+        prefix = 'sysstat.%s.' % host.replace('.', '_')
+        for (source, device, key), value in izip(plan['slots'], values):
+            path = SHIP_SOURCES[source]
+            if device is not None:
+                path += '.' + device.strip(' ').replace('.', '_')
+            path += '.' + key.replace('(', '_').strip(')')
+            lines.append('%s%s %s %d\n' % (prefix, path, value, timestamp))
+        return ''.join(lines)
+    tags = ',host=' + host.replace(' ', '\\ ').replace(',', '\\,')
+    group = None
+    for (source, device, key), value in izip(plan['slots'], values):
+        if (source, device) != group:
+            if group is not None:
+                lines.append(' %d000000000\n' % timestamp)
+            lines.append('sysstat_%s%s' % (SHIP_SOURCES[source], tags))
+            if device is not None:
+                lines.append(',device=' + device.strip(' '))
+            lines.append(' ')
+            group = (source, device)
+        else:
+            lines.append(',')
+        lines.append('%s=%s' % (key.replace('(', '_').strip(')'),
+                                float(value)))
+    if group is not None:
+        lines.append(' %d000000000\n' % timestamp)
+    return ''.join(lines)
+
+
+# Open the connection to the receiver
+def shipconnect(namespace):
+    host, port = namespace['shipto']
+    if namespace['shipudp']:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.connect((host, port))
+        return sock
+    return socket.create_connection((host, port), SHIP_TIMEOUT)
+
+
+# Write data to the receiver, in datagrams of whole lines for UDP
+def shipsend(namespace, sock, data):
+    if not namespace['shipudp']:
+        sock.sendall(data)
+        return
+    while data:
+        end = len(data)
+        if end > SHIP_DATAGRAM:
+            end = data.rfind('\n', 0, SHIP_DATAGRAM) + 1 or SHIP_DATAGRAM
+        sock.send(data[:end])
+        data = data[end:]
+
+
+# Append data to the spool file, dropping the oldest lines when full
+def spoolappend(namespace, data):
+    path = namespace['spoolpath']
+    maxbytes = namespace['spoolmax']
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        size = 0
+    if size + len(data) <= maxbytes:
+        with openfile(path, 'ab') as f:
+            f.write(data)
+        return
+    with openfile(path, 'rb') as f:
+        data = f.read() + data
+    data = data[len(data) - maxbytes:]
+    data = data[data.find('\n') + 1:]
+    tmppath = path + '.tmp'
+    with openfile(tmppath, 'wb') as f:
+        f.write(data)
+    os.rename(tmppath, path)
+
+
+# Send buffered samples, replaying the spool first after a reconnect
+def flushship(namespace, state):
+    """Ship state['ship'] through the connection kept in state.
+
+    The connection is reused for every later sample. When it has to be
+    opened, spooled data is sent first, so the receiver gets samples in
+    the order they were taken. If the receiver cannot be reached, the
+    data goes to the spool (at most spoolmax bytes, oldest lines are
+    dropped first). A spool that was only partly sent is sent again in
+    full; both line protocols overwrite points with the same timestamp,
+    so the duplicates are harmless.
+    """
+    shipbuffer = state.pop('ship', None)
+    if not shipbuffer:
+        return
+    data = ''.join(shipbuffer['lines'])
+    sock = state.get('shipsock')
+    try:
+        if sock is None:
+            sock = shipconnect(namespace)
+            state['shipsock'] = sock
+            if os.path.isfile(namespace['spoolpath']):
+                with openfile(namespace['spoolpath'], 'rb') as f:
+                    shipsend(namespace, sock, f.read())
+                os.remove(namespace['spoolpath'])
+        shipsend(namespace, sock, data)
+        state.pop('shipfailed', None)
+    except (socket.error, IOError, OSError), error:
+        if sock is not None:
+            sock.close()
+        state['shipsock'] = None
+        if not state.get('shipfailed'):
+            print "Error: shipping to %s:%s failed: %s, spooling to %s" %\
+                (namespace['shipto'] + (error, namespace['spoolpath']))
+            state['shipfailed'] = True
+        spoolappend(namespace, data)
+
+
+# Queue one sample for shipping
+def ship(namespace, state, memvalues, netvalues, blockvalues,
+         cpuvalues, loadavgvalues, selfvalues=None):
+    """Add the sample to state['ship'] and ship once shipbatch samples
+    or flushtime seconds are queued. Without daemon mode every sample is
+    shipped at once.
+    """
+    shipbuffer = state.get('ship')
+    if not shipbuffer:
+        shipbuffer = {'lines': [], 'since': time.time()}
+        state['ship'] = shipbuffer
+    shipbuffer['lines'].append(shiplines(namespace, int(time.time()),
+                                         memvalues, netvalues, blockvalues,
+                                         cpuvalues, loadavgvalues,
+                                         selfvalues))
+    if not namespace['daemon'] or \
+            len(shipbuffer['lines']) >= namespace['shipbatch'] or \
+            time.time() - shipbuffer['since'] >= namespace['flushtime']:
+        flushship(namespace, state)
+    if not namespace['daemon'] and state.get('shipsock'):
+        state.pop('shipsock').close()
+
+
+# Main func
+def main(namespace):
+    if namespace['burst'] and not namespace['daemon']:
+        print "Error: burst sampling needs daemon mode (-d), ignored"
+    if namespace['export']:
+        server = startexporter(namespace)
+    if namespace['daemon']:
+        rundaemon(namespace)
+    elif namespace['export']:
+        try:
+            server.serve_forever()
+        finally:
+            server.server_close()
+            closeprocfiles()
+            closenetlink()
+    else:
+        try:
+            collect(namespace)
+        finally:
+            closerrdsessions()
+            closenetlink()
 
 if __name__ == "__main__":
+    if sys.argv[1:2] == ['query']:
+        query_args = createQueryParser().parse_args(
+            queryargv(sys.argv[2:]))
+        sys.exit(query(initnamespace(query_args), query_args))
     parser = createParser()
     namespace_args = parser.parse_args()
     namespace = initnamespace(namespace_args)
@@ -0,0 +1,64 @@
+import shutil
+import tempfile
+import threading
+import unittest
+
+import bench_sysstat
+import collect_sysstat
+
+
+class BurstTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_burst')
+        disks, interfaces = bench_sysstat.makefixture(self.procroot, 2, 1, 1)
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        self.namespace['procroot'] = self.procroot
+        self.namespace['burst'] = ['cpu', 'disk', 'net']
+        # The sampler state startburst() sets up, without its thread
+        self.burst = {'size': 4, 'rings': {}, 'last': {}, 'files': {},
+                      'lock': threading.Lock(), 'stop': False,
+                      'disks': collect_sysstat.burstdevices(disks[0]),
+                      'interfaces': collect_sysstat.burstdevices(
+                          interfaces[0])}
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles(self.burst['files'])
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    def sample(self, ticks):
+        for tick in ticks:
+            bench_sysstat.makefixture(self.procroot, 2, 1, 1, tick=tick)
+            collect_sysstat.burstsample(self.namespace, self.burst)
+
+    def test_every_cpu_sampled(self):
+        self.sample([0, 1, 3])
+        rollups = collect_sysstat.burstrollup(self.burst)
+        self.assertEqual(sorted(key for key in rollups if key[0] == 'cpu'),
+                         [('cpu', 'cpu', 'busy'), ('cpu', 'cpu0', 'busy'),
+                          ('cpu', 'cpu1', 'busy')])
+        # idle and iowait are 900 of the 3600 ticks every column adds up
+        for key in ('cpu', 'cpu0', 'cpu1'):
+            self.assertEqual(rollups[('cpu', key, 'busy')],
+                             {'min': 75.0, 'max': 75.0, 'mean': 75.0,
+                              'p99': 75.0})
+        self.assertIn(('disk', 'disk0', 'ios'), rollups)
+        self.assertIn(('net', 'eth0', 'rx'), rollups)
+
+    def test_rollup_covers_samples_since_last_step(self):
+        self.sample([0, 1, 2])
+        collect_sysstat.burstrollup(self.burst)
+        self.assertEqual(collect_sysstat.burstrollup(self.burst), {})
+        self.assertNotIn(('cpu', 'cpu0', 'busy'), self.burst['rings'])
+
+    def test_merged_into_cpu_values(self):
+        self.sample([0, 1])
+        cpuvalues = {'cpu0': {'name': 'cpu0'}}
+        collect_sysstat.mergeburst(collect_sysstat.burstrollup(self.burst),
+                                   {}, {}, cpuvalues)
+        self.assertEqual(cpuvalues['cpu0']['busy_p99'], 75.0)
+        self.assertEqual(sorted(cpuvalues), ['cpu0'])
+
+
+if __name__ == '__main__':
+    unittest.main()
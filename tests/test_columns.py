@@ -0,0 +1,117 @@
+import math
+import shutil
+import tempfile
+import time
+import unittest
+
+import collect_sysstat
+
+
+# Stands in for the time module, so samples get increasing timestamps
+class Clock(object):
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+
+class ColumnStoreTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_columns')
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        self.namespace['memory'] = True
+        self.namespace['block'] = True
+        self.path = self.workdir + '/test.tsdb'
+        self.clock = Clock(1500000000)
+        collect_sysstat.time = self.clock
+        collect_sysstat.UPDATE_PLAN.clear()
+
+    def tearDown(self):
+        collect_sysstat.time = time
+        collect_sysstat.closecolumnstores()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # Values of sample n: MemFree is n, sda reads grow by 120 a sample
+    def values(self, n):
+        return ({'MemFree': float(n)}, {},
+                {'sda': {'dev': 'sda', 'reads': 120 * n}}, {}, {})
+
+    def store(self, first, last):
+        for n in xrange(first, last):
+            self.clock.now += 60
+            collect_sysstat.updatecolumns(self.namespace, *self.values(n),
+                                          rrdpath=self.path)
+
+    def read(self, level=0):
+        return collect_sysstat.readcolumns(self.path,
+                                           ['MemFree', 'sda_reads', 'nope'],
+                                           0, self.clock.now, level)
+
+    def test_round_trip(self):
+        collect_sysstat.createcolumns(self.namespace, *self.values(0),
+                                      rrdpath=self.path)
+        self.store(0, 25)
+        timestamps, columns = self.read()
+        self.assertEqual(len(timestamps), 25)
+        self.assertEqual(timestamps[-1], self.clock.now)
+        self.assertEqual(sorted(columns), ['MemFree', 'sda_reads'])
+        self.assertEqual(list(columns['MemFree']), range(25))
+        # DERIVE: no rate for the first sample, then 120 per 60 seconds
+        self.assertTrue(math.isnan(columns['sda_reads'][0]))
+        self.assertEqual(list(columns['sda_reads'][1:]), [2.0] * 24)
+
+    def test_consolidation(self):
+        collect_sysstat.createcolumns(self.namespace, *self.values(0),
+                                      rrdpath=self.path)
+        self.store(0, 25)
+        timestamps, columns = self.read(level=1)
+        self.assertEqual(list(columns['MemFree']), [4.5, 14.5])
+        # The unknown first rate is left out of the mean
+        self.assertEqual(list(columns['sda_reads']), [2.0, 2.0])
+
+    def test_consolidation_after_reopen(self):
+        collect_sysstat.createcolumns(self.namespace, *self.values(0),
+                                      rrdpath=self.path)
+        self.store(0, 15)
+        collect_sysstat.closecolumnstores()
+        self.store(15, 20)
+        timestamps, columns = self.read(level=1)
+        self.assertEqual(list(columns['MemFree']), [4.5, 14.5])
+
+    def test_read_then_write(self):
+        collect_sysstat.createcolumns(self.namespace, *self.values(0),
+                                      rrdpath=self.path)
+        self.store(0, 3)
+        collect_sysstat.closecolumnstores()
+        self.assertEqual(len(self.read()[0]), 3)
+        # The store was cached read-only by the read above
+        self.store(3, 5)
+        timestamps, columns = self.read()
+        self.assertEqual(list(columns['MemFree']), range(5))
+
+    def test_new_columns(self):
+        collect_sysstat.createcolumns(self.namespace, *self.values(0),
+                                      rrdpath=self.path)
+        self.store(0, 2)
+        memvalues, netvalues, blockvalues, cpuvalues, loadavgvalues = \
+            self.values(2)
+        memvalues['Cached'] = 7.0
+        self.clock.now += 60
+        collect_sysstat.updatecolumns(self.namespace, memvalues, netvalues,
+                                      blockvalues, cpuvalues, loadavgvalues,
+                                      rrdpath=self.path)
+        timestamps, columns = collect_sysstat.readcolumns(
+            self.path, ['Cached', 'MemFree'], 0, self.clock.now)
+        self.assertEqual(list(columns['MemFree']), [0.0, 1.0, 2.0])
+        self.assertTrue(all(math.isnan(value)
+                            for value in columns['Cached'][:2]))
+        self.assertEqual(columns['Cached'][2], 7.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import math
+import shutil
+import tempfile
+import time
+import unittest
+from array import array
+
+import bench_sysstat
+import collect_sysstat
+
+
+class CpuTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_cpu')
+        bench_sysstat.makefixture(self.procroot, 4, 1, 1)
+        collect_sysstat.closeprocfiles()
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    def test_read(self):
+        names, ticks = collect_sysstat.read_cpu_data(self.procroot)
+        self.assertEqual(names, ('cpu', 'cpu0', 'cpu1', 'cpu2', 'cpu3'))
+        ncol = len(collect_sysstat.STAT_COLUMNS)
+        self.assertEqual(len(ticks), len(names) * ncol)
+        self.assertEqual(list(ticks[ncol:2 * ncol]),
+                         [1000 * (column + 1) for column in xrange(ncol)])
+
+    def test_snapshots_stay_intact(self):
+        first = collect_sysstat.read_cpu_data(self.procroot)
+        kept = list(first[1])
+        bench_sysstat.makefixture(self.procroot, 4, 1, 1, tick=1)
+        for _ in xrange(3):
+            collect_sysstat.read_cpu_data(self.procroot)
+        self.assertEqual(list(first[1]), kept)
+
+    def test_diff(self):
+        prev = collect_sysstat.read_cpu_data(self.procroot)
+        bench_sysstat.makefixture(self.procroot, 4, 1, 1, tick=1)
+        cur = collect_sysstat.read_cpu_data(self.procroot)
+        diff = collect_sysstat.diff_cpu_data(prev, cur)
+        self.assertEqual(sorted(diff), sorted(cur[0]))
+        # Every column grew by 100 * (column + 1) ticks, 3600 in total
+        for name, values in diff.iteritems():
+            self.assertEqual(values['name'], name)
+            self.assertAlmostEqual(values['user'], 100 * 100.0 / 3600)
+            self.assertAlmostEqual(values['idle'], 400 * 100.0 / 3600)
+            self.assertAlmostEqual(sum(
+                values[column] for column in collect_sysstat.STAT_COLUMNS[
+                    :collect_sysstat.STAT_ELAPSED_COLUMNS]), 100)
+
+    def test_diff_cpu_set_changed(self):
+        ncol = len(collect_sysstat.STAT_COLUMNS)
+        prev = (('cpu', 'cpu0', 'cpu1'), array('L', [10] * 3 * ncol))
+        cur = (('cpu', 'cpu1'), array('L', [20] * 2 * ncol))
+        diff = collect_sysstat.diff_cpu_data(prev, cur)
+        self.assertEqual(sorted(diff), ['cpu', 'cpu1'])
+        self.assertAlmostEqual(diff['cpu1']['idle'], 12.5)
+
+    def test_diff_skips_idle_rows(self):
+        ncol = len(collect_sysstat.STAT_COLUMNS)
+        prev = (('cpu', 'cpu0'), array('L', [10] * 2 * ncol))
+        cur = (('cpu', 'cpu0'), array('L', [20] * ncol + [10] * ncol))
+        self.assertEqual(sorted(collect_sysstat.diff_cpu_data(prev, cur)),
+                         ['cpu'])
+
+    def test_unchanged_stat_does_not_sleep(self):
+        state = {'cpu': collect_sysstat.read_cpu_data(self.procroot)}
+        started = time.time()
+        values = collect_sysstat.readCpuValues(state, self.procroot)
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(sorted(values), ['cpu', 'cpu0', 'cpu1', 'cpu2',
+                                          'cpu3'])
+        self.assertTrue(all(math.isnan(values['cpu0'][column])
+                            for column in collect_sysstat.STAT_COLUMNS))
+
+    def test_unchanged_stat_keeps_previous_result(self):
+        state = {'cpu': collect_sysstat.read_cpu_data(self.procroot)}
+        bench_sysstat.makefixture(self.procroot, 4, 1, 1, tick=1)
+        first = collect_sysstat.readCpuValues(state, self.procroot)
+        self.assertAlmostEqual(first['cpu']['user'], 100 * 100.0 / 3600)
+        again = collect_sysstat.readCpuValues(state, self.procroot)
+        self.assertEqual(again, first)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import collect_sysstat
+
+# /proc/diskstats line of Linux 5.5+, with discard and flush columns
+NVME_LINE = ('259       0 nvme0n1 1000 10 80000 500 2000 20 160000 900 '
+             '0 1200 1400 30 0 2400 40 50 60\n')
+
+
+class DiskstatsTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_diskstats')
+        with open(os.path.join(self.procroot, 'diskstats'), 'w') as f:
+            f.write(NVME_LINE)
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        self.namespace['block'] = True
+        collect_sysstat.closeprocfiles()
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    def test_all_columns_parsed(self):
+        blockvalues = collect_sysstat.readBlockValues('nvme0n1',
+                                                      self.procroot)
+        values = blockvalues['nvme0n1']
+        self.assertEqual(sorted(values),
+                         sorted(collect_sysstat.DISKSTATS_COLUMNS))
+        self.assertEqual(values['m'], 259)
+        self.assertEqual(values['dc_sectors'], 2400)
+        self.assertEqual(values['ms_discard'], 40)
+        self.assertEqual(values['ms_flush'], 60)
+
+    def test_ds_names_fit_rrdtool(self):
+        blockvalues = collect_sysstat.readBlockValues('nvme0n1',
+                                                      self.procroot)
+        sources = ({}, {}, blockvalues, {}, {})
+        names = [dataSource.name for dataSource in
+                 collect_sysstat.createDSList(self.namespace, *sources)]
+        self.assertEqual(len(names), len(collect_sysstat.DISKSTATS_COLUMNS)
+                         - 1)
+        self.assertTrue(all(len(name) <= collect_sysstat.DS_NAME_MAX
+                            for name in names))
+        plan = collect_sysstat.createUpdatePlan(*sources)
+        self.assertEqual(sorted(plan['names']), sorted(names))
+
+    def test_long_ds_names_shortened(self):
+        blockvalues = {'mmcblk0p1': {'dev': 'mmcblk0p1', 'reads': 1,
+                                     'ms_weighted': 2}}
+        sources = ({}, {}, blockvalues, {}, {})
+        short = collect_sysstat.dsname('mmcblk0p1_ms_weighted')
+        self.assertEqual(short, 'mmcblk0p1_ms_b91711')
+        self.assertEqual(
+            collect_sysstat.DS_NAME_SHORT['mmcblk0p1_ms_weighted'], short)
+        names = [dataSource.name for dataSource in
+                 collect_sysstat.createDSList(self.namespace, *sources)]
+        self.assertEqual(sorted(names), [short, 'mmcblk0p1_reads'])
+        plan = collect_sysstat.createUpdatePlan(*sources)
+        self.assertEqual(plan['names'], (short, 'mmcblk0p1_reads'))
+        self.assertEqual(plan['slots'], ((4, 'mmcblk0p1', 'ms_weighted'),
+                                         (4, 'mmcblk0p1', 'reads')))
+
+    def test_short_names_differ(self):
+        names = set(collect_sysstat.dsname('enp0s31f6_' + field)
+                    for field in collect_sysstat.DISKSTATS_COLUMNS)
+        self.assertEqual(len(names), len(collect_sysstat.DISKSTATS_COLUMNS))
+        self.assertTrue(all(len(name) <= collect_sysstat.DS_NAME_MAX
+                            for name in names))
+
+
+# The spec of a GRAPH_SPECS graph
+def graphspec(filename):
+    for spec in collect_sysstat.GRAPH_SPECS:
+        if spec['filename'] == filename:
+            return spec
+
+
+class GraphArgsTest(unittest.TestCase):
+    def test_long_ds_names_mapped(self):
+        args = collect_sysstat.graphargs(graphspec('{dev}_iostat_util.png'),
+                                         '/tmp/a.rrd', 'mmcblk0p1')
+        defs = [arg for arg in args if arg.startswith('DEF:')]
+        self.assertTrue(defs)
+        for arg in defs:
+            self.assertTrue(len(arg.split(':')[2]) <=
+                            collect_sysstat.DS_NAME_MAX, arg)
+
+    def test_absent_ds_left_out(self):
+        spec = graphspec('{dev}_iostat_ops.png')
+        args = collect_sysstat.graphargs(spec, '/tmp/a.rrd', 'sda',
+                                         frozenset(['sda_w_s']))
+        self.assertEqual([arg for arg in args if arg.startswith('DEF:')],
+                         ['DEF:dev_w_s=/tmp/a.rrd:sda_w_s:AVERAGE'])
+        self.assertFalse([arg for arg in args if 'dev_r_s' in arg])
+        # w/s was stacked on nothing, it is drawn on its own
+        self.assertFalse([arg for arg in args if arg.endswith(':STACK')])
+        self.assertEqual(collect_sysstat.graphargs(spec, '/tmp/a.rrd', 'sda',
+                                                   frozenset()), [])
+
+    def test_derived_series_left_out(self):
+        stored = frozenset(['Buffers', 'Cached', 'Slab', 'MemFree'])
+        args = collect_sysstat.graphargs(graphspec('memory_summary.png'),
+                                         '/tmp/a.rrd', None, stored)
+        self.assertFalse([arg for arg in args
+                          if 'MemTotal' in arg or 'mem_used' in arg])
+        self.assertTrue([arg for arg in args if 'Buffers' in arg])
+
+if __name__ == '__main__':
+    unittest.main()
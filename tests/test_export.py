@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+import urllib2
+
+import bench_sysstat
+import collect_sysstat
+
+
+class ExportTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_export')
+        disks, interfaces = bench_sysstat.makefixture(self.procroot, 2, 2, 1)
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        self.namespace['procroot'] = self.procroot
+        self.namespace['sysroot'] = None
+        self.namespace['netsource'] = 'proc'
+        self.namespace['interface'] = ' '.join(interfaces)
+        self.namespace['disk'] = ' '.join(disks)
+        self.namespace['exportaddr'] = '127.0.0.1'
+        self.namespace['exportport'] = 0
+        collect_sysstat.closeprocfiles()
+        collect_sysstat.EXPORT_CACHE['text'] = None
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        collect_sysstat.EXPORT_CACHE['text'] = None
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    # Scrape /metrics of server once
+    def scrape(self, server):
+        thread = threading.Thread(target=server.handle_request)
+        thread.start()
+        try:
+            response = urllib2.urlopen('http://127.0.0.1:%d/metrics' %
+                                       server.server_address[1])
+            return response.info().gettype(), response.read()
+        finally:
+            thread.join()
+
+    def test_first_scrape_does_not_sleep(self):
+        started = time.time()
+        server = collect_sysstat.startexporter(self.namespace)
+        try:
+            self.assertIn('cpu', server.state)
+            bench_sysstat.makefixture(self.procroot, 2, 2, 1, tick=1)
+            contenttype, text = self.scrape(server)
+        finally:
+            server.server_close()
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(contenttype, 'application/openmetrics-text')
+        self.assertTrue(text.endswith('# EOF\n'))
+        lines = text.splitlines()
+        self.assertIn('# TYPE sysstat_cpu_percent gauge', lines)
+        self.assertIn('sysstat_cpu_percent{cpu="cpu0",mode="user"} %r' %
+                      (100 * 100.0 / 3600), lines)
+        self.assertIn('sysstat_memory_bytes{field="MemTotal"} %d' %
+                      (1025 * 1024), lines)
+        self.assertIn('sysstat_load1 0.10', lines)
+
+    def test_scrapes_share_result(self):
+        server = collect_sysstat.startexporter(self.namespace)
+        try:
+            first = self.scrape(server)[1]
+            bench_sysstat.makefixture(self.procroot, 2, 2, 1, tick=1)
+            self.assertEqual(self.scrape(server)[1], first)
+        finally:
+            server.server_close()
+
+    def test_daemon_serves_collected_text(self):
+        self.namespace['daemon'] = True
+        collect_sysstat.updateexport({'MemFree': 1}, {}, {}, {}, {})
+        self.assertEqual(
+            collect_sysstat.exporttext(self.namespace, {}).splitlines(),
+            ['# TYPE sysstat_memory_bytes gauge',
+             '# HELP sysstat_memory_bytes Memory fields of /proc/meminfo.',
+             'sysstat_memory_bytes{field="MemFree"} 1024',
+             '# EOF'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench_sysstat
+import collect_sysstat
+
+
+class MeminfoTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_meminfo')
+        bench_sysstat.makefixture(self.procroot, 1, 1, 1)
+        self.path = os.path.join(self.procroot, 'meminfo')
+        collect_sysstat.closeprocfiles()
+        collect_sysstat.MEMINFO_LAYOUT.clear()
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        collect_sysstat.MEMINFO_LAYOUT.clear()
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    # Parse the fixture the plain way, for comparison
+    def expected(self):
+        values = {}
+        with open(self.path, 'r') as f:
+            for line in f:
+                x = line.split()
+                if x and x[0][:-1] in collect_sysstat.DS_MEM:
+                    values[x[0][:-1]] = int(x[1])
+        return values
+
+    def rewrite(self, lines):
+        with open(self.path, 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+    def test_first_read_learns_layout(self):
+        values = collect_sysstat.readMemValues(self.procroot)
+        self.assertEqual(values, self.expected())
+        self.assertEqual(sorted(values), sorted(collect_sysstat.DS_MEM))
+        self.assertEqual(sorted(collect_sysstat.MEMINFO_LAYOUT[self.path]),
+                         sorted(values))
+
+    def test_layout_reused(self):
+        collect_sysstat.readMemValues(self.procroot)
+        layout = dict(collect_sysstat.MEMINFO_LAYOUT[self.path])
+        bench_sysstat.makefixture(self.procroot, 1, 1, 1, tick=1)
+        values = collect_sysstat.readMemValues(self.procroot)
+        self.assertEqual(values, self.expected())
+        self.assertEqual(collect_sysstat.MEMINFO_LAYOUT[self.path], layout)
+
+    def test_layout_fallback(self):
+        collect_sysstat.readMemValues(self.procroot)
+        with open(self.path, 'r') as f:
+            lines = f.read().splitlines()
+        # A new field before the others and a value wider than before
+        lines.insert(0, 'NewField:           1 kB')
+        lines = [line.replace('1024', '123456789') for line in lines]
+        self.rewrite(lines)
+        values = collect_sysstat.readMemValues(self.procroot)
+        self.assertEqual(values, self.expected())
+        self.assertEqual(values['MemTotal'], 123456789)
+        # The new layout is used from now on
+        self.assertEqual(collect_sysstat.readMemValues(self.procroot),
+                         values)
+
+    def test_blank_lines_ignored(self):
+        with open(self.path, 'r') as f:
+            lines = f.read().splitlines()
+        self.rewrite([''] + lines[:5] + ['', ''] + lines[5:])
+        values = collect_sysstat.readMemValues(self.procroot)
+        self.assertEqual(values, self.expected())
+        self.assertEqual(collect_sysstat.readMemValues(self.procroot),
+                         values)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,60 @@
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import collect_sysstat
+
+
+class NeedsRenderTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_needsrender')
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        self.namespace['gtime'] = 3600
+        self.namespace['gwidth'] = 360
+        self.path = os.path.join(self.workdir, 'graph.png')
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    # Write the graph, age seconds ago, last read at atime seconds ago
+    def writegraph(self, age, atime=None):
+        with open(self.path, 'w') as f:
+            f.write('png')
+        now = time.time()
+        os.utime(self.path, (now - (age if atime is None else atime),
+                             now - age))
+
+    def test_missing_graph_rendered(self):
+        self.assertTrue(collect_sysstat.needsrender(self.namespace,
+                                                    self.path))
+
+    def test_rendered_once_window_moved_a_pixel(self):
+        self.writegraph(5)
+        self.assertFalse(collect_sysstat.needsrender(self.namespace,
+                                                     self.path))
+        self.writegraph(11)
+        self.assertTrue(collect_sysstat.needsrender(self.namespace,
+                                                    self.path))
+
+    def test_on_request(self):
+        self.namespace['gonrequest'] = True
+        self.writegraph(60)
+        self.assertFalse(collect_sysstat.needsrender(self.namespace,
+                                                     self.path))
+        # Read since it was written
+        self.writegraph(60, atime=30)
+        self.assertTrue(collect_sysstat.needsrender(self.namespace,
+                                                    self.path))
+        # Or asked for through the marker file
+        self.writegraph(60)
+        with open(self.path + '.request', 'w') as f:
+            f.write('')
+        self.assertTrue(collect_sysstat.needsrender(self.namespace,
+                                                    self.path))
+
+
+if __name__ == '__main__':
+    unittest.main()
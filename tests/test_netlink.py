@@ -0,0 +1,134 @@
+import socket
+import unittest
+
+import collect_sysstat
+
+# An ifindex no link has, the kernel answers requests for it with ENODEV
+MISSING_INDEX = 0x7fffffff
+
+
+# Return True if rtnetlink sockets can be opened here
+def hasnetlink():
+    try:
+        sock = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW,
+                             collect_sysstat.NETLINK_ROUTE)
+    except (AttributeError, socket.error):
+        return False
+    sock.close()
+    return True
+
+
+# Build one rtattr with its padding
+def rtattr(attrtype, value):
+    length = collect_sysstat.RTATTR.size + len(value)
+    return collect_sysstat.RTATTR.pack(length, attrtype) + value + \
+        '\0' * (((length + 3) & ~3) - length)
+
+
+class ParseLinkTest(unittest.TestCase):
+    def test_stats32_fallback(self):
+        counters = range(1, len(collect_sysstat.LINK_STATS) + 1)
+        payload = collect_sysstat.IFINFOMSG.pack(0, 0, 7, 0, 0) + \
+            rtattr(collect_sysstat.IFLA_IFNAME, 'eth7\0') + \
+            rtattr(collect_sysstat.IFLA_STATS,
+                   collect_sysstat.LINK_STATS32.pack(*counters))
+        index, name, stats = collect_sysstat.parselink(payload)
+        self.assertEqual((index, name), (7, 'eth7'))
+        self.assertEqual(stats, dict(zip(collect_sysstat.LINK_STATS,
+                                         counters)))
+
+    def test_stats64_preferred(self):
+        counters = [2 ** 40 + value
+                    for value in xrange(len(collect_sysstat.LINK_STATS))]
+        payload = collect_sysstat.IFINFOMSG.pack(0, 0, 3, 0, 0) + \
+            rtattr(collect_sysstat.IFLA_STATS64,
+                   collect_sysstat.LINK_STATS64.pack(*counters)) + \
+            rtattr(collect_sysstat.IFLA_STATS,
+                   collect_sysstat.LINK_STATS32.pack(
+                       *[0] * len(collect_sysstat.LINK_STATS))) + \
+            rtattr(collect_sysstat.IFLA_IFNAME, 'lo\0')
+        index, name, stats = collect_sysstat.parselink(payload)
+        self.assertEqual((index, name), (3, 'lo'))
+        self.assertEqual(stats['rx_packets'], 2 ** 40)
+
+
+@unittest.skipUnless(hasnetlink(), "rtnetlink is not available")
+class NetlinkTest(unittest.TestCase):
+    def setUp(self):
+        collect_sysstat.closenetlink()
+        collect_sysstat.opennetlink()
+
+    def tearDown(self):
+        collect_sysstat.closenetlink()
+        collect_sysstat.closeprocfiles()
+
+    # Return the ifindex of lo from a dump of all links
+    def loindex(self):
+        links, failed = collect_sysstat.netlinkquery(
+            [collect_sysstat.linkrequest()])
+        self.assertEqual(failed, 0)
+        return dict((name, index)
+                    for index, (name, stats) in links.iteritems())['lo']
+
+    # Assert lo counters of /proc/net/dev lie between two netlink reads
+    def assertBetween(self, before, proc, after):
+        self.assertEqual(sorted(before), sorted(proc))
+        for key in proc:
+            self.assertTrue(int(before[key]) <= int(proc[key]) <=
+                            int(after[key]), key)
+
+    def test_lo_matches_proc(self):
+        index = self.loindex()
+        links, failed = collect_sysstat.netlinkquery(
+            [collect_sysstat.linkrequest(index)])
+        self.assertEqual(failed, 0)
+        name, stats = links[index]
+        self.assertEqual(name, 'lo')
+        proc = collect_sysstat.readNetValues('lo')['lo']
+        links, failed = collect_sysstat.netlinkquery(
+            [collect_sysstat.linkrequest(index)])
+        self.assertBetween(collect_sysstat.linkvalues(stats), proc,
+                           collect_sysstat.linkvalues(links[index][1]))
+
+    def test_read_lo(self):
+        before = collect_sysstat.readNetlinkValues('lo')
+        proc = collect_sysstat.readNetValues('lo')
+        after = collect_sysstat.readNetlinkValues('lo')
+        self.assertEqual(sorted(before), ['lo'])
+        self.assertBetween(before['lo'], proc['lo'], after['lo'])
+
+    def test_index_rebuilt_after_link_event(self):
+        collect_sysstat.readNetlinkValues('lo')
+        index = collect_sysstat.NETLINK['index']['LO']
+        collect_sysstat.NETLINK['index']['LO'] = MISSING_INDEX
+        # Stand in for the event socket with a pending message
+        events, sender = socket.socketpair(socket.AF_UNIX, socket.SOCK_DGRAM)
+        events.setblocking(False)
+        collect_sysstat.NETLINK['events'].close()
+        collect_sysstat.NETLINK['events'] = events
+        try:
+            sender.send('link event')
+            self.assertEqual(sorted(collect_sysstat.readNetlinkValues('lo')),
+                             ['lo'])
+        finally:
+            sender.close()
+        self.assertEqual(collect_sysstat.NETLINK['index']['LO'], index)
+        self.assertFalse(collect_sysstat.linkchanged())
+
+    def test_index_rebuilt_after_error(self):
+        index = self.loindex()
+        links, failed = collect_sysstat.netlinkquery(
+            [collect_sysstat.linkrequest(MISSING_INDEX)])
+        self.assertEqual((links, failed), ({}, 1))
+        collect_sysstat.readNetlinkValues('lo')
+        collect_sysstat.NETLINK['index']['LO'] = MISSING_INDEX
+        # The request for the stale index fails and drops the cache
+        self.assertEqual(collect_sysstat.readNetlinkValues('lo'), {})
+        self.assertIsNone(collect_sysstat.NETLINK['index'])
+        self.assertEqual(sorted(collect_sysstat.readNetlinkValues('lo')),
+                         ['lo'])
+        self.assertEqual(collect_sysstat.NETLINK['index']['LO'], index)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench_sysstat
+import collect_sysstat
+
+
+class SelfStatsTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_selfstats')
+        bench_sysstat.makefixture(self.procroot, 1, 1, 1)
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        collect_sysstat.closeprocfiles()
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    def test_opens_counted_per_cycle(self):
+        state = {}
+        collect_sysstat.endcycle(self.namespace, state, 0)
+        collect_sysstat.readMemValues(self.procroot)
+        collect_sysstat.readLoadAvgValues(self.procroot)
+        collect_sysstat.savestate(os.path.join(self.procroot, 'state'),
+                                  {'cpu': (('cpu',), [0] * 10)},
+                                  self.procroot)
+        collect_sysstat.endcycle(self.namespace, state, 0)
+        # meminfo, loadavg, uptime and the state file
+        self.assertEqual(state['self']['opens'], 4)
+        # /proc files are read again through the fds kept open
+        collect_sysstat.readMemValues(self.procroot)
+        collect_sysstat.readLoadAvgValues(self.procroot)
+        collect_sysstat.endcycle(self.namespace, state, 0)
+        self.assertEqual(state['self']['opens'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,165 @@
+import os
+import socket
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import collect_sysstat
+
+# One sample of every source shipped by the tests
+VALUES = ({'MemFree': 100, 'MemTotal': 200},
+          {'eth0': {'recv_bytes': 5, 'trans_bytes': 6}},
+          {},
+          {'cpu': {'user': 1.5, 'idle': 98.5, 'name': 'cpu'}},
+          {'1m': 0.5})
+
+
+# Local TCP listener keeping everything sent to it
+class Receiver(object):
+    def __init__(self, port=0):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind(('127.0.0.1', port))
+        self.sock.listen(5)
+        self.port = self.sock.getsockname()[1]
+        self.chunks = []
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                conn, _ = self.sock.accept()
+            except socket.error:
+                return
+            while True:
+                chunk = conn.recv(65536)
+                if not chunk:
+                    break
+                self.chunks.append(chunk)
+            conn.close()
+
+    # Wait until size bytes arrived and return everything received
+    def received(self, size, timeout=5):
+        deadline = time.time() + timeout
+        while len(''.join(self.chunks)) < size and time.time() < deadline:
+            time.sleep(0.01)
+        return ''.join(self.chunks)
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+        self.thread.join(5)
+
+
+# Return a local port nothing listens on
+def closedport():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class ShipTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_ship')
+        self.namespace = collect_sysstat.initnamespace(
+            collect_sysstat.createParser().parse_args([]))
+        self.namespace['spoolpath'] = os.path.join(self.workdir, 'spool')
+        self.host = socket.gethostname()
+        collect_sysstat.UPDATE_PLAN.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def shipto(self, port):
+        self.namespace['shipto'] = ('127.0.0.1', port)
+
+    def readspool(self):
+        with open(self.namespace['spoolpath'], 'rb') as f:
+            return f.read()
+
+    def test_graphite_lines(self):
+        prefix = 'sysstat.%s.' % self.host.replace('.', '_')
+        expected = ''.join(prefix + line for line in (
+            'memory.MemFree 100 1000\n',
+            'memory.MemTotal 200 1000\n',
+            'loadavg.1m 0.5 1000\n',
+            'cpu.cpu.idle 98.5 1000\n',
+            'cpu.cpu.user 1.5 1000\n',
+            'net.eth0.recv_bytes 5 1000\n',
+            'net.eth0.trans_bytes 6 1000\n'))
+        self.assertEqual(collect_sysstat.shiplines(self.namespace, 1000,
+                                                   *VALUES), expected)
+
+    def test_influx_lines(self):
+        self.namespace['shipformat'] = 'influx'
+        tags = ',host=' + self.host
+        expected = (
+            'sysstat_memory%s MemFree=100.0,MemTotal=200.0 1000000000000\n'
+            'sysstat_loadavg%s 1m=0.5 1000000000000\n'
+            'sysstat_cpu%s,device=cpu idle=98.5,user=1.5 1000000000000\n'
+            'sysstat_net%s,device=eth0 recv_bytes=5.0,trans_bytes=6.0 '
+            '1000000000000\n') % ((tags,) * 4)
+        self.assertEqual(collect_sysstat.shiplines(self.namespace, 1000,
+                                                   *VALUES), expected)
+
+    def test_ship_to_listener(self):
+        for shipformat in ('graphite', 'influx'):
+            receiver = Receiver()
+            try:
+                self.namespace['shipformat'] = shipformat
+                self.shipto(receiver.port)
+                state = {}
+                collect_sysstat.ship(self.namespace, state, *VALUES)
+                expected = collect_sysstat.shiplines(
+                    self.namespace, int(time.time()), *VALUES)
+                received = receiver.received(len(expected))
+            finally:
+                receiver.close()
+            # Timestamps may differ by the second the sample crossed
+            self.assertEqual([line.rsplit(' ', 1)[0]
+                              for line in received.splitlines()],
+                             [line.rsplit(' ', 1)[0]
+                              for line in expected.splitlines()])
+            self.assertNotIn('shipsock', state)
+            self.assertFalse(os.path.exists(self.namespace['spoolpath']))
+
+    def test_spool_trimmed_at_spoolmax(self):
+        self.namespace['spoolmax'] = 20
+        lines = ['line%03d\n' % index for index in xrange(5)]
+        for line in lines:
+            collect_sysstat.spoolappend(self.namespace, line)
+        spool = self.readspool()
+        self.assertTrue(len(spool) <= 20)
+        # Only whole lines are kept, the newest ones
+        self.assertEqual(spool, ''.join(lines[-2:]))
+
+    def test_spool_then_replay_in_order(self):
+        self.shipto(closedport())
+        state = {}
+        for line in ('first 1 1\n', 'second 2 2\n'):
+            state['ship'] = {'lines': [line], 'since': time.time()}
+            collect_sysstat.flushship(self.namespace, state)
+            self.assertIsNone(state['shipsock'])
+        self.assertEqual(self.readspool(), 'first 1 1\nsecond 2 2\n')
+        receiver = Receiver(self.namespace['shipto'][1])
+        try:
+            state['ship'] = {'lines': ['third 3 3\n'], 'since': time.time()}
+            collect_sysstat.flushship(self.namespace, state)
+            self.assertIsNotNone(state['shipsock'])
+            state.pop('shipsock').close()
+            expected = 'first 1 1\nsecond 2 2\nthird 3 3\n'
+            self.assertEqual(receiver.received(len(expected)), expected)
+        finally:
+            receiver.close()
+        self.assertFalse(os.path.exists(self.namespace['spoolpath']))
+        self.assertNotIn('shipfailed', state)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench_sysstat
+import collect_sysstat
+
+
+class StateTest(unittest.TestCase):
+    def setUp(self):
+        self.procroot = tempfile.mkdtemp(prefix='test_state')
+        bench_sysstat.makefixture(self.procroot, 2, 1, 1)
+        self.path = os.path.join(self.procroot, 'test.cpustate')
+        collect_sysstat.closeprocfiles()
+        self.state = {'cpu': collect_sysstat.read_cpu_data(self.procroot),
+                      'self': {'cpu_pct': 0.5},
+                      'block': (1500000000.0, {'sda': [1, 2, 3]})}
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        shutil.rmtree(self.procroot, ignore_errors=True)
+
+    # Write an uptime of seconds into the fixture
+    def setuptime(self, seconds):
+        with open(os.path.join(self.procroot, 'uptime'), 'w') as f:
+            f.write('%d.00 0.00\n' % seconds)
+
+    def test_round_trip(self):
+        collect_sysstat.savestate(self.path, self.state, self.procroot)
+        self.setuptime(1060)
+        state = {}
+        collect_sysstat.loadstate(self.path, state, self.procroot)
+        self.assertEqual(sorted(state), ['block', 'cpu', 'self'])
+        self.assertEqual(state['cpu'][0], self.state['cpu'][0])
+        self.assertEqual(list(state['cpu'][1]), list(self.state['cpu'][1]))
+        self.assertEqual(state['self'], {'cpu_pct': 0.5})
+        self.assertEqual(state['block'], (1500000000.0, {'sda': [1, 2, 3]}))
+
+    def test_block_only(self):
+        del self.state['cpu']
+        collect_sysstat.savestate(self.path, self.state, self.procroot)
+        self.setuptime(1060)
+        state = {}
+        collect_sysstat.loadstate(self.path, state, self.procroot)
+        self.assertEqual(sorted(state), ['block', 'self'])
+
+    def test_stale_state_ignored(self):
+        collect_sysstat.savestate(self.path, self.state, self.procroot)
+        for uptime in (1000, 900, 1001 + collect_sysstat.STATE_MAX_AGE):
+            self.setuptime(uptime)
+            state = {}
+            collect_sysstat.loadstate(self.path, state, self.procroot)
+            self.assertEqual(state, {}, uptime)
+
+    def test_missing_or_malformed_ignored(self):
+        state = {}
+        collect_sysstat.loadstate(self.path, state, self.procroot)
+        with open(self.path, 'w') as f:
+            f.write('garbage\n')
+        collect_sysstat.loadstate(self.path, state, self.procroot)
+        self.assertEqual(state, {})
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import bench_sysstat
+import collect_sysstat
+
+
+class SysBlockTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix='test_sysblock')
+        self.procroot = os.path.join(self.workdir, 'proc')
+        self.sysroot = os.path.join(self.workdir, 'sys')
+        bench_sysstat.makefixture(self.procroot, 1, 2, 1,
+                                  sysroot=self.sysroot)
+        self.names = ['disk0', 'disk1', 'disk2']
+        collect_sysstat.closeprocfiles()
+        collect_sysstat.SYS_BLOCK.clear()
+
+    def tearDown(self):
+        collect_sysstat.closeprocfiles()
+        collect_sysstat.SYS_BLOCK.clear()
+        shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def read(self):
+        return collect_sysstat.readSysBlockValues(self.names, self.sysroot)
+
+    # Set the mtime of <sysroot>/block to a whole second, as os.utime()
+    # cannot restore the nanoseconds of an mtime
+    def setmtime(self):
+        base = os.path.join(self.sysroot, 'block')
+        os.utime(base, (1500000000, 1500000000))
+
+    # Plug in disk2, keeping the mtime of <sysroot>/block if asked to
+    def plug(self, keepmtime=False):
+        bench_sysstat.makefixture(self.procroot, 1, 3, 1,
+                                  sysroot=self.sysroot)
+        if keepmtime:
+            self.setmtime()
+
+    def test_read(self):
+        values = self.read()
+        self.assertEqual(sorted(values), ['disk0', 'disk1'])
+        self.assertEqual((values['disk1']['m'], values['disk1']['mm']),
+                         (8, 16))
+        self.assertEqual(values['disk1']['reads'], 1000)
+
+    def test_partition(self):
+        path = os.path.join(self.sysroot, 'block', 'disk0', 'disk0p1')
+        os.makedirs(path)
+        bench_sysstat.writefixture(path, 'dev', ['8:1'])
+        bench_sysstat.writefixture(path, 'stat', ['1 2 3 4'])
+        values = collect_sysstat.readSysBlockValues(['disk0p1'],
+                                                    self.sysroot)
+        self.assertEqual(values['disk0p1']['mm'], 1)
+        self.assertEqual(values['disk0p1']['reads'], 1)
+
+    def test_hotplug_seen_on_block_change(self):
+        self.read()
+        self.plug()
+        self.assertEqual(sorted(self.read()), self.names)
+
+    def test_hotplug_seen_after_rescan_samples(self):
+        self.setmtime()
+        self.read()
+        self.plug(keepmtime=True)
+        for _ in xrange(collect_sysstat.SYS_BLOCK_RESCAN - 1):
+            self.assertEqual(sorted(self.read()), ['disk0', 'disk1'])
+        self.assertEqual(sorted(self.read()), self.names)
+
+    def test_lookup_kept_while_complete(self):
+        self.names = ['disk0', 'disk1']
+        self.read()
+        lookup = collect_sysstat.SYS_BLOCK.values()[0]
+        self.plug()
+        for _ in xrange(collect_sysstat.SYS_BLOCK_RESCAN + 1):
+            self.read()
+        self.assertIs(collect_sysstat.SYS_BLOCK.values()[0], lookup)
+        self.assertEqual(lookup[2], 0)
+
+    def test_no_block_devices(self):
+        self.assertIsNone(collect_sysstat.readSysBlockValues(
+            self.names, os.path.join(self.workdir, 'nosys')))
+
+
+if __name__ == '__main__':
+    unittest.main()
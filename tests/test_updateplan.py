@@ -0,0 +1,45 @@
+import unittest
+
+import collect_sysstat
+
+
+class UpdatePlanTest(unittest.TestCase):
+    def setUp(self):
+        collect_sysstat.UPDATE_PLAN.clear()
+        self.sources = ({'MemFree': 1, 'Active(anon)': 2},
+                        {'eth0': {'recv_bytes': 3, 'recv_drop': 4}},
+                        {'sda': {'dev': 'sda', 'writes': 5, 'reads': 6}},
+                        {'cpu': {'name': 'cpu', 'user': 7.5,
+                                 'guest-nice': 0.0}},
+                        {'loadavg1min': '0.10'})
+
+    def tearDown(self):
+        collect_sysstat.UPDATE_PLAN.clear()
+
+    def test_template_and_values(self):
+        plan = collect_sysstat.updateplan(*self.sources, plankey='a.rrd')
+        self.assertEqual(plan['template'],
+                         'Active_anon:MemFree:loadavg1min:cpu_user:'
+                         'eth0_recv_bytes:sda_reads:sda_writes')
+        self.assertEqual(collect_sysstat.planvalues(plan, *self.sources),
+                         ['2', '1', '0.10', '7.5', '3', '6', '5'])
+
+    def test_plan_reused(self):
+        plan = collect_sysstat.updateplan(*self.sources, plankey='a.rrd')
+        self.sources[2]['sda']['reads'] = 60
+        self.assertIs(collect_sysstat.updateplan(*self.sources,
+                                                 plankey='a.rrd'), plan)
+        # Plans of other RRD files are kept apart
+        self.assertIsNot(collect_sysstat.updateplan(*self.sources,
+                                                    plankey='b.rrd'), plan)
+
+    def test_plan_rebuilt_when_fields_change(self):
+        plan = collect_sysstat.updateplan(*self.sources, plankey='a.rrd')
+        self.sources[2]['sda']['r_s'] = 1.5
+        rebuilt = collect_sysstat.updateplan(*self.sources, plankey='a.rrd')
+        self.assertIsNot(rebuilt, plan)
+        self.assertIn('sda_r_s', rebuilt['names'])
+
+
+if __name__ == '__main__':
+    unittest.main()